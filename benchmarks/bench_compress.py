@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare throughput of the sum waveform zero suppression against the
+original per-sample loop. Waveforms look roughly like TPC sum waveforms:
+mostly zero with a few pulses of a few hundred samples.
+
+    python benchmarks/bench_compress.py
+"""
+
+import time
+import numpy as np
+
+from jax.output import compress_waveform
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def loop_compress(waveform):
+    zeros = 0
+    ret = []
+    for i in range(0, len(waveform)):
+        if waveform[i] == 0:
+            zeros += 1
+            continue
+        else:
+            if zeros != 0:
+                ret.append('z')
+                ret.append(str(zeros))
+                zeros = 0
+            ret.append(str(waveform[i]))
+    if zeros != 0:
+        ret.append('z')
+        ret.append(str(zeros))
+    return ret
+
+
+def make_waveform(n_samples, occupancy, rng):
+    """
+    Zero waveform with pulses of ~200 samples until the requested
+    fraction of samples is non-zero
+    """
+    samples = np.zeros(n_samples, dtype=np.float32)
+    n_pulses = max(1, int(n_samples * occupancy / 200))
+    for start in rng.randint(0, n_samples - 200, n_pulses):
+        samples[start:start+200] = rng.exponential(5, 200)
+    return samples.astype(np.float64).tolist()
+
+
+def rate(function, waveforms):
+    start = time.time()
+    for waveform in waveforms:
+        function(waveform)
+    return sum(len(w) for w in waveforms) / (time.time() - start)
+
+
+def main():
+    rng = np.random.RandomState(0)
+    print("Rates in samples/s. 'list' takes the json sample list, 'array' "
+          "the float array straight from the event")
+    print("occupancy        loop        list       array")
+    for occupancy in [0.001, 0.01, 0.05, 0.2]:
+        waveforms = [make_waveform(200000, occupancy, rng) for i in range(20)]
+        for waveform in waveforms:
+            assert compress_waveform(waveform) == loop_compress(waveform)
+        arrays = [np.array(waveform) for waveform in waveforms]
+        print("%9.3f   %9.3g   %9.3g   %9.3g" % (
+            occupancy, rate(loop_compress, waveforms),
+            rate(compress_waveform, waveforms),
+            rate(compress_waveform, arrays)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time reading a processed (ROOT) file with 1, 2, 4, ... entry_workers.
+Writes a synthetic file shaped like pax output with uproot first.
+
+    python benchmarks/bench_processed_parallel.py [n_events] [max_workers]
+"""
+
+import os
+import sys
+import time
+import tempfile
+from configparser import ConfigParser
+
+import numpy as np
+import uproot
+import awkward as ak
+
+from jax.output import Output
+from jax.processor import Processor
+from jax.root_reader import PEAK_BRANCHES, INTERACTION_BRANCHES
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+class CountingOutput(Output):
+    """
+    Takes the docs and counts them, so we time the reading
+    """
+
+    def __init__(self):
+        super(CountingOutput, self).__init__(ConfigParser(), "jax")
+        self.saved = 0
+        self.closed = None
+
+    def save_reduced_doc(self, insert_doc, collection):
+        self.saved += 1
+
+    def close(self, collection, nevents):
+        self.closed = nevents
+
+
+def fixed_size(values, counts):
+    """
+    Jagged array of the (counts[i], width) blocks of values. uproot
+    works out the basket offsets of such a branch from the flattened
+    values, so it gets offsets in values, not rows.
+    """
+    offsets = np.concatenate(([0], np.cumsum(counts))) * values.shape[1]
+    return ak.Array(ak.contents.ListOffsetArray(
+        ak.index.Index64(offsets),
+        ak.contents.RegularArray(ak.contents.NumpyArray(values.ravel()),
+                                 values.shape[1])))
+
+
+def write_file(filename, n, rng):
+    """
+    n events with 0-19 peaks and up to 2 interactions each
+    """
+    n_peaks = rng.randint(0, 20, n)
+    total = n_peaks.sum()
+    peak_offsets = np.concatenate(([0], np.cumsum(n_peaks)))
+    branches = {
+        "event_number": np.arange(n),
+        "start_time": np.arange(n, dtype=np.int64) * 1000,
+        "stop_time": np.arange(n, dtype=np.int64) * 1000 + 500,
+    }
+    for b in PEAK_BRANCHES:
+        if b == "range_area_decile":
+            # Sliced per basket below
+            deciles = np.sort(rng.exponential(100, (total, 11)), axis=1)
+            continue
+        values = rng.exponential(100, total)
+        branches["peaks." + b] = ak.unflatten(values, n_peaks)
+    # Peaks 0 and 1 are the S1 and S2 of events that have them
+    n_s = np.minimum(n_peaks, 1)
+    branches["s1s"] = ak.unflatten(np.zeros(n_s.sum(), dtype=np.int32), n_s)
+    n_s = (n_peaks > 1).astype(np.int64)
+    branches["s2s"] = ak.unflatten(np.ones(n_s.sum(), dtype=np.int32), n_s)
+    n_interactions = np.where(n_peaks > 1, rng.randint(0, 3, n), 0)
+    for b in INTERACTION_BRANCHES:
+        values = rng.uniform(1, 2, n_interactions.sum())
+        if b in ["s1", "s2"]:
+            values = np.full(n_interactions.sum(), int(b == "s2"))
+        branches["interactions." + b] = ak.unflatten(values, n_interactions)
+    types = dict((k, v.type) if hasattr(v, "layout") else (k, v.dtype)
+                 for k, v in branches.items())
+    types["peaks.range_area_decile"] = "var * 11 * float64"
+    with uproot.recreate(filename) as f:
+        # A TTree like pax writes, not uproot's default RNTuple
+        f.mktree("tree", types)
+        # One basket per 1000 entries, a worker only decompresses
+        # the baskets of its own range
+        for start in range(0, n, 1000):
+            stop = min(start + 1000, n)
+            chunk = dict((k, v[start:stop]) for k, v in branches.items())
+            chunk["peaks.range_area_decile"] = fixed_size(
+                deciles[peak_offsets[start]:peak_offsets[stop]],
+                n_peaks[start:stop])
+            f["tree"].extend(chunk)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    directory = tempfile.mkdtemp()
+    write_file(os.path.join(directory, "bench.root"), n,
+               np.random.RandomState(0))
+
+    print("workers   events/s   speedup")
+    single = None
+    workers = 1
+    while workers <= max_workers:
+        config = ConfigParser()
+        config.add_section("jax")
+        config.set("jax", "input_type", "processed")
+        config.set("jax", "data_path", directory)
+        config.set("jax", "entry_workers", str(workers))
+        output = CountingOutput()
+        start = time.time()
+        Processor(config).process_run(output, {'name': "bench"})
+        rate = output.saved / (time.time() - start)
+        assert output.closed == n
+        single = single or rate
+        print("%7d %10.0f %9.2f" % (workers, rate, rate / single))
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
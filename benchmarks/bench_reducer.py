@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Events/s of the table driven jax.reducer.Reducer against the reduced
+doc code it replaced (copied below as legacy_reduce), for ROOT and
+python native shaped events.
+
+    python benchmarks/bench_reducer.py
+"""
+
+import time
+from types import SimpleNamespace
+import numpy as np
+
+from jax.reducer import Reducer, REDUCED_FIELDS
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+# The reduced doc code jax.reducer replaced
+def legacy_reduce(event):
+    """
+    Returns the reduced doc for this event or None if the event
+    can't be read
+    """
+    insert_doc = {"type": "data"}
+    insert_doc.update(dict.fromkeys(REDUCED_FIELDS))
+
+    # This is a bit nasty. Here's the thing. The pax event class
+    # is different if using ROOT output or if using the python
+    # native version.
+    try:
+        legacy_fill(insert_doc, event)
+    except Exception as e:
+        print("Couldn't read event class in either pax native "
+              "or ROOT form. Failing. " + str(e))
+        return None
+    return insert_doc
+
+
+def legacy_fill(insert_doc, event):
+
+    # Nasty things to maintain ROOT and python-native compatibility
+    # Don't ask, just DO.
+    try:
+        s1s = event.s1s()
+        s2s = event.s2s()
+        peaks = event.peaks
+        interactions = event.interactions
+    except Exception as e:
+        s1s = event.s1s
+        s2s = event.s2s
+        peaks = event.peaks
+        interactions = event.interactions
+
+    insert_doc['ns1'] = len(s1s)
+    insert_doc['ns2'] = len(s2s)
+    insert_doc['time'] = event.start_time
+    insert_doc['event_number'] = event.event_number
+    insert_doc['event_length'] = event.stop_time - event.start_time
+    insert_doc['interactions'] = len(interactions)
+    if len(interactions) > 0:
+        interaction = interactions[0]
+        s1 = peaks[interaction.s1]
+        s2 = peaks[interaction.s2]
+
+        insert_doc['s1'] = s1.area
+        insert_doc['s2'] = s2.area
+        insert_doc['cs1'] = insert_doc['s1']*interaction.s1_area_correction
+        insert_doc['cs2'] = insert_doc['s2']*interaction.s2_area_correction
+        insert_doc['x'] = interaction.x
+        insert_doc['y'] = interaction.y
+        insert_doc['z'] = interaction.z
+        insert_doc['dt'] = interaction.drift_time
+        insert_doc['s1_range_50p_area'] = s1.range_area_decile[5]
+        insert_doc['s2_range_50p_area'] = s2.range_area_decile[5]
+        insert_doc['s1_hit_time_mean'] = s1.hit_time_mean
+        insert_doc['s2_hit_time_mean'] = s2.hit_time_mean
+        insert_doc['s1_area_fraction_top'] = s1.area_fraction_top
+        insert_doc['s2_area_fraction_top'] = s2.area_fraction_top
+        insert_doc['s1_n_hits'] = s1.n_hits
+        insert_doc['s2_n_hits'] = s2.n_hits
+        insert_doc['s1_n_contributing_channels'] = s1.n_contributing_channels
+        insert_doc['s2_n_contributing_channels'] = s2.n_contributing_channels
+        insert_doc['s1_n_saturated_channels'] = s1.n_saturated_channels
+        insert_doc['s2_n_saturated_channels'] = s2.n_saturated_channels
+
+    # Now we want the largest other s1 and largest other s1
+    los1 = None
+    alos1 = 0
+    for s1 in s1s:
+        try:
+            if peaks[s1].area > alos1:
+                alos1 = peaks[s1].area
+                los1 = peaks[s1]
+        except:
+            if s1.area > alos1:
+                alos1 = s1.area
+                los1 = s1
+    los2 = None
+    alos2 = 0
+    for s2 in s2s:
+        try:
+            if peaks[s2].area > alos2:
+                alos2 = peaks[s2].area
+                los2 = peaks[s2]
+        except:
+            if s2.area > alos2:
+                alos2 = s2.area
+                los2 = s2
+
+    if los1 is not None:
+        insert_doc['largest_other_s1'] = los1.area
+        insert_doc['largest_other_s1_range_50p_area'] = los1.range_area_decile[5]
+        insert_doc['largest_other_s1_hit_time_mean'] = los1.hit_time_mean
+        insert_doc['largest_other_s1_n_contributing_channels'] = los1.n_contributing_channels
+    if los2 is not None:
+        insert_doc['largest_other_s2'] = los2.area
+        insert_doc['largest_other_s2_range_50p_area'] = los2.range_area_decile[5]
+        insert_doc['largest_other_s2_hit_time_mean'] = los2.hit_time_mean
+        insert_doc['largest_other_s2_n_contributing_channels'] = los2.n_contributing_channels
+
+
+def make_events(n, rng):
+    """
+    ROOT flavour events with up to 10 peaks and 2 interactions
+    """
+    events = []
+    for i in range(n):
+        peaks = [SimpleNamespace(
+            area=float(rng.exponential(100)),
+            range_area_decile=rng.uniform(0, 1000, 11),
+            hit_time_mean=float(rng.uniform(0, 1e5)),
+            area_fraction_top=float(rng.uniform()),
+            n_hits=int(rng.randint(0, 100)),
+            n_contributing_channels=int(rng.randint(0, 100)),
+            n_saturated_channels=0) for j in range(rng.randint(2, 10))]
+        s1s = list(range(0, len(peaks), 2))
+        s2s = list(range(1, len(peaks), 2))
+        interactions = [SimpleNamespace(
+            s1=s1s[0], s2=s2s[0], s1_area_correction=1.1,
+            s2_area_correction=1.2, x=0., y=0., z=0., drift_time=1e4)
+            for j in range(rng.randint(0, 3))]
+        events.append(SimpleNamespace(
+            event_number=i, start_time=i * 1000, stop_time=i * 1000 + 500,
+            s1s=s1s, s2s=s2s, peaks=peaks, interactions=interactions))
+    return events
+
+
+def to_native(event):
+    s1s = [event.peaks[i] for i in event.s1s]
+    s2s = [event.peaks[i] for i in event.s2s]
+    return SimpleNamespace(event_number=event.event_number,
+                           start_time=event.start_time,
+                           stop_time=event.stop_time,
+                           peaks=event.peaks, interactions=event.interactions,
+                           s1s=lambda: s1s, s2s=lambda: s2s)
+
+
+def rate(function, events, repeat=3):
+    best = 0
+    for i in range(repeat):
+        start = time.time()
+        for event in events:
+            function(event)
+        best = max(best, len(events) / (time.time() - start))
+    return best
+
+
+def main():
+    events = make_events(20000, np.random.RandomState(0))
+    print("flavour     legacy events/s   table events/s   speedup")
+    for flavour, sample in [("ROOT", events),
+                            ("native", [to_native(e) for e in events])]:
+        old = rate(legacy_reduce, sample)
+        new = rate(Reducer().reduce, sample)
+        print("%-8s %18.0f %16.0f %9.2f" % (flavour, old, new, new / old))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the zero suppressed string waveform format with the zlib
+compressed binary one: BSON size of the samples field and encode rate.
+
+    python benchmarks/bench_waveform_encoding.py
+"""
+
+import time
+import bson
+import numpy as np
+
+from jax.output import compress_waveform, encode_waveform
+from bench_compress import make_waveform
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def measure(function, waveforms):
+    """
+    Returns (total BSON bytes, samples/s) for encoding all waveforms
+    """
+    start = time.time()
+    encoded = [function(waveform) for waveform in waveforms]
+    elapsed = time.time() - start
+    size = sum(len(bson.BSON.encode({'samples': e})) for e in encoded)
+    return size, sum(len(w) for w in waveforms) / elapsed
+
+
+def main():
+    rng = np.random.RandomState(0)
+    print("Sizes are BSON bytes per waveform, rates in samples/s")
+    print("occupancy  strings size  binary size   ratio  "
+          "strings rate  binary rate")
+    for occupancy in [0.001, 0.01, 0.05, 0.2]:
+        waveforms = [np.array(make_waveform(200000, occupancy, rng),
+                              dtype=np.float32) for i in range(20)]
+        s_size, s_rate = measure(compress_waveform, waveforms)
+        b_size, b_rate = measure(encode_waveform, waveforms)
+        print("%9.3f  %12d  %11d  %6.1f  %12.3g  %11.3g" % (
+            occupancy, s_size / len(waveforms), b_size / len(waveforms),
+            s_size / b_size, s_rate, b_rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Streaming per-run aggregates of the reduced docs: fixed binning 1D and
+2D histograms, counters and quantile sketches. They live in the run's
+status doc under 'aggregates', so a dashboard reads O(bins) numbers
+instead of every event. Everything is additive and written as $inc of
+what changed since the last write, so several processes writing the
+same run add up.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import math
+import numpy as np
+
+# name: ([fields], [bins per field], [(low, high) per field])
+DEFAULT_HISTOGRAMS = {
+    "cs1": (["cs1"], [100], [(0., 5000.)]),
+    "cs2": (["cs2"], [100], [(0., 500000.)]),
+    "cs1_cs2": (["cs1", "cs2"], [100, 100], [(0., 5000.), (0., 500000.)]),
+    "dt": (["dt"], [100], [(0., 800000.)]),
+    "xy": (["x", "y"], [50, 50], [(-50., 50.), (-50., 50.)]),
+}
+DEFAULT_QUANTILE_FIELDS = ["cs1", "cs2", "s1", "s2", "event_length"]
+
+
+def parse_histogram(name, spec):
+    """
+    Turns a [histograms] entry like
+        cs1_cs2 = cs1 100 0 5000 cs2 100 0 5e5
+    (field, bins, low, high for every axis) into a DEFAULT_HISTOGRAMS
+    value
+    """
+    parts = spec.split()
+    if len(parts) not in [4, 8]:
+        raise ValueError("Can't make a histogram of " + name + " = " + spec +
+                         ", expected field bins low high for 1 or 2 axes")
+    fields, bins, ranges = [], [], []
+    for i in range(0, len(parts), 4):
+        fields.append(parts[i])
+        bins.append(int(parts[i+1]))
+        ranges.append((float(parts[i+2]), float(parts[i+3])))
+    return fields, bins, ranges
+
+
+def get_histograms(config):
+    """
+    The histograms in the [histograms] section, or the default ones if
+    there is none
+    """
+    if config is None or not config.has_section("histograms"):
+        return DEFAULT_HISTOGRAMS
+    return dict((name, parse_histogram(name, spec))
+                for name, spec in config.items("histograms"))
+
+
+class Histogram(object):
+    """
+    Fixed binning histogram of one or two fields. Values outside the
+    range go to 'overflow', events without the field aren't counted.
+    Counts are stored flat, row major, with the first field on the
+    slow axis.
+    """
+
+    def __init__(self, fields, bins, ranges):
+        self.fields = fields
+        self.bins = bins
+        self.ranges = ranges
+        self.counts = np.zeros(int(np.prod(bins)), dtype=np.int64)
+        self.overflow = 0
+
+    def add(self, columns):
+        values = [columns[field] for field in self.fields]
+        ok = np.ones(len(values[0]), dtype=bool)
+        for v in values:
+            ok &= np.isfinite(v)
+        index = np.zeros(ok.sum(), dtype=np.int64)
+        inside = np.ones(ok.sum(), dtype=bool)
+        for v, n, (low, high) in zip(values, self.bins, self.ranges):
+            v = v[ok]
+            inside &= (v >= low) & (v < high)
+            index = index * n + np.clip(
+                ((v - low) * (n / (high - low))).astype(np.int64), 0, n - 1)
+        self.counts += np.bincount(index[inside], minlength=len(self.counts))
+        self.overflow += int((~inside).sum())
+
+    def empty_doc(self):
+        return {"fields": self.fields, "bins": self.bins,
+                "ranges": [list(r) for r in self.ranges],
+                "counts": [0] * len(self.counts), "overflow": 0}
+
+    def increments(self, prefix):
+        ret = {}
+        for i in np.flatnonzero(self.counts):
+            ret[prefix + ".counts." + str(i)] = int(self.counts[i])
+        if self.overflow:
+            ret[prefix + ".overflow"] = self.overflow
+        return ret
+
+    def clear(self):
+        self.counts[:] = 0
+        self.overflow = 0
+
+    def pop_increments(self, prefix):
+        ret = self.increments(prefix)
+        self.clear()
+        return ret
+
+
+class QuantileSketch(object):
+    """
+    Log-bucketed sketch (like DDSketch): a positive value x goes to
+    bucket ceil(log(x) / log(gamma)) with gamma = (1+a)/(1-a), so any
+    quantile read back is within relative accuracy a of the true one.
+    Negative values are bucketed by their magnitude, zeros counted.
+    Buckets are keyed by their index as a string in the doc.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+
+    def add(self, values):
+        values = values[np.isfinite(values)]
+        self.zero += int((values == 0).sum())
+        for store, v in [(self.positive, values[values > 0]),
+                         (self.negative, -values[values < 0])]:
+            if len(v) == 0:
+                continue
+            keys, counts = np.unique(
+                np.ceil(np.log(v) / self.log_gamma).astype(np.int64),
+                return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                store[key] = store.get(key, 0) + count
+
+    def empty_doc(self):
+        return {"gamma": self.gamma, "zero": 0, "positive": {},
+                "negative": {}}
+
+    def increments(self, prefix):
+        ret = {}
+        for name, store in [("positive", self.positive),
+                            ("negative", self.negative)]:
+            for key, count in store.items():
+                ret[prefix + "." + name + "." + str(key)] = count
+        if self.zero:
+            ret[prefix + ".zero"] = self.zero
+        return ret
+
+    def clear(self):
+        self.positive.clear()
+        self.negative.clear()
+        self.zero = 0
+
+    def pop_increments(self, prefix):
+        ret = self.increments(prefix)
+        self.clear()
+        return ret
+
+
+def sketch_quantile(doc, q):
+    """
+    Reads quantile q (0 to 1) back from a sketch doc as stored in the
+    status doc. Returns None if the sketch is empty.
+    """
+    gamma = doc["gamma"]
+    buckets = ( [(-gamma**int(k), c) for k, c in doc["negative"].items()] +
+                [(0., doc["zero"])] +
+                [(gamma**int(k), c) for k, c in doc["positive"].items()] )
+    buckets.sort()
+    total = sum(c for v, c in buckets)
+    if total == 0:
+        return None
+    rank = q * (total - 1)
+    seen = 0
+    for value, count in buckets:
+        seen += count
+        if seen > rank:
+            # Middle of the bucket, in relative terms
+            return value * 2 / (1 + gamma)
+    return buckets[-1][0]
+
+
+class RateSeries(object):
+    """
+    Number of events and sum and number of S2 areas per bin_seconds of
+    event time, for rate and mean S2 plots. Stored as one doc of arrays
+    per block_bins bins:
+    {
+       "_id": "rate.<block>",
+       "type": "rate",
+       "block": int,
+       "start": ns since the epoch of the first bin,
+       "bin_seconds": float,
+       "counts": [...], "s2_sum": [...], "s2_n": [...]
+    }
+    Mean S2 is s2_sum/s2_n. Counts are of the events we processed, so
+    of raw runs they're prescaled.
+    """
+
+    def __init__(self, bin_seconds=1., block_bins=600):
+        self.bin_seconds = bin_seconds
+        self.bin_ns = int(round(bin_seconds * 1e9))
+        self.block_bins = block_bins
+        # block: (counts, s2 sum, s2 n) since the last pop
+        self.pending = {}
+
+    def add(self, docs):
+        times = np.array([doc.get("time") for doc in docs], dtype=object)
+        has_time = np.array([t is not None for t in times], dtype=bool)
+        if not has_time.any():
+            return
+        bins = times[has_time].astype(np.int64) // self.bin_ns
+        s2 = np.array([doc.get("s2") for doc in docs],
+                      dtype=np.float64)[has_time]
+        has_s2 = np.isfinite(s2)
+        blocks = bins // self.block_bins
+        offsets = bins % self.block_bins
+        for block in np.unique(blocks).tolist():
+            sel = blocks == block
+            counts = np.bincount(offsets[sel], minlength=self.block_bins)
+            sel &= has_s2
+            s2_sum = np.bincount(offsets[sel], weights=s2[sel],
+                                 minlength=self.block_bins)
+            s2_n = np.bincount(offsets[sel], minlength=self.block_bins)
+            if block in self.pending:
+                old = self.pending[block]
+                counts, s2_sum, s2_n = (old[0] + counts, old[1] + s2_sum,
+                                        old[2] + s2_n)
+            self.pending[block] = (counts, s2_sum, s2_n)
+
+    def empty_doc(self, block):
+        return {"type": "rate", "block": block,
+                "start": block * self.block_bins * self.bin_ns,
+                "bin_seconds": self.bin_seconds,
+                "counts": [0] * self.block_bins,
+                "s2_sum": [0.] * self.block_bins,
+                "s2_n": [0] * self.block_bins}
+
+    def pop_increments(self):
+        """
+        Returns [(block, {path: increment})] of what was added since the
+        last call
+        """
+        ret = []
+        for block, (counts, s2_sum, s2_n) in sorted(self.pending.items()):
+            increments = {}
+            for i in np.flatnonzero(counts).tolist():
+                increments["counts." + str(i)] = int(counts[i])
+            for i in np.flatnonzero(s2_n).tolist():
+                increments["s2_sum." + str(i)] = float(s2_sum[i])
+                increments["s2_n." + str(i)] = int(s2_n[i])
+            ret.append((block, increments))
+        self.pending = {}
+        return ret
+
+
+class RunAggregates(object):
+    """
+    The aggregates of one run in one process. add() takes batches of
+    reduced docs, increments() returns what to $inc in the status doc
+    since the last clear(). pop_increments() does both.
+    """
+
+    def __init__(self, histograms=DEFAULT_HISTOGRAMS,
+                 quantile_fields=DEFAULT_QUANTILE_FIELDS,
+                 relative_accuracy=0.01):
+        self.histograms = dict(
+            (name, Histogram(fields, bins, ranges))
+            for name, (fields, bins, ranges) in histograms.items())
+        self.sketches = dict((field, QuantileSketch(relative_accuracy))
+                             for field in quantile_fields)
+        self.fields = set(self.sketches)
+        for histogram in self.histograms.values():
+            self.fields.update(histogram.fields)
+        self.counters = dict.fromkeys(["events", "with_s1", "with_s2",
+                                       "with_interaction"], 0)
+
+    def add(self, docs):
+        if len(docs) == 0:
+            return
+        columns = dict((field, np.array([doc.get(field) for doc in docs],
+                                        dtype=np.float64))
+                       for field in self.fields)
+        for histogram in self.histograms.values():
+            histogram.add(columns)
+        for field, sketch in self.sketches.items():
+            sketch.add(columns[field])
+        self.counters["events"] += len(docs)
+        for counter, field in [("with_s1", "ns1"), ("with_s2", "ns2"),
+                               ("with_interaction", "interactions")]:
+            self.counters[counter] += sum(1 for doc in docs
+                                          if doc.get(field))
+
+    def empty_doc(self):
+        """
+        The 'aggregates' field of a run that has none yet. Histograms
+        need their count arrays in place before $inc can index them.
+        """
+        return {
+            "counters": dict.fromkeys(self.counters, 0),
+            "histograms": dict((name, h.empty_doc())
+                               for name, h in self.histograms.items()),
+            "quantiles": dict((field, s.empty_doc())
+                              for field, s in self.sketches.items()),
+        }
+
+    def increments(self, prefix="aggregates"):
+        ret = {}
+        for counter, value in self.counters.items():
+            if value:
+                ret[prefix + ".counters." + counter] = value
+        for name, histogram in self.histograms.items():
+            ret.update(histogram.increments(prefix + ".histograms." + name))
+        for field, sketch in self.sketches.items():
+            ret.update(sketch.increments(prefix + ".quantiles." + field))
+        return ret
+
+    def clear(self):
+        for counter in self.counters:
+            self.counters[counter] = 0
+        for histogram in self.histograms.values():
+            histogram.clear()
+        for sketch in self.sketches.values():
+            sketch.clear()
+
+    def pop_increments(self, prefix="aggregates"):
+        ret = self.increments(prefix)
+        self.clear()
+        return ret
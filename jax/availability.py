@@ -0,0 +1,88 @@
+"""
+Index of what's in data_path, so checking whether a run's data is there
+doesn't cost a glob (a directory listing on network storage) per run.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import time
+
+
+class AvailabilityIndex(object):
+    """
+    The names in one directory, from a single os.scandir. A run is
+    available if there's an entry called like it, or like it with an
+    extension (the raw data directory or the processed .root file).
+    The listing is redone when the directory's mtime changes or, since
+    network filesystems don't always show that right away, at least
+    every ttl seconds.
+
+    Counts lookups that found the run (hits) and didn't (misses), and
+    the number and total time of listings.
+    """
+
+    def __init__(self, directory, ttl=30.):
+        self.directory = directory
+        self.ttl = ttl
+        self.names = set()
+        self.mtime = None
+        self.listed = None
+
+        self.hits = 0
+        self.misses = 0
+        self.n_refreshes = 0
+        self.refresh_time = 0.
+
+    def refresh(self, force=False):
+        """
+        Lists the directory again if it changed or the listing is older
+        than ttl. Returns True if it did.
+        """
+        now = time.time()
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            mtime = None
+        if ( not force and self.listed is not None and mtime == self.mtime
+             and now - self.listed < self.ttl ):
+            return False
+
+        names = set()
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    names.add(entry.name)
+                    names.add(entry.name.partition(".")[0])
+        except OSError as e:
+            _logger.warning("Can't list " + self.directory + ": " + str(e))
+        self.names = names
+        self.mtime = mtime
+        self.listed = now
+        self.n_refreshes += 1
+        self.refresh_time += time.time() - now
+        return True
+
+    def available(self, name):
+        self.refresh()
+        return self.lookup(name)
+
+    def lookup(self, name):
+        if name in self.names:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def filter(self, names):
+        """
+        The names that are available, with one refresh check for all
+        """
+        self.refresh()
+        return [name for name in names if self.lookup(name)]
+
+    def summary(self):
+        return ("availability: " + str(self.hits) + " hits, " +
+                str(self.misses) + " misses, " + str(self.n_refreshes) +
+                " listings in %.3f s" % self.refresh_time)
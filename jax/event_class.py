@@ -0,0 +1,115 @@
+"""
+On-disk cache of compiled pax event classes. Every processed ROOT file
+embeds the C++ source of its event class and
+load_pax_event_class_from_root compiles it again in every process that
+opens one. Here the source goes to a directory named after its hash (and
+the ROOT version) and is compiled there once. ACLiC sees the library is
+up to date and only loads it in every later process.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import fcntl
+import hashlib
+import platform
+
+# Written into a class directory once its library is built
+READY = "ready"
+SOURCE = "pax_event_class.cpp"
+
+# Class directories this process has loaded the library of
+_loaded = set()
+
+
+def read_class_code(filename):
+    """
+    The event class source embedded in a pax ROOT file
+    """
+    import ROOT
+    from pax.exceptions import MaybeOldFormatException
+    tfile = ROOT.TFile(filename)
+    try:
+        code = tfile.Get("pax_event_class")
+        if not code:
+            raise MaybeOldFormatException("No pax_event_class in " + filename)
+        return code.GetTitle()
+    finally:
+        tfile.Close()
+
+
+def class_key(code, root_version):
+    """
+    Name of the cache directory for a class. The library only works
+    with the ROOT it was built with, so that's part of the key.
+    """
+    digest = hashlib.sha1(code.encode())
+    digest.update(root_version.encode())
+    digest.update(platform.machine().encode())
+    return digest.hexdigest()[:20]
+
+
+def populate(directory, build):
+    """
+    Runs build(directory) unless a process already did. Concurrent
+    misses wait on a lock file next to the directory and only the first
+    one builds. The directory counts as built once the READY file is
+    there, so a build that died halfway is redone. Returns True if this
+    process did the build.
+    """
+    ready = os.path.join(directory, READY)
+    if os.path.exists(ready):
+        return False
+    os.makedirs(directory, exist_ok=True)
+    with open(directory + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(ready):
+                return False
+            build(directory)
+            with open(ready + ".tmp", "w") as f:
+                f.write(str(os.getpid()))
+            os.rename(ready + ".tmp", ready)
+            return True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def compile_class(source):
+    """
+    Compiles (or, if the library next to source is up to date, just
+    loads) the class the way pax does
+    """
+    import ROOT
+    try:
+        from pax.plugins.io.ROOTClass import load_event_class
+    except ImportError:
+        ROOT.gROOT.ProcessLine(".L " + source + "+")
+    else:
+        load_event_class(source)
+
+
+def load_event_class_from_root(filename, cache_dir):
+    """
+    Drop-in for pax's load_pax_event_class_from_root that compiles each
+    distinct class once per cache_dir instead of once per process
+    """
+    import ROOT
+    code = read_class_code(filename)
+    directory = os.path.join(cache_dir, class_key(code,
+                                                  ROOT.gROOT.GetVersion()))
+    if directory in _loaded:
+        return
+    source = os.path.join(directory, SOURCE)
+
+    def build(directory):
+        with open(source, "w") as f:
+            f.write(code)
+        compile_class(source)
+
+    if populate(directory, build):
+        _logger.info("Compiled pax event class in " + directory)
+    else:
+        compile_class(source)
+    _loaded.add(directory)
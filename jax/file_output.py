@@ -0,0 +1,276 @@
+"""
+Writes reduced events to local columnar files instead of a database.
+Useful for backfilling and benchmarking without mongo and for offline
+analysis of the reduced data.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import json
+import zipfile
+import bson
+import numpy as np
+
+from jax.output import Output
+from jax.reducer import REDUCED_FIELDS
+
+# Never None, and too large for float64 in the case of time
+INTEGER_FIELDS = ["event_number", "time"]
+
+
+def to_columns(docs, fields=REDUCED_FIELDS):
+    """
+    Turns a list of reduced docs into a dict of arrays, one per field in
+    fields. Missing values become NaN.
+    """
+    columns = {}
+    for field in fields:
+        values = [doc.get(field) for doc in docs]
+        if field in INTEGER_FIELDS:
+            columns[field] = np.array(values, dtype=np.int64)
+        else:
+            columns[field] = np.array(
+                [np.nan if v is None else v for v in values],
+                dtype=np.float64)
+    return columns
+
+
+class NpzWriter(object):
+    """
+    Appends each chunk as one .npy per field to a zip archive, so the
+    file can be opened with np.load. Keys are 'field/chunk'.
+    """
+    extension = ".npz"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.n_chunks = 0
+
+    def append(self, columns):
+        with zipfile.ZipFile(self.filename, mode='a') as archive:
+            for field, values in columns.items():
+                name = field + "/" + str(self.n_chunks).zfill(6) + ".npy"
+                with archive.open(name, mode='w') as f:
+                    np.lib.format.write_array(f, values)
+        self.n_chunks += 1
+
+    def close(self):
+        return
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        columns = {}
+        for key in sorted(data.files):
+            field = key.split("/")[0]
+            columns.setdefault(field, []).append(data[key])
+        return {field: np.concatenate(chunks)
+                for field, chunks in columns.items()}
+
+
+class Hdf5Writer(object):
+    """
+    One resizable dataset per field, grown by each chunk. Needs h5py.
+    """
+    extension = ".hdf5"
+
+    def __init__(self, filename):
+        import h5py
+        self.file = h5py.File(filename, 'a')
+
+    def append(self, columns):
+        for field, values in columns.items():
+            if field not in self.file:
+                self.file.create_dataset(field, data=values,
+                                         maxshape=(None,), chunks=True)
+                continue
+            dataset = self.file[field]
+            dataset.resize((len(dataset) + len(values),))
+            dataset[-len(values):] = values
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(filename):
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            return {field: f[field][:] for field in f}
+
+
+class ParquetWriter(object):
+    """
+    One parquet row group per chunk. Needs pyarrow.
+    """
+    extension = ".parquet"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.writer = None
+
+    def append(self, columns):
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array(values) for values in columns.values()],
+            names=list(columns.keys()))
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.filename,
+                                                        table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    @staticmethod
+    def load(filename):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(filename)
+        return {name: table.column(name).to_numpy()
+                for name in table.column_names}
+
+
+WRITERS = {
+    "npz": NpzWriter,
+    "hdf5": Hdf5Writer,
+    "parquet": ParquetWriter,
+}
+
+
+def load_run(filename):
+    """
+    Reads a run file written by FileOutput back into a dict of arrays
+    """
+    for writer in WRITERS.values():
+        if filename.endswith(writer.extension):
+            return writer.load(filename)
+    raise ValueError("Don't know how to read " + filename)
+
+
+class FileOutput(Output):
+    """
+    Saves reduced events in chunks to one columnar file per run in
+    output_path. The status doc lives next to it as <run>.status.json
+    and waveforms go to <run>_waveforms.bson, one BSON doc after another.
+    """
+
+    def __init__(self, config):
+        super(FileOutput, self).__init__(config, "file_output")
+
+        self.output_path = "."
+        if config.has_option("file_output", "output_path"):
+            self.output_path = config.get("file_output", "output_path")
+
+        self.file_format = "npz"
+        if config.has_option("file_output", "file_format"):
+            self.file_format = config.get("file_output", "file_format")
+        if self.file_format not in WRITERS:
+            raise ValueError("Unknown file_format " + self.file_format)
+
+        self.chunk_size = 10000
+        if config.has_option("file_output", "chunk_size"):
+            self.chunk_size = config.getint("file_output", "chunk_size")
+
+        self.buffers = {}
+        self.writers = {}
+
+    def get_filename(self, collection):
+        return os.path.join(self.output_path, collection +
+                            WRITERS[self.file_format].extension)
+
+    def get_status_filename(self, collection):
+        return os.path.join(self.output_path, collection + ".status.json")
+
+    def get_waveform_filename(self, collection):
+        return os.path.join(self.output_path, collection + "_waveforms.bson")
+
+    def read_status(self, collection):
+        if not os.path.exists(self.get_status_filename(collection)):
+            return None
+        with open(self.get_status_filename(collection)) as f:
+            return json.load(f)
+
+    def write_status(self, collection, status_doc):
+        # Write then rename so readers never see half a file
+        filename = self.get_status_filename(collection)
+        with open(filename + ".tmp", "w") as f:
+            json.dump(status_doc, f)
+        os.replace(filename + ".tmp", filename)
+
+    def register_processor(self, collection, mode, prescale):
+        """
+        Same rules as the mongo output, see Output.should_process
+        """
+        if not self.should_process(self.read_status(collection), mode):
+            return False
+
+        if not os.path.exists(self.output_path):
+            os.makedirs(self.output_path)
+        for filename in [self.get_filename(collection),
+                         self.get_waveform_filename(collection)]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        status_doc = {
+            'type': 'status',
+            'instance_id': self.instance_id,
+            'finished': False,
+            'mode': mode,
+            'prescale': 1,
+            'layout': self.file_format,
+        }
+        if mode == "raw":
+            status_doc['prescale'] = prescale
+        self.write_status(collection, status_doc)
+        return True
+
+    def may_take_later(self, collection, mode):
+        return self.may_change(self.read_status(collection), mode)
+
+    def save_reduced_doc(self, insert_doc, collection):
+        self.buffers.setdefault(collection, []).append(insert_doc)
+        if len(self.buffers[collection]) >= self.chunk_size:
+            self.flush(collection)
+
+    def flush(self, collection):
+        """
+        Appends the buffered docs as one chunk. Returns the number of
+        events written.
+        """
+        docs = self.buffers.get(collection, [])
+        if len(docs) == 0:
+            return 0
+        self.buffers[collection] = []
+        if collection not in self.writers:
+            self.writers[collection] = WRITERS[self.file_format](
+                self.get_filename(collection))
+        self.writers[collection].append(
+            to_columns(docs, self.reducer.fields))
+        return len(docs)
+
+    def save_waveform_doc(self, waveform_doc, collection):
+        with open(self.get_waveform_filename(collection), "ab") as f:
+            f.write(bson.BSON.encode(waveform_doc))
+        return True
+
+    def close(self, collection, nevents):
+        """
+        Write the last chunk, close the file and mark the run finished
+        """
+        self.flush(collection)
+        self.buffers.pop(collection, None)
+        if collection in self.writers:
+            self.writers.pop(collection).close()
+
+        status_doc = self.read_status(collection)
+        if status_doc is None:
+            _logger.error("output.close: status file not found")
+            status_doc = {'type': 'status', 'instance_id': self.instance_id}
+        status_doc['finished'] = True
+        status_doc['events'] = nevents
+        self.write_status(collection, status_doc)
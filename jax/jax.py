@@ -8,21 +8,24 @@ For processed data it simply unpacks and loops the ROOT file.
 The initial use is for the online monitor, for which we have a flat
 BSON output. You could very easily repurpose the output class to store 
 the data in any format you want using any technology for which there is 
-a python interface.
+a python interface: subclass jax.output.Output and add it to get_output.
+The output_mode option in [jax] selects the backend ("mongodb" or
+"file" for local columnar files).
 """
 
 import argparse
 import sys
+import json
 import logging
 
 from jax import __version__
 from jax.runs_generator import RunsGenerator
-from jax.output import MonitorOutput
+from jax.output import get_output
 from jax.processor import Processor
+from jax.workers import WorkerPool
+from jax.scheduler import Scheduler, format_state
+from jax.processor import PAUSED
 from configparser import ConfigParser
-from multiprocessing import Process
-
-import time
 
 __author__ = "Daniel Coderre"
 __copyright__ = "Daniel Coderre"
@@ -55,9 +58,14 @@ def parse_args(args):
         '-j', 
         type=int,
         dest="cores",
-        help="Concurrent processing threads",
+        help="Concurrent processing workers",
         default=1
     )
+    parser.add_argument(
+        '--queue',
+        dest="queue",
+        help="show the run queue of the running monitor and exit",
+        action='store_true')
     parser.add_argument(
         '-v',
         '--verbose',
@@ -86,9 +94,12 @@ def main(args):
                            default_section='powdered_cheddar')
     configp.read(args.config)
 
+    if args.queue:
+        return show_queue(configp)
+
     # Initialize runs list generator, output plugin, processor
     runs = RunsGenerator(configp)
-    output = MonitorOutput(configp)
+    output = get_output(configp)
     processor = Processor(configp)
 
     # Loop runs list, insert data
@@ -96,56 +107,115 @@ def main(args):
     if(configp.getboolean("jax", "autoprocess")):
         autorun = configp.getboolean("jax", "autoprocess")
 
-    threads = []
-    while(True):
-        
-        # Start up to n processes
-        for i in range(0, args.cores):
-        
-            # Check if we have a lingering thread open
-            if i < len(threads):
-                continue
-            
-            # For each process, loop through runs
-            for run in runs.get(processor):                
-                
-                if output.register_processor(run, processor.get_mode(),
-                                             processor.get_prescale()):
-                    rundoc = runs.get_run_doc(run)
-                    print("Processing run " + rundoc['name'])
-                    t = (Process(target = thread_process, 
-                                args=(configp, rundoc)))
-                    threads.append(t)
-                    print("Appended new thread. ("+str(len(threads))+")")
-                    t.start()
-                    break
-        
-        # Join threads with 1 second timeout. 
-        # If we're autorunning, return only living threads to list,
-        # allowing new threads to be spawned if one finishes
-        for t in threads:
-            t.join(1)
-        ntb = len(threads)
-        if autorun:
-            threads = [t for t in threads if t.is_alive()]
-        nta = len(threads)
-        if len(threads)==0 and not autorun:
-            break
-        if ntb != nta:
-            print("Killed " + str(ntb-nta) + " threads")
-        time.sleep(5)
-
-    # Loop through threads and join all
-    print("End of program. Joining threads")
-    for t in threads:
-        t.join()
+    # Workers are recycled after worker_max_runs runs or once they use
+    # more than worker_max_rss MB (0 for no limit). New runs are looked
+    # for every poll_interval seconds and whenever a run finishes.
+    max_runs = 0
+    if configp.has_option("jax", "worker_max_runs"):
+        max_runs = configp.getint("jax", "worker_max_runs")
+    max_rss = 0
+    if configp.has_option("jax", "worker_max_rss"):
+        max_rss = configp.getfloat("jax", "worker_max_rss")
+    poll_interval = 5.
+    if configp.has_option("jax", "poll_interval"):
+        poll_interval = configp.getfloat("jax", "poll_interval")
+
+    # Live, recent and backlog runs by priority (see jax.scheduler)
+    scheduler = Scheduler(configp, args.cores)
+    if scheduler.preempt and not output.can_release:
+        _logger.warning("Output can't resume runs, backlog runs won't "
+                        "be paused")
+        scheduler.preempt = False
+
+    pool = WorkerPool(configp, args.cores, max_runs, max_rss)
+    pool.start()
+    try:
+        while(True):
+            started = fill_slots(pool, scheduler, runs, output, processor)
+            scheduler.write_state(pool)
+            if pool.busy() == 0 and started == 0 and not autorun:
+                break
+
+            # Returns as soon as a run finishes
+            for name, result in pool.wait(poll_interval):
+                scheduler.finished(name)
+                if result == PAUSED:
+                    # Back in the queue right away, to be resumed
+                    print("Paused run " + name)
+                    runs.defer(name, 0)
+                else:
+                    print("Finished run " + name + " (" + str(result) + ")")
+            _logger.debug(pool.summary())
+    finally:
+        print("End of program. Stopping workers")
+        pool.stop()
 
     _logger.info("Monitor stopped")
 
-def thread_process(config, rundoc):
-    output = MonitorOutput(config)
-    processor = Processor(config)
-    return processor.process_run(output, rundoc)
+
+def fill_slots(pool, scheduler, runs, output, processor):
+    """
+    Claims runs, highest priority first, and hands them to the pool
+    until every worker has one. If a live run finds no free worker a
+    backlog run is paused to make room. Returns how many it started.
+    """
+    started = 0
+    for run_class, rundoc in scheduler.order(runs.get(processor)):
+        if not scheduler.has_quota(run_class):
+            continue
+        if pool.free_slots() == 0:
+            if run_class == "live":
+                # The first one whose worker is actually on it
+                for victim in scheduler.victims():
+                    if pool.pause(victim):
+                        print("Pausing run " + victim + " for " +
+                              rundoc['name'])
+                        scheduler.paused(victim)
+                        break
+            break
+
+        try:
+            taken = output.register_processor(rundoc['name'],
+                                              processor.get_mode(),
+                                              processor.get_prescale())
+        except Exception as e:
+            # Worth another try next pass
+            _logger.error("Couldn't claim run " + rundoc['name'] + ": " +
+                          str(e))
+            continue
+
+        if taken or output.may_take_later(rundoc['name'],
+                                          processor.get_mode()):
+            # Not a candidate for a while
+            runs.defer(rundoc['name'])
+        else:
+            # Done with, e.g. finished
+            runs.drop(rundoc['name'])
+        if taken:
+            print("Processing " + run_class + " run " + rundoc['name'])
+            pool.submit(rundoc)
+            scheduler.started(rundoc['name'], run_class)
+            started += 1
+    return started
+
+
+def show_queue(config):
+    """
+    Prints the queue state the monitor last wrote to state_file
+    """
+    if not ( config.has_option("scheduler", "state_file") and
+             config.get("scheduler", "state_file") ):
+        print("No state_file in [scheduler]")
+        return 1
+    state_file = config.get("scheduler", "state_file")
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (OSError, ValueError) as e:
+        print("Can't read " + state_file + ": " + str(e))
+        return 1
+    print(format_state(state))
+    return 0
 
 
 def run():
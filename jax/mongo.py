@@ -0,0 +1,60 @@
+"""
+Process-wide registry of mongo clients. Every URI/credential pair gets
+one pymongo.MongoClient (and so one connection pool) per process, no
+matter how many outputs or run generators ask for it.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import atexit
+import threading
+import pymongo
+
+_clients = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def get_client(uri, user=None, password=None):
+    """
+    Returns the shared client for mongodb://[user:password@]uri.
+    Clients are made with connect=False, so nothing is opened until the
+    first operation, and a forked process never reuses its parent's
+    clients: the registry starts over when the pid changes.
+    """
+    global _pid
+    key = (uri, user, password)
+    with _lock:
+        if _pid != os.getpid():
+            # Inherited sockets belong to the parent. Forget, don't close.
+            _clients.clear()
+            _pid = os.getpid()
+        if key not in _clients:
+            upstr = ""
+            if user is not None and password is not None:
+                upstr = user + ":" + password + "@"
+            _clients[key] = pymongo.MongoClient("mongodb://" + upstr + uri,
+                                                connect=False)
+            _logger.debug("New mongo client for " + uri)
+        return _clients[key]
+
+
+def get_database(uri, database, user=None, password=None):
+    return get_client(uri, user, password)[database]
+
+
+def close_clients():
+    """
+    Closes all clients this process made. Registered with atexit, but
+    multiprocessing children skip atexit so workers call it themselves.
+    """
+    with _lock:
+        if _pid == os.getpid():
+            for client in _clients.values():
+                client.close()
+        _clients.clear()
+
+
+atexit.register(close_clients)
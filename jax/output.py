@@ -4,138 +4,817 @@ Allows list input as well if wanted.
 """
 
 
-from configparser import ConfigParser
 import logging
 _logger = logging.getLogger(__name__)
 import pymongo
+import bson
 import os
-import json
+import time
+import datetime
+import zlib
+import numpy as np
 
-import sys
+from jax.mongo import get_database
+from jax.reducer import Reducer, get_field_table
+from jax.aggregates import (RunAggregates, RateSeries, get_histograms,
+                            DEFAULT_QUANTILE_FIELDS)
 
-class MonitorOutput(object):
+
+def compress_waveform(samples):
+    """
+    Zero-suppress a waveform into the frontend format: a list of strings
+    where each non-zero sample appears as str(sample) and each run of n
+    zeros becomes the two entries 'z', str(n). Runs are found with array
+    operations so only non-zero samples are touched in python.
+    """
+    is_zero = np.asarray(samples) == 0
+    n = len(is_zero)
+    if n == 0:
+        return []
+
+    # Non-zero samples in order. Lists keep their own python scalars so
+    # str() gives exactly what the json path used to give
+    if isinstance(samples, list):
+        values = samples
+    else:
+        values = np.asarray(samples)[~is_zero].tolist()
+
+    change = np.flatnonzero(is_zero[1:] != is_zero[:-1]) + 1
+    starts = np.concatenate(([0], change)).tolist()
+    ends = np.concatenate((change, [n])).tolist()
+
+    ret = []
+    offset = 0
+    for start, end, zero in zip(starts, ends, is_zero[starts].tolist()):
+        if zero:
+            ret.append('z')
+            ret.append(str(end - start))
+            offset += end - start
+        elif values is samples:
+            ret.extend(map(str, values[start:end]))
+        else:
+            ret.extend(map(str, values[start-offset:end-offset]))
+    return ret
+
+
+# Bump whenever the layout written by encode_waveform changes
+WAVEFORM_FORMAT_VERSION = 1
+
+
+def encode_waveform(samples, compression_level=6):
+    """
+    Packs a waveform into a zlib-compressed BSON Binary. Samples are
+    stored as little endian int16 if they are all integers that fit,
+    otherwise as float32. The returned dict is what goes into the
+    'samples' field of the waveform doc when waveform_encoding = binary.
+    """
+    samples = np.asarray(samples)
+    packed = samples.astype('<f4')
+    if ( len(samples) > 0 and np.all(packed == np.round(packed)) and
+         packed.min() >= -32768 and packed.max() <= 32767 ):
+        packed = samples.astype('<i2')
+    return {
+        'format_version': WAVEFORM_FORMAT_VERSION,
+        'compression': 'zlib',
+        'dtype': packed.dtype.str,
+        'n_samples': len(packed),
+        'data': bson.Binary(zlib.compress(packed.tobytes(),
+                                          compression_level)),
+    }
+
+
+def decode_waveform(samples):
+    """
+    Inverse of both waveform encodings, for the frontend side and for
+    testing. Takes the 'samples' field of a waveform doc, either the
+    zero suppressed string list or an encode_waveform dict, and returns
+    the samples as a float array.
+    """
+    if isinstance(samples, dict):
+        if samples['format_version'] != WAVEFORM_FORMAT_VERSION:
+            raise ValueError("Unknown waveform format version " +
+                             str(samples['format_version']))
+        ret = np.frombuffer(zlib.decompress(samples['data']),
+                            dtype=samples['dtype'])
+        if len(ret) != samples['n_samples']:
+            raise ValueError("Waveform has " + str(len(ret)) + " samples, "
+                             "expected " + str(samples['n_samples']))
+        return ret.astype(np.float64)
+
+    ret = []
+    i = 0
+    while i < len(samples):
+        if samples[i] == 'z':
+            ret.extend([0.] * int(samples[i+1]))
+            i += 2
+        else:
+            ret.append(float(samples[i]))
+            i += 1
+    return np.array(ret, dtype=np.float64)
+
+
+def to_native(value):
+    """
+    Converts numpy arrays and scalars from the pax event into plain
+    python types BSON can store. NaN becomes None like in pax's to_json.
+    """
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    elif isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+class Output(object):
+    """
+    Base class for output backends. A backend decides per run whether
+    to process it (register_processor), stores reduced docs (save_doc)
+    and waveforms (save_waveform) and marks the run done (close). The
+    event reduction and waveform extraction are shared here, so backends
+    only implement the storage (save_reduced_doc, save_waveform_doc).
+    Options are read from the backend's own config section.
+    """
+
+    # Whether several processes can write reduced docs into the same run
+    concurrent_writers = False
+    # Whether a run given back with release() is taken up again
+    can_release = False
+
+    def __init__(self, config, section):
+
+        self.instance_id = 0
+        if config.has_option(section, "instance_id"):
+            self.instance_id = config.getint(section, "instance_id")
+        self.reprocess = False
+        if config.has_option(section, "reprocess"):
+            self.reprocess = config.getboolean(section, "reprocess")
+        self.finish = False
+        if config.has_option(section, "finish"):
+            self.finish = config.getboolean(section, "finish")
+
+        # Resume our own unfinished runs from their last checkpoint once
+        # nobody has touched them for stale_after seconds
+        self.resume = False
+        if config.has_option(section, "resume"):
+            self.resume = config.getboolean(section, "resume")
+        self.stale_after = 3600.
+        if config.has_option(section, "stale_after"):
+            self.stale_after = config.getfloat(section, "stale_after")
+
+        # Reduced fields, plus whatever the [reduced_fields] section adds
+        self.reducer = Reducer(get_field_table(config))
+
+        # What goes into the waveform docs
+        self.waveform_detectors = ['tpc']
+        self.waveform_names = ['tpc']
+        self.waveform_peak_vars = ['area', 'area_fraction_top',
+                                   'area_per_channel', 'center_time',
+                                   'index_of_maximum', 'left',
+                                   'n_contributing_channels', 'right', 'type']
+        # "strings" (zero suppressed, see compress_waveform) or "binary"
+        self.waveform_encoding = "strings"
+        if config.has_option(section, "waveform_encoding"):
+            self.waveform_encoding = config.get(section,
+                                                "waveform_encoding")
+        if self.waveform_encoding not in ["strings", "binary"]:
+            raise ValueError("Unknown waveform_encoding " +
+                             self.waveform_encoding)
+        self.waveform_compression_level = 6
+        if config.has_option(section, "waveform_compression_level"):
+            self.waveform_compression_level = config.getint(
+                section, "waveform_compression_level")
+        self.debug_waveform_size = False
+        if config.has_option(section, "debug_waveform_size"):
+            self.debug_waveform_size = config.getboolean(
+                section, "debug_waveform_size")
+
+    def register_processor(self, collection, mode, prescale):
+        raise NotImplementedError
+
+    def may_take_later(self, collection, mode):
+        """
+        Whether register_processor could still take a run it just
+        turned down. Backends that can't tell say yes.
+        """
+        return True
+
+    def save_doc(self, event, collection):
+        """
+        Reduces the event and stores the reduced doc
+        """
+        insert_doc = self.MakeReducedDoc(event)
+        if insert_doc is None:
+            return
+        return self.save_reduced_doc(insert_doc, collection)
+
+    def save_waveform(self, event, collection, selection=None):
+        """
+        Extracts the waveform doc from the event and stores it, with
+        the waveform class it was selected for (see jax.selection).
+        Returns False if it couldn't be stored.
+        """
+        waveform_doc = self.ExtractWaveformDoc(event)
+        if selection is not None:
+            waveform_doc['selection'] = selection
+        if self.debug_waveform_size:
+            self.LogWaveformSize(waveform_doc)
+        return self.save_waveform_doc(waveform_doc, collection)
+
+    def save_reduced_doc(self, insert_doc, collection):
+        raise NotImplementedError
+
+    def save_waveform_doc(self, waveform_doc, collection):
+        raise NotImplementedError
+
+    def close(self, collection, nevents):
+        raise NotImplementedError
+
+    def flush(self, collection):
+        """
+        Stores everything buffered for this collection
+        """
+        return 0
+
+    def forget(self, collection):
+        """
+        Drops what the backend keeps about a run this process is done
+        with. Everything it gathered must be written already.
+        """
+        return
+
+    def checkpoint(self, collection, checkpoint):
+        """
+        Records processing progress of a run: a dict with the last
+        completed 'file' (raw only), the next 'event' to process and the
+        number of 'saved' events. Everything saved before the call must
+        be stored when it returns. Backends that can't resume ignore it.
+        """
+        return
+
+    def write_aggregates(self, collection):
+        """
+        Writes what the run's aggregates (see jax.aggregates) gained
+        since the last write. For backends that keep them.
+        """
+        return
+
+    def release(self, collection, checkpoint):
+        """
+        Checkpoints a run we stop before its end (a paused backlog run,
+        see jax.scheduler) and gives it back, so the next
+        register_processor resumes it. Only for backends with
+        can_release.
+        """
+        return self.checkpoint(collection, checkpoint)
+
+    def get_checkpoint(self, collection):
+        """
+        Returns the checkpoint to resume this run from, or None to start
+        from the beginning
+        """
+        return None
+
+    def stale_before(self):
+        return datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.stale_after)
+
+    def should_process(self, stat, mode):
+        """
+        Decides from an existing status doc (None if there is none)
+        whether this instance should (re)process the run.
+        We have two possible rules:
+                1) Do not process runs who have been processed
+                2) Process runs who have been processed but only if they
+                   have a different instance ID as the current run
+        With resume on, our own unfinished runs whose heartbeat is older
+        than stale_after are taken over too (the worker died).
+        """
+        # New collection, no status. Definitely process
+        if stat is None:
+            return True
+
+        # If this is a raw thread and we find a processed file skip
+        if ( mode == "raw" and "mode" in stat and 
+             stat["mode"]=="processed" ):
+            return False
+
+        return (
+                # This is processed data. We only had raw. Eat it up.
+                (mode == "processed" and ( "mode" not in stat or 
+                                           stat["mode"]=="raw")) or
+
+                # Reprocess runs from other instances. 
+             ( self.reprocess and "instance_id" in stat
+               and stat["instance_id"] != self.instance_id) or
+
+                # Finish unfinished runs, but don't reprocess finished runs
+             ( self.finish and "instance_id" in stat
+               and stat['instance_id'] != self.instance_id and
+               ( 'finished' not in stat or stat['finished']==False)) or
+
+                # Resume our own runs whose worker went away
+             ( self.resume and stat.get('instance_id') == self.instance_id
+               and not stat.get('finished', False) and 'heartbeat' in stat
+               and stat['heartbeat'] < self.stale_before()))
+
+    def may_change(self, stat, mode):
+        """
+        Whether should_process could still say yes to a run it said no
+        to, with status doc stat. Only while the run is unfinished and
+        the worker on it may die: ours with resume on, another
+        instance's with finish on.
+        """
+        if stat is None:
+            return True
+        if stat.get('finished', False):
+            return False
+        if mode == "raw" and stat.get('mode') == "processed":
+            return False
+        if stat.get('instance_id') == self.instance_id:
+            return self.resume
+        return self.finish
+
+    def MakeReducedDoc(self, event):
+        """
+        Returns the reduced doc for this event or None if the event
+        can't be read
+        """
+        try:
+            return self.reducer.reduce(event)
+        except Exception as e:
+            _logger.error("Couldn't read event class in either pax native "
+                          "or ROOT form. Failing. " + str(e))
+            return None
+
+    def ExtractWaveformDoc(self, event):
+        """ 
+        Builds the waveform document straight from the pax event object,
+        reading only the TPC sum waveform, a few peak fields, the hits and
+        the metadata. The event is never serialized as a whole (the pulses
+        alone can be huuuuuuuuuge-uh).
+        Waveforms are zero suppressed in a way the frontend will
+        understand (see compress_waveform) or, if waveform_encoding is
+        'binary', packed with encode_waveform.
+        """
+        ret_event = {}
+
+        # First compress the waveform
+        ret_event['sum_waveforms'] = []
+        for waveform in event.sum_waveforms:
+            if ( waveform.detector not in self.waveform_detectors or
+                 waveform.name not in self.waveform_names ):
+                continue
+            ret_waveform = {}
+            for var in ['name', 'detector', 'channel_list']:
+                ret_waveform[var] = to_native(getattr(waveform, var, None))
+            if self.waveform_encoding == "binary":
+                ret_waveform['samples'] = encode_waveform(
+                    waveform.samples, self.waveform_compression_level)
+            else:
+                ret_waveform['samples'] = compress_waveform(waveform.samples)
+            ret_event['sum_waveforms'].append(ret_waveform)
+
+        # Now compress each peak
+        ret_event['peaks'] = []
+        for peak in event.peaks:
+            new_peak = {}
+            for var in self.waveform_peak_vars:
+                new_peak[var] = to_native(getattr(peak, var))
+            ret_event['peaks'].append(new_peak)
+
+        # Now hits
+        ret_event['all_hits'] = to_native(event.all_hits)
+
+        # Metadata
+        for value in ['dataset_name', 'event_number', 'start_time', 'stop_time']:
+            ret_event[value] = to_native(getattr(event, value))
+        return ret_event
+
+    def LogWaveformSize(self, waveform_doc):
+        """
+        Debug instrumentation, only used if debug_waveform_size is set
+        since encoding the doc again costs about as much as inserting it
+        """
+        _logger.debug(
+            "Waveform doc for event " + str(waveform_doc['event_number']) +
+            " is " + str(len(bson.BSON.encode(waveform_doc))) + " bytes. "
+            "Breakdown. Waveforms: " +
+            str(len(bson.BSON.encode({'w': waveform_doc['sum_waveforms']}))) +
+            " Hits: " +
+            str(len(bson.BSON.encode({'h': waveform_doc['all_hits']}))) +
+            " Peaks: " +
+            str(len(bson.BSON.encode({'p': waveform_doc['peaks']}))))
+
+
+class MonitorOutput(Output):
     """
     Connect to output database and save reduced events and waveforms
     """
 
     def __init__(self, config):
+        super(MonitorOutput, self).__init__(config, "mongo_output")
 
-        # Declare monitor DB
-        self.mdb = None
+        # Declare monitor and waveform DBs. The clients come from the
+        # per-process registry in jax.mongo and are only looked up when
+        # used, so an output built before a fork is still safe after it.
+        self._mdb = None
+        self._wdb = None
+        self.monitor_db = None
         if ( config.has_option("mongo_output", "monitor_uri") and
              config.has_option("mongo_output", "monitor_db") ):
-            try:
-                # Get environment variables for mongo
-                user = os.getenv("MONITOR_USER")
-                password = os.getenv("MONITOR_PASSWORD")
-                upstr = ""
-                if user is not None and password is not None:
-                    upstr = user + ":" + password + "@"
-                client = pymongo.MongoClient("mongodb://" + upstr + config.get(
-                    "mongo_output", "monitor_uri"))        
-                database = config.get("mongo_output", "monitor_db")
-                self.mdb = client[database]
-
-            except pymongo.errors.ConnectionFailure as e:
-                _logger.debug("Failed to connect to monitor DB.")
-
-        # Declare waveform db
-        self.wdb = None
+            self.monitor_db = (config.get("mongo_output", "monitor_uri"),
+                               config.get("mongo_output", "monitor_db"))
+        self.waveform_db = None
         if ( config.has_option("mongo_output", "waveform_uri") and
              config.has_option("mongo_output", "waveform_db") ):
-            try:
-                # Get environment variables for mongo
-                user = os.getenv("MONITOR_USER")
-                password = os.getenv("MONITOR_PASSWORD")
-                upstr = ""
-                if user is not None and password is not None:
-                    upstr = user + ":" + password + "@"
-                client = pymongo.MongoClient("mongodb://" + upstr + config.get(
-                    "mongo_output", "waveform_uri"))
-                database = config.get("mongo_output", "waveform_db")
-                self.wdb = client[database]
-
-            except pymongo.errors.ConnectionFailure as e:
-                _logger.debug("Failed to connect to waveform DB.")
-                
-        self.instance_id = 0
-        if config.has_option("mongo_output", "instance_id"):
-            self.instance_id = config.getint("mongo_output", "instance_id")
-        self.reprocess = False
-        if config.has_option("mongo_output", "reprocess"):
-            self.reprocess = config.getboolean("mongo_output", "reprocess")
-        self.finish = False
-        if config.has_option("mongo_output", "finish"):
-            self.finish = config.getboolean("mongo_output", "finish")
+            self.waveform_db = (config.get("mongo_output", "waveform_uri"),
+                                config.get("mongo_output", "waveform_db"))
+
+        # Reduced docs are buffered per collection and written with
+        # insert_many once either limit is hit (or on close)
+        self.insert_batch_size = 1000
+        if config.has_option("mongo_output", "insert_batch_size"):
+            self.insert_batch_size = config.getint("mongo_output",
+                                                   "insert_batch_size")
+        self.insert_flush_interval = 5. # seconds
+        if config.has_option("mongo_output", "insert_flush_interval"):
+            self.insert_flush_interval = config.getfloat(
+                "mongo_output", "insert_flush_interval")
+        self.insert_buffers = {}
+        self.last_flush = {}
+        # Highest event number a resumed run had stored. Docs up to it
+        # may be there already and are upserted, the rest inserted.
+        self.replay_until = {}
+
+        # "events" writes one doc per event. "chunks" writes each flushed
+        # batch of up to chunk_size events as one doc of per-field arrays
+        # and lists the chunks in the status doc.
+        self.doc_layout = "events"
+        if config.has_option("mongo_output", "doc_layout"):
+            self.doc_layout = config.get("mongo_output", "doc_layout")
+        if self.doc_layout not in ["events", "chunks"]:
+            raise ValueError("Unknown doc_layout " + self.doc_layout)
+        self.chunk_size = 10000
+        if config.has_option("mongo_output", "chunk_size"):
+            self.chunk_size = config.getint("mongo_output", "chunk_size")
+        if self.doc_layout == "chunks":
+            self.insert_batch_size = self.chunk_size
+        self.n_chunks = {}
+
+        # Run status docs live in their own collection, keyed by run name
+        self.status_collection = "run_status"
+        if config.has_option("mongo_output", "status_collection"):
+            self.status_collection = config.get("mongo_output",
+                                                "status_collection")
+
+        # Histograms (see the [histograms] section), counters and
+        # quantile sketches of every run, kept while writing and added
+        # to the status doc with every checkpoint and at close
+        self.aggregate = True
+        if config.has_option("mongo_output", "aggregates"):
+            self.aggregate = config.getboolean("mongo_output", "aggregates")
+        self.histograms = get_histograms(config)
+        self.quantile_fields = DEFAULT_QUANTILE_FIELDS
+        if config.has_option("mongo_output", "quantile_fields"):
+            self.quantile_fields = [
+                f.strip() for f in
+                config.get("mongo_output", "quantile_fields").split(",")
+                if f.strip()]
+        self.quantile_accuracy = 0.01
+        if config.has_option("mongo_output", "quantile_accuracy"):
+            self.quantile_accuracy = config.getfloat("mongo_output",
+                                                     "quantile_accuracy")
+        self.aggregates = {}
+
+        # Event rate and mean S2 per rate_bin_seconds of event time, as
+        # "rate" docs of rate_block_bins bins in the run collection.
+        # Updated with every flush, so they follow a live run.
+        self.rate_series = True
+        if config.has_option("mongo_output", "rate_series"):
+            self.rate_series = config.getboolean("mongo_output",
+                                                 "rate_series")
+        self.rate_bin_seconds = 1.
+        if config.has_option("mongo_output", "rate_bin_seconds"):
+            self.rate_bin_seconds = config.getfloat("mongo_output",
+                                                    "rate_bin_seconds")
+        self.rate_block_bins = 600
+        if config.has_option("mongo_output", "rate_block_bins"):
+            self.rate_block_bins = config.getint("mongo_output",
+                                                 "rate_block_bins")
+        self.rates = {}
+
+    def get_db(self, uri_db):
+        if uri_db is None:
+            return None
+        # Get environment variables for mongo
+        return get_database(uri_db[0], uri_db[1],
+                            os.getenv("MONITOR_USER"),
+                            os.getenv("MONITOR_PASSWORD"))
+
+    @property
+    def mdb(self):
+        if self._mdb is not None:
+            return self._mdb
+        return self.get_db(self.monitor_db)
+
+    @mdb.setter
+    def mdb(self, value):
+        self._mdb = value
+
+    @property
+    def wdb(self):
+        if self._wdb is not None:
+            return self._wdb
+        return self.get_db(self.waveform_db)
+
+    @wdb.setter
+    def wdb(self, value):
+        self._wdb = value
+
+    @property
+    def concurrent_writers(self):
+        # Chunk numbers are counted per process
+        return self.doc_layout == "events"
+
+    @property
+    def can_release(self):
+        return self.resume
+
+    def status(self):
+        """
+        The status collection, one doc per run with the run name as _id
+        """
+        return self.mdb[self.status_collection]
+
+    def get_aggregates(self, collection):
+        if collection not in self.aggregates:
+            self.aggregates[collection] = RunAggregates(
+                self.histograms, self.quantile_fields,
+                self.quantile_accuracy)
+        return self.aggregates[collection]
+
+    def add_increments(self, collection, update):
+        """
+        Adds the aggregates gained since the last write to a status doc
+        update, as $inc. They're kept until increments_written, so an
+        update that fails carries them over to the next one.
+        """
+        if not self.aggregate or collection not in self.aggregates:
+            return update
+        increments = self.aggregates[collection].increments()
+        if len(increments) > 0:
+            update['$inc'] = increments
+        return update
+
+    def increments_written(self, collection, result):
+        """
+        Drops the increments add_increments handed out if the update
+        result says the status doc got them. Returns whether it did.
+        """
+        if result.matched_count == 0:
+            return False
+        if collection in self.aggregates:
+            self.aggregates[collection].clear()
+        return True
+
+    def claim_query(self, collection, mode):
+        """
+        The rules of should_process as a query on the run's status doc.
+        It matches an existing status doc only if we may take the run over.
+        """
+        query = {'_id': collection}
+
+        # If this is a raw thread and we find a processed file skip
+        if mode == "raw":
+            query['mode'] = {'$ne': 'processed'}
+
+        rules = []
+        # This is processed data. We only had raw. Eat it up.
+        if mode == "processed":
+            rules.append({'mode': {'$in': [None, 'raw']}})
+        # Reprocess runs from other instances. 
+        if self.reprocess:
+            rules.append({'instance_id': {'$exists': True,
+                                          '$ne': self.instance_id}})
+        # Finish unfinished runs, but don't reprocess finished runs
+        if self.finish:
+            rules.append({'instance_id': {'$exists': True,
+                                          '$ne': self.instance_id},
+                          'finished': {'$ne': True}})
+        # Resume our own runs whose worker went away
+        if self.resume:
+            rules.append({'instance_id': self.instance_id,
+                          'finished': {'$ne': True},
+                          'heartbeat': {'$lt': self.stale_before()}})
+        # No rule allows a takeover: only a missing status doc will do
+        if len(rules) == 0:
+            rules.append({'_id': {'$exists': False}})
+        query['$or'] = rules
+        return query
 
     def register_processor(self, collection, mode, prescale):
         """
-        Looks for a status document. The status document looks like:
+        Claims the run in the status collection. The status document
+        looks like:
         {
+           "_id": run name,
            "type": "status",
            "instance_id": int,
+           "finished": bool,
+           "mode": "raw" or "processed",
+           ...
         }
-        We have two possible rules:
-                1) Do not process runs who have been processed
-                2) Process runs who have been processed but only if they
-                   have a different instance ID as the current run
+        The claim is a single find_one_and_update with upsert, so it costs
+        one indexed lookup however many runs there are, and two workers
+        can't both get the same run: if no status doc exists one of the
+        upserts wins and the other fails on the duplicate _id.
+        Returns whether we got the run. Raises if the DB couldn't tell.
         """
         
         if self.mdb == None:
             print("No mongo")
             return False
             
-        no_collection = True
-        if collection in self.mdb.collection_names():
-            no_collection = False
-        
-            try:
-                stat = self.mdb[collection].find({"type": "status"})
-            except:
-                print("Can't connect to output DB")
-                return False
+        status_doc = {
+            'type': 'status',
+            'instance_id': self.instance_id,
+            'finished': False,
+            'mode': mode,
+            'prescale': 1,
+            'layout': self.doc_layout,
+        }
+        if mode == "raw":
+            status_doc['prescale'] = prescale
 
-        # If this is a raw thread and we find a processed file skip
-        if ( not no_collection and stat.count() > 0 and mode == "raw" and 
-             "mode" in stat[0] and stat[0]["mode"]=="processed" ):
+        status_doc['heartbeat'] = datetime.datetime.utcnow()
+        try:
+            previous = self.status().find_one_and_update(
+                self.claim_query(collection, mode),
+                {'$set': status_doc,
+                 '$unset': {'events': ''}},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.BEFORE)
+        except pymongo.errors.DuplicateKeyError:
             return False
 
-        # Register it.
-        if ( 
-                # New collection, no status. Definitely process
-                no_collection or stat.count() == 0 or 
-                
-                # This is processed data. We only had raw. Eat it up.
-                (mode == "processed" and ( "mode" not in stat[0] or 
-                                           ("mode" in stat[0] and 
-                                            stat[0]["mode"]=="raw"))) or
+        # Whatever we counted for this run before is in the status doc
+        # already or is thrown away with the run, like the rest of what
+        # we kept about it if we failed to close it
+        self.forget(collection)
 
-                
-                # Reprocess runs from other instances. 
-             ( self.reprocess and "instance_id" in stat[0]
-               and stat[0]["instance_id"] != self.instance_id) or
+        # Pick up where the last worker left off if it processed the
+        # same way we would
+        if ( self.resume and previous is not None and
+             previous.get('checkpoint') is not None and
+             not previous.get('finished', False) and
+             previous.get('mode') == mode and
+             previous.get('prescale') == status_doc['prescale'] and
+             previous.get('layout') == self.doc_layout ):
+            n_chunks = previous['checkpoint'].get('n_chunks', 0)
+            _logger.info("Resuming " + collection + " from " +
+                         str(previous['checkpoint']))
+            if self.doc_layout == "chunks":
+                # Chunks after the checkpoint will be written again
+                self.mdb[collection].delete_many(
+                    {'type': 'chunk', 'chunk': {'$gte': n_chunks}})
+                self.status().update_one(
+                    {'_id': collection},
+                    {'$pull': {'chunks': {'chunk': {'$gte': n_chunks}}}})
+            else:
+                self.index_events(collection)
+            return True
+
+        # "Finish" doesn't actually mean finish. It means start again.
+        update = {'$unset': {'checkpoint': '', 'chunks': ''}}
+        if self.aggregate:
+            update['$set'] = {
+                'aggregates': self.get_aggregates(collection).empty_doc()}
+        self.status().update_one({'_id': collection}, update)
+        self.mdb[collection].drop()
+        if self.doc_layout == "events":
+            self.index_events(collection)
+        return True
+
+    def may_take_later(self, collection, mode):
+        """
+        Looks at the status doc of a run we just failed to claim, see
+        Output.may_change
+        """
+        try:
+            stat = self.status().find_one({'_id': collection})
+        except Exception as e:
+            _logger.error("Couldn't read status of " + collection + ": " +
+                          str(e))
+            return True
+        return self.may_change(stat, mode)
+
+    def index_events(self, collection):
+        """
+        One doc per event number, however often an event is written.
+        Only for the event docs: the rate docs in the same collection
+        have no event number, which a unique index takes as one null.
+        """
+        try:
+            self.mdb[collection].create_index(
+                'event_number', unique=True,
+                partialFilterExpression={'type': 'data'})
+        except Exception as e:
+            _logger.error("Couldn't make unique event_number index on " +
+                          collection + ": " + str(e))
+
+    def checkpoint(self, collection, checkpoint):
+        """
+        Flushes the buffer and stores the checkpoint, a heartbeat and
+        the new aggregates in the status doc, in one update so a resumed
+        run counts every event once
+        """
+        if self.mdb == None:
+            return
+        self.flush(collection)
+        checkpoint = dict(checkpoint)
+        checkpoint['n_chunks'] = self.n_chunks.get(collection, 0)
+        try:
+            result = self.status().update_one(
+                {'_id': collection},
+                self.add_increments(collection, {
+                    '$set': {'checkpoint': checkpoint,
+                             'heartbeat': datetime.datetime.utcnow()}}))
+        except Exception as e:
+            _logger.error("Failed to save checkpoint for " + collection +
+                          ": " + str(e))
+            return
+        if not self.increments_written(collection, result):
+            _logger.error("Failed to save checkpoint for " + collection +
+                          ": status doc not found")
+
+    def write_aggregates(self, collection):
+        """
+        Flushes the buffer and adds the new aggregates to the status
+        doc. For processes that write into a run without checkpointing
+        it, like file pool workers.
+        """
+        if self.mdb == None or not self.aggregate:
+            return
+        self.flush(collection)
+        update = self.add_increments(collection, {})
+        if len(update) == 0:
+            return
+        try:
+            result = self.status().update_one({'_id': collection}, update)
+        except Exception as e:
+            _logger.error("Failed to save aggregates for " + collection +
+                          ": " + str(e))
+            return
+        if not self.increments_written(collection, result):
+            _logger.error("Failed to save aggregates for " + collection +
+                          ": status doc not found")
+
+    def release(self, collection, checkpoint):
+        """
+        Checkpoints the run and backdates its heartbeat, so it counts as
+        abandoned and is resumed by whoever claims it next
+        """
+        if self.mdb == None:
+            return
+        self.checkpoint(collection, checkpoint)
+        try:
+            self.status().update_one(
+                {'_id': collection},
+                {'$set': {'heartbeat': datetime.datetime(1970, 1, 1)}})
+        except Exception as e:
+            _logger.error("Failed to release " + collection + ": " + str(e))
+        self.forget(collection)
+
+    def get_checkpoint(self, collection):
+        if self.mdb == None or not self.resume:
+            return None
+        try:
+            stat = self.status().find_one({'_id': collection},
+                                          {'checkpoint': 1})
+        except Exception as e:
+            _logger.error("Failed to read checkpoint for " + collection +
+                          ": " + str(e))
+            return None
+        if stat is None or stat.get('checkpoint') is None:
+            return None
+        self.n_chunks[collection] = stat['checkpoint'].get('n_chunks', 0)
+        if self.doc_layout == "events":
+            # Events after the checkpoint may have been stored before
+            # the last worker went away
+            try:
+                last = self.mdb[collection].find_one(
+                    {'type': 'data'}, {'event_number': 1},
+                    sort=[('event_number', -1)])
+            except Exception as e:
+                _logger.error("Failed to find last event of " + collection +
+                              ": " + str(e))
+                last = None
+            if last is not None:
+                self.replay_until[collection] = last['event_number']
+        return stat['checkpoint']
 
-                # Finish unfinished runs, but don't reprocess finished runs
-             ( self.finish and "instance_id" in stat[0] 
-               and stat[0]['instance_id'] != self.instance_id and
-               ( 'finished' not in stat[0] or stat[0]['finished']==False))):
-
-            # "Finish" doesn't actually mean finish. It means start again.
-            self.mdb[collection].drop()
-            status_doc = {
-                'type': 'status',
-                'instance_id': self.instance_id,
-                'finished': False,
-                'mode': mode,
-                'prescale': 1
-            }
-            if mode == "raw":
-                status_doc['prescale'] = prescale
-
-            self.mdb[collection].insert_one(status_doc)
-            return True            
-        return False
-        
     def close(self, collection, nevents):
         """
         Close the run. Tell DB you're done and how many events were processed
@@ -144,249 +823,222 @@ class MonitorOutput(object):
             _logger.error("output.close: no mongo")
             return False
 
-        if collection not in self.mdb.collection_names():
-            _logger.error("output.close: collection not found")
-            
+        self.flush(collection)
+
         try:
-            self.mdb[collection].update_one(
-                {'type': 'status'},
-                {'$set': {'finished': True,
-                          'events': nevents}
-             })
+            result = self.status().update_one(
+                {'_id': collection},
+                self.add_increments(collection, {
+                    '$set': {'finished': True,
+                             'events': nevents}}))
         except:
             _logger.error("output.close: error updating status doc")
             return 
+        if not self.increments_written(collection, result):
+            _logger.error("output.close: status doc not found")
+            return
+        # Only once the run is closed. If it isn't, whoever claims it
+        # next starts over from the checkpoint (register_processor
+        # drops what we kept).
+        self.forget(collection)
         return
 
+    def forget(self, collection):
+        """
+        Drops what we kept about a closed run, a worker goes on to others
+        """
+        for state in [self.insert_buffers, self.last_flush, self.n_chunks,
+                      self.aggregates, self.rates, self.replay_until]:
+            state.pop(collection, None)
 
-    def save_doc(self, event, collection):
+    def save_reduced_doc(self, insert_doc, collection):
         
         if self.mdb == None:
             _logger.error("No monitor db")
             return
 
-        # Put it into mongo. Simple stuff for now                                  
-        insert_doc = {
-            "type": "data",
-            "event_number": None,
-            "cs1": None,
-            "cs2": None,
-            "s1": None,
-            "s2": None,
-            "s1_range_50p_area": None,
-            "s2_range_50p_area": None,
-            "s1_area_fraction_top": None,
-            "s2_area_fraction_top": None,
-            "s1_n_hits": None,
-            "s2_n_hits": None,
-            "s1_hit_time_mean": None,
-            "s2_hit_time_mean": None,
-            "event_time": None,
-            "z": None,            
-            "largest_other_s1": None,
-            "largest_other_s2": None,
-            "largest_other_s1_time": None,
-            "largest_other_s2_time": None,
-            "s1_n_contributing_channels": None,
-            "s2_n_contributing_channels": None,
-            "s1_n_saturated_channels": None,
-            "s2_n_saturated_channels": None, 
-            "event_length": None,
-            "largest_other_s1_hit_time_mean": None,
-            "largest_other_s2_hit_time_mean": None,
-            "ns1": None,
-            "ns2": None,
-            "dt": None,
-            "x": None,
-            "y": None,
-            "interactions": None,
-        }
+        if collection not in self.insert_buffers:
+            self.insert_buffers[collection] = []
+            self.last_flush[collection] = time.time()
+        self.insert_buffers[collection].append(insert_doc)
 
-        # This is a bit nasty. Here's the thing. The pax event class 
-        # is different if using ROOT output or if using the python
-        # native version. 
+        if ( len(self.insert_buffers[collection]) >= self.insert_batch_size or
+             time.time() - self.last_flush[collection] >=
+             self.insert_flush_interval ):
+            self.flush(collection)
+        return
+
+    def flush(self, collection):
+        """
+        Write all buffered docs for this collection in one unordered
+        insert_many. Events a resumed run processes again (up to
+        replay_until) are upserted by event number instead, so they
+        replace their earlier copies. Returns the number of docs
+        actually written.
+        """
+        self.last_flush[collection] = time.time()
+        docs = self.insert_buffers.get(collection, [])
+        if len(docs) == 0:
+            return 0
+        self.insert_buffers[collection] = []
+        if self.aggregate:
+            self.get_aggregates(collection).add(docs)
+        if self.rate_series:
+            self.write_rates(collection, docs)
+
+        if self.doc_layout == "chunks":
+            return self.write_chunk(docs, collection)
+
+        replayed = []
+        replay_until = self.replay_until.get(collection)
+        if replay_until is not None:
+            replayed = [d for d in docs if d['event_number'] <= replay_until]
+            docs = [d for d in docs if d['event_number'] > replay_until]
+            if len(docs) > 0:
+                # Past what was there before
+                del self.replay_until[collection]
+        n_written = 0
+        if len(replayed) > 0:
+            n_written += self.write_docs(collection, replayed, upsert=True)
+        if len(docs) > 0:
+            n_written += self.write_docs(collection, docs)
+        return n_written
+
+    def write_docs(self, collection, docs, upsert=False):
+        """
+        Inserts docs, or upserts them by event number. An event that is
+        there already (duplicate key) counts as written.
+        """
         try:
-            self.FillDocPaxOutput(insert_doc, event)
+            if upsert:
+                self.mdb[collection].bulk_write(
+                    [pymongo.ReplaceOne({'type': 'data',
+                                         'event_number': d['event_number']},
+                                        d, upsert=True) for d in docs],
+                    ordered=False)
+            else:
+                self.mdb[collection].insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            errors = [error for error in e.details.get('writeErrors', [])
+                      if error.get('code') != 11000]
+            n_inserted = len(docs) - len(errors)
+            if len(errors) > 0:
+                _logger.error("Failed to insert " + str(len(errors)) +
+                              " of " + str(len(docs)) + " documents into " +
+                              collection + ". First error: " +
+                              str(errors[0].get('errmsg')))
+            return n_inserted
         except Exception as e:
-            _logger.error("Couldn't read event class in either pax native "
-                          "or ROOT form. Failing. " + str(e))
-            return                
+            _logger.error("Failed to insert batch of " + str(len(docs)) +
+                          " documents into " + collection + "! " + str(e))
+            return 0
+        return len(docs)
+
+    def write_rates(self, collection, docs):
+        """
+        Adds docs to the run's rate docs (see jax.aggregates.RateSeries).
+        A new block is upserted with zeros first, then everything is
+        $inc'd, so several writers add up. Events processed again after a
+        resume are counted again in here.
+        """
+        if collection not in self.rates:
+            self.rates[collection] = RateSeries(self.rate_bin_seconds,
+                                                self.rate_block_bins)
+        rates = self.rates[collection]
+        rates.add(docs)
+        requests = []
+        for block, increments in rates.pop_increments():
+            key = {'_id': 'rate.' + str(block)}
+            requests.append(pymongo.UpdateOne(
+                key, {'$setOnInsert': rates.empty_doc(block)}, upsert=True))
+            requests.append(pymongo.UpdateOne(key, {'$inc': increments}))
+        if len(requests) == 0:
+            return
         try:
-            self.mdb[collection].insert_one(insert_doc)
+            self.mdb[collection].bulk_write(requests, ordered=True)
         except Exception as e:
-            _logger.error("Failed to insert document! " +str(e))
-        return
+            _logger.error("Failed to update rate docs of " + collection +
+                          ": " + str(e))
 
-    def FillDocPaxOutput(self, insert_doc, event):
+    def write_chunk(self, docs, collection):
+        """
+        Writes reduced docs as one columnar chunk doc:
+        {
+           "type": "chunk",
+           "chunk": int,
+           "n_events": int,
+           "fields": {"cs1": [...], "cs2": [...], ...}
+        }
+        and appends it to the 'chunks' list of the status doc. Fields
+        missing from some events are None in those positions.
+        """
+        fields = {}
+        for doc in docs:
+            for key in doc:
+                if key != "type" and key not in fields:
+                    fields[key] = None
+        for key in fields:
+            fields[key] = [doc.get(key) for doc in docs]
 
-        # Nasty things to maintain ROOT and python-native compatibility
-        # Don't ask, just DO.
+        chunk = self.n_chunks.get(collection, 0)
+        chunk_doc = {
+            "type": "chunk",
+            "chunk": chunk,
+            "n_events": len(docs),
+            "fields": fields,
+        }
         try:
-            s1s = event.s1s()
-            s2s = event.s2s()
-            peaks = event.peaks
-            interactions = event.interactions
-        except Exception as e:            
-            s1s = event.s1s
-            s2s = event.s2s
-            peaks = event.peaks
-            interactions = event.interactions
-
-        insert_doc['ns1'] = len(s1s)
-        insert_doc['ns2'] = len(s2s)
-        insert_doc['time'] = event.start_time
-        insert_doc['event_number'] = event.event_number
-        insert_doc['event_length'] = event.stop_time - event.start_time
-        insert_doc['interactions'] = len(interactions)
-        if len(interactions) > 0:
-            interaction = interactions[0]
-            s1 = peaks[interaction.s1]
-            s2 = peaks[interaction.s2]
-            
-            insert_doc['s1'] = s1.area
-            insert_doc['s2'] = s2.area
-            insert_doc['cs1'] = insert_doc['s1']*interaction.s1_area_correction
-            insert_doc['cs2'] = insert_doc['s2']*interaction.s2_area_correction
-            insert_doc['x'] = interaction.x
-            insert_doc['y'] = interaction.y
-            insert_doc['z'] = interaction.z
-            insert_doc['dt'] = interaction.drift_time
-            insert_doc['s1_range_50p_area'] = s1.range_area_decile[5]
-            insert_doc['s2_range_50p_area'] = s2.range_area_decile[5]
-            insert_doc['s1_hit_time_mean'] = s1.hit_time_mean
-            insert_doc['s2_hit_time_mean'] = s2.hit_time_mean
-            insert_doc['s1_area_fraction_top'] = s1.area_fraction_top
-            insert_doc['s2_area_fraction_top'] = s2.area_fraction_top
-            insert_doc['s1_n_hits'] = s1.n_hits
-            insert_doc['s2_n_hits'] = s2.n_hits
-            insert_doc['s2_n_contributing_channels'] = s1.n_contributing_channels
-            insert_doc['s2_n_contributing_channels'] = s2.n_contributing_channels
-            insert_doc['s1_n_saturated_channels'] = s1.n_saturated_channels
-            insert_doc['s2_n_saturated_channels'] = s2.n_saturated_channels
-            
-        # Now we want the largest other s1 and largest other s1
-        los1 = None
-        alos1 = 0
-        for s1 in s1s:
-            try:
-                if peaks[s1].area > alos1:
-                    alos1 = peaks[s1].area
-                    los1 = peaks[s1]
-            except:
-                if s1.area > alos1:
-                    alos1 = s1.area
-                    los1 = s1
-        los2 = None
-        alos2 = 0
-        for s2 in s2s:
-            try:
-                if peaks[s2].area > alos2:
-                    alos2 = peaks[s2].area
-                    los2 = peaks[s2]
-            except:
-                if s2.area > alos2:
-                    alos2 = s2.area
-                    los2 = s2
-
-        if los1 is not None:
-            insert_doc['largest_other_s1'] = los1.area
-            insert_doc['largest_other_s1_range_50p_area'] = los1.range_area_decile[5]
-            insert_doc['largest_other_s1_hit_time_mean'] = los1.hit_time_mean
-            insert_doc['largest_other_s1_n_contributing_channels'] = los1.n_contributing_channels
-        if los2 is not None:
-            insert_doc['largest_other_s2'] = los2.area
-            insert_doc['largest_other_s2_range_50p_area'] = los2.range_area_decile[5]
-            insert_doc['largest_other_s2_hit_time_mean'] = los2.hit_time_mean
-            insert_doc['largest_other_s2_n_contributing_channels'] = los2.n_contributing_channels
-
-
-    def save_waveform(self, event, collection):
+            self.mdb[collection].insert_one(chunk_doc)
+            self.status().update_one(
+                {'_id': collection},
+                {'$push': {'chunks': {
+                    'chunk': chunk,
+                    'n_events': len(docs),
+                    'first_event': fields['event_number'][0],
+                    'last_event': fields['event_number'][-1]}}})
+        except Exception as e:
+            _logger.error("Failed to insert chunk " + str(chunk) + " of " +
+                          str(len(docs)) + " documents into " + collection +
+                          "! " + str(e))
+            return 0
+        self.n_chunks[collection] = chunk + 1
+        return len(docs)
+
+    def save_waveform_doc(self, waveform_doc, collection):
         
         if self.wdb == None:
             return False
 
-        # Compress the event to make larger events fit in BSON
-        smaller = self.CompressEvent(json.loads(event.to_json()))
         try:
-            self.wdb[collection].insert_one(smaller)
+            self.wdb[collection].insert_one(waveform_doc)
         except Exception as e:
             print("Error inserting waveform. Maybe it's too large. ")
             return False
         return True
-    
-    def CompressEvent(self, event):
-
-        """ 
-        Compresses an event by suppressing zeros in 
-        waveform in a way the frontend will understand 
-        Format is the char 'zn' where 'z' is a char and 
-        'n' is the number of following zero bins                                                                                 
-        Also removes fields
-        """
-        
-        print("Size before compression = " + str(sys.getsizeof(json.dumps(event))))
-
-        # First compress the waveform
-        ret_event = {}
-        detectors = ['tpc']
-        names = ['tpc']
-        for x in range(0, len(event['sum_waveforms'])):
-            if event['sum_waveforms'][x]['detector'] == 'tpc':
-                print("Name is " + event['sum_waveforms'][x]['name'])
-                print("Waveform for TPC is " + str(len(event['sum_waveforms'][x]['samples'])))
-            if ( event['sum_waveforms'][x]['detector'] not in detectors or
-                 event['sum_waveforms'][x]['name'] not in names ):
-                continue
-            waveform = event['sum_waveforms'][x]['samples']
-            zeros = 0
-            ret = []
-
-            for i in range(0, len(waveform)):
-                if waveform[i] == 0:
-                    zeros += 1
-                    continue
-                else:
-                    if zeros != 0:
-                        ret.append('z')
-                        ret.append(str(zeros))
-                        zeros = 0
-                    ret.append(str(waveform[i]))
-        if zeros != 0:
-            ret.append('z')
-            ret.append(str(zeros))
-        event['sum_waveforms'][x]['samples'] = ret
-
-        # Unfortunately we also have to remove the pulses 
-        # or some events are huuuuuuuuuge-uh
-        del event['pulses']
-        print("Size after compression = " + str(sys.getsizeof(json.dumps(event))))
 
-        ret_event['sum_waveforms'] = []
-        for waveform in event['sum_waveforms']:
-            if ( waveform['detector'] not in detectors or
-                 waveform['name'] not in names ):
-                continue
-            ret_event['sum_waveforms'].append(waveform)
 
+def get_output(config):
+    """
+    Builds the output backend selected by output_mode in [jax]:
+    "mongodb" (default) or "file". With async_output the backend is
+    run behind a queue in a writer thread, see jax.writer.
+    """
+    output_mode = "mongodb"
+    if config.has_option("jax", "output_mode"):
+        output_mode = config.get("jax", "output_mode")
+    if output_mode == "mongodb":
+        output = MonitorOutput(config)
+    elif output_mode == "file":
+        from jax.file_output import FileOutput
+        output = FileOutput(config)
+    else:
+        raise ValueError("Unknown output_mode " + output_mode)
 
-        # Now compress each peak
-        ret_event['peaks'] = []
-        peak_vars = ['area', 'area_fraction_top', 'area_per_channel',
-                     'center_time', 'index_of_maximum', 'left', 
-                     'n_contributing_channels', 'right', 'type']
-        for peak in event['peaks']:
-            new_peak = {}
-            for var in peak_vars:
-                new_peak[var] = peak[var]
-            ret_event['peaks'].append(new_peak)
-        
-        # Now hits
-        ret_event['all_hits'] = event['all_hits']
-
-        # Metadata
-        for value in ['dataset_name', 'event_number', 'start_time', 'stop_time']:
-            ret_event[value] = event[value]
-        print("Size of ret event " + str(sys.getsizeof(json.dumps(ret_event))))
-        print("Breakdown. Waveforms: "+str(sys.getsizeof(json.dumps(ret_event['sum_waveforms']))) + " Hits: " + str(sys.getsizeof(json.dumps(ret_event['all_hits']))) + " Peaks: " + str(sys.getsizeof(json.dumps(ret_event['peaks']))))
-        return ret_event
-    
+    if ( config.has_option("jax", "async_output") and
+         config.getboolean("jax", "async_output") ):
+        from jax.writer import AsyncOutput
+        queue_size = 1000
+        if config.has_option("jax", "output_queue_size"):
+            queue_size = config.getint("jax", "output_queue_size")
+        output = AsyncOutput(output, queue_size)
+    return output
@@ -0,0 +1,126 @@
+"""
+Long-lived pax processing context. Building a pax core.Processor loads
+the config, every plugin and the runs DB connection, which easily costs
+more than processing a small, heavily prescaled file. A worker keeps one
+for the files of a run and points it at new files and event ranges
+instead.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import time
+
+
+class PaxContext(object):
+    """
+    Wraps one pax core.Processor. get_events(input_name, to_process)
+    yields the requested raw events. The processor is built for every
+    new input_name, since pax reads the run's settings from the runs DB
+    when it's built, and otherwise (unless reuse is off, the old
+    behaviour) just has its input plugin re-pointed and rescanned, which
+    also picks up files written since the last call.
+
+    Setup timing is kept in build_time/n_builds (full builds) and
+    setup_time/n_setups (everything done before the first event of a
+    file, builds included), see timing_summary.
+    """
+
+    def __init__(self, reuse=True):
+        self.reuse = reuse
+        self.pax = None
+        self.input_name = None
+
+        self.n_builds = 0
+        self.build_time = 0.
+        self.n_setups = 0
+        self.setup_time = 0.
+
+    def make_config(self, input_name, to_process):
+        return {
+            "pax":
+            {
+                'output': 'Dummy.DummyOutput',
+                'pre_output': [],
+                'encoder_plugin':     None,
+                'logging_level': 'ERROR',
+                'events_to_process': to_process,
+                'input_name': input_name
+            },
+            "MongoDB":
+            {
+                "user": os.getenv("MONGO_USER"),
+                "password": os.getenv("MONGO_PASSWORD"),
+                "host": "gw",
+                "port": 27017,
+                "database": "run"
+            },
+        }
+
+    def build(self, input_name, to_process):
+        # Imported here, processed input doesn't need pax
+        from pax import core
+        start = time.time()
+        self.shutdown()
+        self.pax = core.Processor(config_names="XENON1T",
+                                  config_dict=self.make_config(input_name,
+                                                               to_process))
+        self.input_name = input_name
+        self.n_builds += 1
+        self.build_time += time.time() - start
+
+    def point_at(self, input_name, to_process):
+        """
+        Re-points the existing processor's input plugin at more of the
+        run it was built for. Returns False if the plugin doesn't
+        cooperate, in which case we have to rebuild.
+        """
+        try:
+            plugin = self.pax.input_plugin
+            self.pax.config['pax']['events_to_process'] = to_process
+            plugin.config['input_name'] = input_name
+            # Rescans the run directory for files
+            plugin.startup()
+        except Exception as e:
+            _logger.warning("Couldn't re-point pax input, rebuilding: " +
+                            str(e))
+            return False
+        self.input_name = input_name
+        return True
+
+    def get_events(self, input_name, to_process):
+        """
+        Yields the events numbered in to_process from the raw data in
+        input_name, unprocessed
+        """
+        start = time.time()
+        to_process = list(to_process)
+        if ( self.pax is None or not self.reuse or
+             input_name != self.input_name or
+             not self.point_at(input_name, to_process) ):
+            self.build(input_name, to_process)
+        self.n_setups += 1
+        self.setup_time += time.time() - start
+
+        for event_number in to_process:
+            yield self.pax.input_plugin.get_single_event(event_number)
+
+    def process_event(self, event):
+        return self.pax.process_event(event)
+
+    def shutdown(self):
+        if self.pax is not None and hasattr(self.pax, 'shutdown'):
+            try:
+                self.pax.shutdown()
+            except Exception as e:
+                _logger.debug("pax shutdown failed: " + str(e))
+        self.pax = None
+
+    def timing_summary(self):
+        if self.n_setups == 0:
+            return "pax: no files processed"
+        return ("pax setup: " + str(self.n_setups) + " files, " +
+                "%.3f s/file" % (self.setup_time / self.n_setups) +
+                " (" + str(self.n_builds) + " builds, " +
+                "%.3f s total)" % self.build_time)
@@ -3,13 +3,67 @@ Processes data or just reads ROOT files into data class.
 """
 
 
-from configparser import ConfigParser
 import logging
 _logger = logging.getLogger(__name__)
 import os
-import glob
-from pax import core
-from jax.output import MonitorOutput
+import tempfile
+from jax.pax_context import PaxContext
+from jax.watcher import RunWatcher
+from jax.availability import AvailabilityIndex
+from jax.output import get_output
+from jax.reducer import Reducer, get_field_table
+from jax.selection import WaveformSelector
+import collections
+import multiprocessing
+
+# What a paused run returns instead of the number of saved events
+PAUSED = -2
+
+
+class Paused(Exception):
+    """
+    Raised out of process_run once a run asked to pause (see
+    Processor.pause) is checkpointed and given back to the output
+    """
+    pass
+
+# Processor and output of a worker in a run's file pool
+_file_worker = None
+
+
+def init_file_worker(config):
+    global _file_worker
+    _file_worker = (Processor(config), get_output(config))
+
+
+def process_file_task(run_name, to_process, saved_offset):
+    """
+    Runs in the file pool. The docs and their aggregates are written
+    before returning so the file can be checkpointed as soon as the
+    result is in. The pool outlives the run, so the output forgets it.
+    """
+    processor, output = _file_worker
+    saved = processor.process_file(output, run_name, to_process,
+                                   saved_offset)
+    output.flush(run_name)
+    output.write_aggregates(run_name)
+    output.forget(run_name)
+    return saved
+
+
+# Processor and reducer of a worker in a processed file's entry pool
+_entry_worker = None
+
+
+def init_entry_worker(config):
+    global _entry_worker
+    # The worker only makes docs, the parent writes them
+    _entry_worker = (Processor(config), Reducer(get_field_table(config)))
+
+
+def read_entries_task(filename, start, stop):
+    processor, reducer = _entry_worker
+    return processor.read_entries(reducer, filename, start, stop)
 
 
 class Processor(object):
@@ -20,6 +74,8 @@ class Processor(object):
 
     def __init__(self, config):
 
+        self.config = config
+
         # Understands "raw" and "processed"
         self.input_type = "raw"
         if config.has_option("jax", "input_type"):
@@ -29,6 +85,14 @@ class Processor(object):
         if config.has_option("jax", "data_path"):
             self.search_path = config.get("jax", "data_path")
 
+        # What's in data_path, listed at most every availability_ttl
+        # seconds unless it changes (see jax.availability)
+        availability_ttl = 30.
+        if config.has_option("jax", "availability_ttl"):
+            availability_ttl = config.getfloat("jax", "availability_ttl")
+        self.availability = AvailabilityIndex(self.search_path,
+                                              availability_ttl)
+
         self.raw_prescale = 10
         if config.has_option("jax", "raw_prescale"):
             self.raw_prescale = config.getint("jax", "raw_prescale")
@@ -37,10 +101,126 @@ class Processor(object):
         if config.has_option("jax", "waveform_prescale"):
             self.waveform_prescale = config.getint("jax", "waveform_prescale")
 
+        # Waveforms of interesting events, see jax.selection. Kept per
+        # run, so the rate limits start over with every run.
+        self.selector = None
+        self.selector_run = None
+
+        # Set by a run worker (multiprocessing.Event) to pause the run
+        # at its next checkpoint, see jax.scheduler
+        self.pause = None
+
         self.file_timeout_counter = 10000 # Queries
         if config.has_option("jax", "file_timeout_counter"):
             self.file_timeout_counter = config.getint("jax", "file_timeout_counter")
 
+        # A query waits up to file_wait seconds for the next raw file.
+        # Without inotify the run directory is listed every
+        # file_poll_interval seconds while waiting.
+        self.file_wait = 5.
+        if config.has_option("jax", "file_wait"):
+            self.file_wait = config.getfloat("jax", "file_wait")
+        self.file_poll_interval = 1.
+        if config.has_option("jax", "file_poll_interval"):
+            self.file_poll_interval = config.getfloat("jax",
+                                                      "file_poll_interval")
+
+        # Processed input is checkpointed every checkpoint_interval events,
+        # raw input after every file. While waiting for the next raw file
+        # the checkpoint is repeated every heartbeat_counter queries to
+        # show we're still alive.
+        self.checkpoint_interval = 10000
+        if config.has_option("jax", "checkpoint_interval"):
+            self.checkpoint_interval = config.getint("jax",
+                                                     "checkpoint_interval")
+        self.heartbeat_counter = 60
+        if config.has_option("jax", "heartbeat_counter"):
+            self.heartbeat_counter = config.getint("jax", "heartbeat_counter")
+
+        # Keep one pax processor for the files of a run (see
+        # jax.pax_context).
+        # Switch off to compare setup times with a fresh one per file.
+        self.reuse_pax = True
+        if config.has_option("jax", "reuse_pax"):
+            self.reuse_pax = config.getboolean("jax", "reuse_pax")
+        self.pax_context = None
+
+        # Read processed input branch-wise in bulk (needs uproot),
+        # falling back to reading it event by event
+        self.fast_root = True
+        if config.has_option("jax", "fast_root"):
+            self.fast_root = config.getboolean("jax", "fast_root")
+        self.field_table = get_field_table(config)
+
+        # Number of processes working on the raw files of one run. The
+        # pool is started by the first run that needs it and kept.
+        self.file_workers = 1
+        if config.has_option("jax", "file_workers"):
+            self.file_workers = config.getint("jax", "file_workers")
+        self.file_pool = None
+
+        # Number of processes reading entry ranges of one processed file
+        self.entry_workers = 1
+        if config.has_option("jax", "entry_workers"):
+            self.entry_workers = config.getint("jax", "entry_workers")
+        self.root_file = None
+
+        # Compiled pax event classes of processed files are kept here
+        # for all workers (see jax.event_class). Empty to compile in
+        # every process like pax does.
+        self.event_class_cache = os.path.join(tempfile.gettempdir(),
+                                              "jax_event_class")
+        if config.has_option("jax", "event_class_cache"):
+            self.event_class_cache = config.get("jax", "event_class_cache")
+
+    def get_pax(self):
+        """
+        The worker's pax context, built on first use so the processor
+        in the main process, which only checks availability, never
+        builds one
+        """
+        if self.pax_context is None:
+            self.pax_context = PaxContext(self.reuse_pax)
+        return self.pax_context
+
+    def get_file_pool(self):
+        """
+        The pool for the raw files of a run. Its workers set up their
+        output and pax processor once for all runs of this worker,
+        though pax is still built again for every run.
+        """
+        if self.file_pool is None:
+            self.file_pool = multiprocessing.Pool(
+                self.file_workers, init_file_worker, (self.config,))
+        return self.file_pool
+
+    def stop_file_pool(self):
+        if self.file_pool is not None:
+            self.file_pool.terminate()
+            self.file_pool.join()
+            self.file_pool = None
+
+    def shutdown(self):
+        """
+        Lets go of pax, the file pool and the open ROOT file
+        """
+        if self.pax_context is not None:
+            self.pax_context.shutdown()
+        self.stop_file_pool()
+        if self.root_file is not None:
+            self.root_file[1].Close()
+            self.root_file = None
+
+    def pause_requested(self):
+        return self.pause is not None and self.pause.is_set()
+
+    def get_selector(self, run_name):
+        if self.selector is None or self.selector_run != run_name:
+            self.selector = WaveformSelector(self.config,
+                                             self.waveform_prescale)
+            self.selector_run = run_name
+        return self.selector
+
     def get_mode(self):
         return self.input_type
     def get_prescale(self):
@@ -50,12 +230,17 @@ class Processor(object):
         """
         We want to know if the raw/processed data for this run is
         even there. Otherwise no need to start. This should be easy.
+        The run directory or the .root file will do.
         """
-        search_path = os.path.join(self.search_path, run_doc['name'])
-        search_path += '*' #because of .root
-        if not glob.glob(search_path):
-            return False
-        return True
+        return self.availability.available(run_doc['name'])
+
+    def filter_available(self, run_docs):
+        """
+        The run docs whose data is there, checked in one go
+        """
+        available = set(self.availability.filter(
+            [doc['name'] for doc in run_docs]))
+        return [doc for doc in run_docs if doc['name'] in available]
 
     def process_run(self, output, run_doc):
         """
@@ -64,6 +249,7 @@ class Processor(object):
         the run gets offloaded to another funciton.
 
         Return is number of events processed. If error return -1.
+        Raises Paused if the run was paused.
         """
         if self.input_type == "processed":
             return self.process_processed(output, run_doc)
@@ -73,87 +259,171 @@ class Processor(object):
         saved_events = 0
 
         # First we have to find the file. If we can't find the file we quit
-        path_base = ( self.search_path + run_name + "/" + "XENON1T-"+
-                      str(run_number)+"-")
-
-        if not glob.glob(path_base+"*"):
+        watcher = RunWatcher(os.path.join(self.search_path, run_name),
+                             "XENON1T-" + str(run_number) + "-",
+                             self.file_poll_interval)
+        if not watcher.any_files:
+            watcher.close()
             return -1
 
         counter = 0
         current_event = 0
-        while not self.check_finished(run_doc, counter, current_event):
-
-            counter += 1
-            
-            # Check if the current file even exists
-            if not glob.glob(path_base+str(current_event).zfill(9)+"*"):
-                time.sleep(5)
-                continue
-
-            current_file = os.path.basename(
-                glob.glob(path_base+str(current_event).zfill(9)+"*")[0])
-            
-            # Check if the current file is a temp file
-            if 'temp' in current_file:
-                time.sleep(5)
-                continue
-
-            counter = 0
-            
-            # Get the list of events to process
-            filenamelist = current_file.split("-")            
-            last_event = int(filenamelist[3])
-            print("Thread processing " + current_file + " with events " + 
-                  str(current_event) + " to " + str(last_event))
-            to_process = range(current_event, last_event, self.raw_prescale)
-            
-            # Do the processing using pax
-            pax_config = {
-                "pax":
-                {                
-                    'output': 'Dummy.DummyOutput',
-                    'pre_output': [],
-                    'encoder_plugin':     None,
-                    'logging_level': 'ERROR',
-                    'events_to_process': to_process,
-                    'input_name': os.path.join(self.search_path,
-                                               run_name)
-                },
-            "MongoDB":
-                {
-                    "user": os.getenv("MONGO_USER"),
-                    "password": os.getenv("MONGO_PASSWORD"),
-                    "host": "gw",
-                    "port": 27017,
-                    "database": "run"
-                },
-            }
-            thispax = core.Processor(config_names="XENON1T", 
-                                     config_dict=pax_config)
-            
-            # Loop through processed events
-            saveNext = False
-            for event in thispax.get_events():
-                processed = thispax.process_event(event)
-                output.save_doc(processed, run_name)
-                
-                if ( saveNext or self.waveform_prescale > 0 and 
-                     saved_events % self.waveform_prescale == 0 ):
-                    if not output.save_waveform(processed, run_name):
-                        saveNext = True
-                    else:
-                        saveNext = False
-            
-                saved_events+=1
-            
-            # Set current event for start of next file
-            current_event = last_event + 1
-        
+
+        # Resume after the last completed file if a previous worker died
+        checkpoint = output.get_checkpoint(run_name)
+        if checkpoint is not None:
+            current_event = checkpoint['event']
+            saved_events = checkpoint['saved']
+            print("Resuming after " + str(checkpoint['file']) +
+                  " at event " + str(current_event))
+        else:
+            checkpoint = {'file': None, 'event': 0, 'saved': 0}
+
+        # With file_workers > 1 the files go to a pool and are
+        # checkpointed in order as they complete. Needs a backend that
+        # takes writes from several processes into one run.
+        pool = None
+        if self.file_workers > 1:
+            if output.concurrent_writers:
+                pool = self.get_file_pool()
+            else:
+                _logger.warning("Output can't take concurrent writers. "
+                                "Processing files one by one.")
+        # (file, next event, saved events, result) in submission order
+        pending = collections.deque()
+        queued_events = saved_events
+
+        paused = False
+        try:
+            while not self.check_finished(watcher, counter, current_event):
+
+                if self.pause_requested():
+                    paused = True
+                    break
+
+                counter += 1
+                if counter % self.heartbeat_counter == 0:
+                    output.checkpoint(run_name, checkpoint)
+                checkpoint = self.collect_files(output, run_name, pending,
+                                                checkpoint)
+
+                # Wait for the current file. Returns as soon as it's there
+                # (and not a temp file anymore).
+                current_file = watcher.wait_for(current_event, self.file_wait)
+                if current_file is None:
+                    continue
+
+                counter = 0
+
+                # Get the list of events to process
+                filenamelist = current_file.split("-")            
+                last_event = int(filenamelist[3])
+                print("Thread processing " + current_file + " with events " + 
+                      str(current_event) + " to " + str(last_event))
+                to_process = range(current_event, last_event,
+                                   self.raw_prescale)
+
+                if pool is None:
+                    result = self.process_file(output, run_name, to_process,
+                                               queued_events)
+                else:
+                    result = pool.apply_async(
+                        process_file_task,
+                        (run_name, to_process, queued_events))
+                queued_events += len(to_process)
+
+                # Set current event for start of next file
+                current_event = last_event + 1
+                pending.append((current_file, current_event, result))
+
+                # Don't run too far ahead of the checkpoint
+                checkpoint = self.collect_files(
+                    output, run_name, pending, checkpoint,
+                    max_pending=2*self.file_workers-1)
+
+            checkpoint = self.collect_files(output, run_name, pending,
+                                            checkpoint, max_pending=0)
+        except BaseException:
+            # Don't leave files of this run behind in the pool
+            if len(pending) > 0:
+                self.stop_file_pool()
+            raise
+        finally:
+            watcher.close()
+
+        if paused:
+            output.release(run_name, checkpoint)
+            raise Paused(run_name)
+
+        saved_events = checkpoint['saved']
         output.close(run_name, saved_events)
-        print("Processed " + saved_events + " events")
+        print("Processed " + str(saved_events) + " events")
+        if pool is None:
+            print(self.get_pax().timing_summary())
+            print(self.get_selector(run_name).summary())
+        return saved_events
+
+    def collect_files(self, output, run_name, pending, checkpoint,
+                      max_pending=None):
+        """
+        Checkpoints finished files in the order they were queued. Waits
+        for files until at most max_pending are left, or only takes
+        files that are already done if max_pending is None. Returns the
+        latest checkpoint.
+        """
+        while len(pending) > 0:
+            current_file, next_event, result = pending[0]
+            if isinstance(result, int):
+                saved = result
+            elif max_pending is None or len(pending) <= max_pending:
+                if not result.ready():
+                    break
+                saved = result.get()
+            else:
+                # Raises here if the worker did
+                saved = result.get()
+            pending.popleft()
+            checkpoint = {'file': current_file, 'event': next_event,
+                          'saved': checkpoint['saved'] + saved}
+            output.checkpoint(run_name, checkpoint)
+        return checkpoint
+
+    def process_file(self, output, run_name, to_process, saved_offset):
+        """
+        Processes the events in to_process with pax and saves them.
+        saved_offset is the number of events of the run queued before
+        these, for the waveform prescale. Whether the waveform is saved
+        too is decided on the reduced doc (see jax.selection), so only
+        the selected events pay for extracting it. Returns the number of
+        events saved.
+        """
+        saved_events = 0
+        saveNext = None
+        pax = self.get_pax()
+        selector = self.get_selector(run_name)
+        for event in pax.get_events(os.path.join(self.search_path,
+                                                 run_name), to_process):
+            processed = pax.process_event(event)
+            insert_doc = output.MakeReducedDoc(processed)
+            selection = None
+            if insert_doc is not None:
+                output.save_reduced_doc(insert_doc, run_name)
+                selection = selector.select(insert_doc,
+                                            saved_offset + saved_events)
+
+            # If the last one didn't fit, take this one instead
+            if selection is None:
+                selection = saveNext
+            if selection is not None:
+                if not output.save_waveform(processed, run_name, selection):
+                    saveNext = selection
+                else:
+                    saveNext = None
+
+            saved_events+=1
         return saved_events
         
-    def check_finished(self, run_doc, counter, current_event):
+    def check_finished(self, watcher, counter, current_event):
         """
         How do we know if we're done with this run?
           (a) if it is not done processing then we aren't done!
@@ -161,6 +431,7 @@ class Processor(object):
               then we ARE done
           (c) if we hit a predefined timeout waiting for processing, then
               we ARE done
+        The watcher (see jax.watcher) knows about the files and the log.
         """
         
         # Predefined timeout
@@ -169,20 +440,16 @@ class Processor(object):
             return True
 
         # Is the run even finished?
-        run_name = run_doc['name']
-        path_log = ( self.search_path + run_name + "/" + "eventbuilder.log" )
-        if not glob.glob(path_log):
+        if not watcher.finished:
             return False
 
-        # It is finished, did we do the last event? Note the run doc might
-        # be outdated if the run wasn't finished when we started processing
-        run_number = run_doc['number']
-        path_base = ( self.search_path + run_name + "/" + "XENON1T-"+
-                      str(run_number)+"-")
-
+        # It is finished, did we do the last event? The log can show up
+        # just before the last file, so look once more.
+        if current_event not in watcher.files:
+            watcher.scan()
         # If the run is finished but current_file does not exist, we're done
-        if not glob.glob(path_base+str(current_event).zfill(9)+"*"):
-            print("NOFILE" + current_file)
+        if current_event not in watcher.files:
+            print("NOFILE " + str(current_event))
             return True
         return False
 
@@ -199,14 +466,43 @@ class Processor(object):
                       "Actually you should not have gotten this far.")
             return -1
 
+        # Start after the last checkpoint if there is one
+        saved=0
+        first = 0
+        checkpoint = output.get_checkpoint(run_doc['name'])
+        if checkpoint is not None:
+            first = checkpoint['event']
+            saved = checkpoint['saved']
+
+        if self.entry_workers > 1:
+            try:
+                saved = self.process_processed_parallel(
+                    output, run_doc['name'], filename, first, saved)
+            except Paused:
+                raise
+            except Exception as e:
+                _logger.error("Couldn't read " + filename + " in parallel: " +
+                              str(e))
+                return -1
+            output.close(run_doc['name'], saved)
+            return saved
+
+        # Bulk read of just the branches we need. Whatever it can't do
+        # is left to the per-event loop below.
+        if self.fast_root:
+            first, saved = self.process_processed_fast(output, run_doc,
+                                                       filename, first, saved)
+            if first is None:
+                output.close(run_doc['name'], saved)
+                return saved
+
         # If you have trouble with this part of the code please contact
         # somebody who thought using ROOT was a good idea.
         import ROOT
-        from pax.plugins.io.ROOTClass import load_pax_event_class_from_root
         from pax.exceptions import MaybeOldFormatException
 
         try:
-            load_pax_event_class_from_root(filename)
+            self.load_event_class(filename)
         except MaybeOldFormatException:
             _logger.error("There was a problem loading the ROOT class from your file."
                           "I guess just give up. Or use a new ROOT file with the "
@@ -221,8 +517,7 @@ class Processor(object):
         n_events = tree.GetEntries()
 
         # Loop it
-        saved=0
-        for i in range(0, n_events):
+        for i in range(first, n_events):
             tree.GetEntry(i)
             event = tree.events
             try:
@@ -231,8 +526,152 @@ class Processor(object):
                 _logger.error("Couldn't save processed event to output. Quitting.")
                 return -1
             saved +=1
+            if saved % self.checkpoint_interval == 0:
+                self.checkpoint(output, run_doc['name'],
+                                {'event': i+1, 'saved': saved})
         output.close(run_doc['name'], saved)
         return saved
 
-    
-    
+    def checkpoint(self, output, run_name, checkpoint):
+        """
+        Checkpoints a processed run, or gives it back and raises Paused
+        if it was asked to pause
+        """
+        if self.pause_requested():
+            output.release(run_name, checkpoint)
+            raise Paused(run_name)
+        output.checkpoint(run_name, checkpoint)
+
+    def process_processed_fast(self, output, run_doc, filename, first, saved):
+        """
+        Reads the reduced fields of entries first and up in blocks with
+        jax.root_reader. Returns (None, saved) when the whole file is
+        done, or (next entry, saved) if the per-event path has to take
+        over, e.g. because uproot isn't there or the file has branches
+        we don't know.
+        """
+        try:
+            from jax.root_reader import iterate_reduced
+            blocks = iterate_reduced(filename, first, self.checkpoint_interval,
+                                     table=self.field_table)
+            for stop, docs in blocks:
+                for doc in docs:
+                    output.save_reduced_doc(doc, run_doc['name'])
+                saved += len(docs)
+                first = stop
+                self.checkpoint(output, run_doc['name'],
+                                {'event': first, 'saved': saved})
+        except Paused:
+            raise
+        except Exception as e:
+            _logger.warning("Bulk read of " + filename + " stopped at entry " +
+                            str(first) + ", reading event by event: " +
+                            str(e))
+            return first, saved
+        return None, saved
+
+    def process_processed_parallel(self, output, run_name, filename, first,
+                                   saved):
+        """
+        Splits the entries first and up into ranges of checkpoint_interval
+        entries that a pool of entry_workers processes reads with
+        read_entries. The docs come back to this process and go to the
+        one output in entry order, so any backend works and checkpoints
+        and the final count are the same as reading it here. Returns
+        the number of events saved.
+        """
+        n_entries = self.count_entries(filename)
+        step = max(self.checkpoint_interval, 1)
+        ranges = collections.deque(
+            (start, min(start + step, n_entries))
+            for start in range(first, n_entries, step))
+        print("Reading " + str(len(ranges)) + " ranges of " + filename +
+              " with " + str(self.entry_workers) + " workers")
+
+        pool = multiprocessing.Pool(self.entry_workers, init_entry_worker,
+                                    (self.config,))
+        # (stop, result) in entry order. Only a few ranges are read ahead
+        # so the docs waiting here stay bounded.
+        pending = collections.deque()
+        try:
+            while len(ranges) > 0 or len(pending) > 0:
+                while len(ranges) > 0 and len(pending) < 2*self.entry_workers:
+                    start, stop = ranges.popleft()
+                    pending.append((stop, pool.apply_async(
+                        read_entries_task, (filename, start, stop))))
+                stop, result = pending.popleft()
+                docs = result.get()
+                for doc in docs:
+                    output.save_reduced_doc(doc, run_name)
+                saved += len(docs)
+                self.checkpoint(output, run_name,
+                                {'event': stop, 'saved': saved})
+        finally:
+            pool.terminate()
+            pool.join()
+        return saved
+
+    def count_entries(self, filename):
+        if self.fast_root:
+            try:
+                from jax.root_reader import count_entries
+                return count_entries(filename)
+            except Exception as e:
+                _logger.debug("uproot couldn't count entries: " + str(e))
+        return self.open_root(filename).GetEntries()
+
+    def open_root(self, filename):
+        """
+        The event tree of filename, with the pax event class loaded.
+        Kept open, a worker reads many ranges of the same file.
+        """
+        if self.root_file is not None and self.root_file[0] == filename:
+            return self.root_file[2]
+        import ROOT
+        self.load_event_class(filename)
+        tfile = ROOT.TFile(filename)
+        self.root_file = (filename, tfile, tfile.Get("tree"))
+        return self.root_file[2]
+
+    def load_event_class(self, filename):
+        """
+        Loads the pax event class embedded in filename, from the
+        event_class_cache if we have one
+        """
+        if self.event_class_cache:
+            from jax.event_class import load_event_class_from_root
+            load_event_class_from_root(filename, self.event_class_cache)
+        else:
+            from pax.plugins.io.ROOTClass import \
+                load_pax_event_class_from_root
+            load_pax_event_class_from_root(filename)
+
+    def read_entries(self, reducer, filename, start, stop):
+        """
+        Reduced docs of entries start to stop of a processed file, in
+        bulk with jax.root_reader if we can and with ROOT otherwise.
+        reducer is a jax.reducer.Reducer. Events it can't read are
+        skipped.
+        """
+        if self.fast_root:
+            try:
+                from jax.root_reader import iterate_reduced
+                docs = []
+                for _, block in iterate_reduced(filename, start, stop - start,
+                                                stop, self.field_table):
+                    docs.extend(block)
+                return docs
+            except Exception as e:
+                _logger.warning("Bulk read of " + filename + " entries " +
+                                str(start) + " to " + str(stop) +
+                                " failed, reading event by event: " + str(e))
+        tree = self.open_root(filename)
+        docs = []
+        for i in range(start, stop):
+            tree.GetEntry(i)
+            try:
+                docs.append(reducer.reduce(tree.events))
+            except Exception as e:
+                _logger.error("Couldn't reduce entry " + str(i) + " of " +
+                              filename + ": " + str(e))
+        return docs
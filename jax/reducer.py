@@ -0,0 +1,196 @@
+"""
+Builds the reduced doc of a pax event from a table of fields. Each entry
+says which object of the event a field comes from and which attribute
+(and array element) of it, so adding a field is a config change, see
+the [reduced_fields] section.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import re
+from operator import attrgetter
+
+# Everything the reducer can fill. Fields of peaks an event doesn't
+# have stay None.
+REDUCED_FIELDS = [
+    "event_number", "time", "cs1", "cs2", "s1", "s2",
+    "s1_range_50p_area", "s2_range_50p_area",
+    "s1_area_fraction_top", "s2_area_fraction_top",
+    "s1_n_hits", "s2_n_hits", "s1_hit_time_mean", "s2_hit_time_mean",
+    "event_time", "z",
+    "largest_other_s1", "largest_other_s2",
+    "largest_other_s1_time", "largest_other_s2_time",
+    "s1_n_contributing_channels", "s2_n_contributing_channels",
+    "s1_n_saturated_channels", "s2_n_saturated_channels",
+    "event_length",
+    "largest_other_s1_hit_time_mean", "largest_other_s2_hit_time_mean",
+    "largest_other_s1_range_50p_area", "largest_other_s2_range_50p_area",
+    "largest_other_s1_n_contributing_channels",
+    "largest_other_s2_n_contributing_channels",
+    "ns1", "ns2", "dt", "x", "y", "interactions",
+]
+
+# Objects a field can come from: the event, its first interaction, the
+# main S1 and S2 (those of the first interaction) and the largest S1
+# and S2 of the event
+SOURCES = ["event", "interaction", "s1", "s2", "largest_s1", "largest_s2"]
+
+# (field, source, attribute, array index or None). ns1, ns2,
+# interactions, event_length, cs1 and cs2 aren't plain attributes and
+# are filled by the reducer itself.
+FIELD_TABLE = [
+    ("event_number", "event", "event_number", None),
+    ("time", "event", "start_time", None),
+    ("x", "interaction", "x", None),
+    ("y", "interaction", "y", None),
+    ("z", "interaction", "z", None),
+    ("dt", "interaction", "drift_time", None),
+]
+for _peak in ["s1", "s2"]:
+    FIELD_TABLE += [
+        (_peak, _peak, "area", None),
+        (_peak + "_range_50p_area", _peak, "range_area_decile", 5),
+        (_peak + "_hit_time_mean", _peak, "hit_time_mean", None),
+        (_peak + "_area_fraction_top", _peak, "area_fraction_top", None),
+        (_peak + "_n_hits", _peak, "n_hits", None),
+        (_peak + "_n_contributing_channels", _peak,
+         "n_contributing_channels", None),
+        (_peak + "_n_saturated_channels", _peak, "n_saturated_channels",
+         None),
+    ]
+for _peak in ["s1", "s2"]:
+    FIELD_TABLE += [
+        ("largest_other_" + _peak, "largest_" + _peak, "area", None),
+        ("largest_other_" + _peak + "_range_50p_area", "largest_" + _peak,
+         "range_area_decile", 5),
+        ("largest_other_" + _peak + "_hit_time_mean", "largest_" + _peak,
+         "hit_time_mean", None),
+        ("largest_other_" + _peak + "_n_contributing_channels",
+         "largest_" + _peak, "n_contributing_channels", None),
+    ]
+
+FIELD_SPEC = re.compile(r"^(\w+)\.(\w+)(?:\[(\d+)\])?$")
+
+
+def parse_field(field, spec):
+    """
+    Turns a [reduced_fields] entry like
+        s2_width = s2.range_area_decile[9]
+    into a FIELD_TABLE row
+    """
+    match = FIELD_SPEC.match(spec.strip())
+    if match is None or match.group(1) not in SOURCES:
+        raise ValueError("Can't make a reduced field of " + field + " = " +
+                         spec + ", expected source.attribute[index] with "
+                         "source one of " + ", ".join(SOURCES))
+    index = match.group(3)
+    if index is not None:
+        index = int(index)
+    return (field, match.group(1), match.group(2), index)
+
+
+def get_field_table(config):
+    """
+    FIELD_TABLE plus the fields in the [reduced_fields] section
+    """
+    table = list(FIELD_TABLE)
+    if config is not None and config.has_section("reduced_fields"):
+        known = set(REDUCED_FIELDS)
+        for field, spec in config.items("reduced_fields"):
+            if field in known:
+                raise ValueError("Reduced field " + field + " exists already")
+            table.append(parse_field(field, spec))
+    return table
+
+
+def table_fields(table):
+    """
+    REDUCED_FIELDS plus the fields only table has, in order
+    """
+    fields = list(REDUCED_FIELDS)
+    for field, source, attribute, index in table:
+        if field not in fields:
+            fields.append(field)
+    return fields
+
+
+def compile_getter(attribute, index):
+    getter = attrgetter(attribute)
+    if index is None:
+        return getter
+    return lambda obj: getter(obj)[index]
+
+
+class Reducer(object):
+    """
+    Fills reduced docs from pax events. The table is turned into a list
+    of getters per source once. The event flavour (ROOT, where s1s and
+    s2s are peak indices, or python native, where they are methods
+    returning peaks) is found from the first event and kept.
+    """
+
+    def __init__(self, table=FIELD_TABLE):
+        self.table = table
+        self.fields = table_fields(table)
+        self.template = {"type": "data"}
+        self.template.update(dict.fromkeys(self.fields))
+
+        self.getters = dict((source, []) for source in SOURCES)
+        for field, source, attribute, index in table:
+            self.getters[source].append((field,
+                                         compile_getter(attribute, index)))
+        self.native = None
+
+    def fill(self, doc, source, obj):
+        for field, getter in self.getters[source]:
+            doc[field] = getter(obj)
+
+    def reduce(self, event):
+        """
+        Returns the reduced doc of event. Raises if the event doesn't
+        look like a pax event.
+        """
+        if self.native is None:
+            self.native = callable(event.s1s)
+        peaks = event.peaks
+        if self.native:
+            s1s = event.s1s()
+            s2s = event.s2s()
+        else:
+            s1s = [peaks[i] for i in event.s1s]
+            s2s = [peaks[i] for i in event.s2s]
+        interactions = event.interactions
+
+        doc = self.template.copy()
+        self.fill(doc, "event", event)
+        doc['ns1'] = len(s1s)
+        doc['ns2'] = len(s2s)
+        doc['event_length'] = event.stop_time - event.start_time
+        doc['interactions'] = len(interactions)
+
+        if len(interactions) > 0:
+            interaction = interactions[0]
+            s1 = peaks[interaction.s1]
+            s2 = peaks[interaction.s2]
+            self.fill(doc, "interaction", interaction)
+            self.fill(doc, "s1", s1)
+            self.fill(doc, "s2", s2)
+            doc['cs1'] = doc['s1'] * interaction.s1_area_correction
+            doc['cs2'] = doc['s2'] * interaction.s2_area_correction
+
+        # Largest S1 and S2 with positive area, first one on ties. One
+        # loop per peak list only visits S1s and S2s. A single pass over
+        # all peaks has to look up what each peak is and was slower
+        # (benchmarks/bench_reducer.py).
+        for source, candidates in [("largest_s1", s1s), ("largest_s2", s2s)]:
+            largest = None
+            largest_area = 0
+            for peak in candidates:
+                area = peak.area
+                if area > largest_area:
+                    largest_area = area
+                    largest = peak
+            if largest is not None:
+                self.fill(doc, source, largest)
+        return doc
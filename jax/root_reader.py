@@ -0,0 +1,231 @@
+"""
+Fast path for processed (ROOT) input. Instead of deserializing every
+pax event object with tree.GetEntry, only the branches the reduced doc
+needs are read, in bulk, with uproot, and the reduced fields are built
+for a whole block of entries at once with numpy.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import numpy as np
+
+from jax.reducer import FIELD_TABLE, table_fields
+
+# Needed whatever the table says
+BASE_BRANCHES = ( ["start_time", "stop_time", "s1s", "s2s", "peaks.area"] +
+                  ["interactions." + b for b in [
+                      "s1", "s2", "s1_area_correction",
+                      "s2_area_correction"]] )
+
+
+def table_branches(table=FIELD_TABLE):
+    """
+    Names in the pax event class of the branches the fields in table
+    need. Leaves of peaks and interactions carry a 'peaks.' or
+    'interactions.' prefix.
+    """
+    names = list(BASE_BRANCHES)
+    for field, source, attribute, index in table:
+        if source == "event":
+            name = attribute
+        elif source == "interaction":
+            name = "interactions." + attribute
+        else:
+            name = "peaks." + attribute
+        if name not in names:
+            names.append(name)
+    return names
+
+
+ROOT_BRANCHES = table_branches()
+PEAK_BRANCHES = [b[len("peaks."):] for b in ROOT_BRANCHES
+                 if b.startswith("peaks.")]
+INTERACTION_BRANCHES = [b[len("interactions."):] for b in ROOT_BRANCHES
+                        if b.startswith("interactions.")]
+
+
+def resolve_branches(keys, names=ROOT_BRANCHES):
+    """
+    Maps names (see table_branches) to the branch names in the file.
+    Leaves of the split events branch may or may not carry an 'events.'
+    prefix and fixed size arrays carry their dimension, e.g.
+    peaks.range_area_decile[11]. Raises KeyError if one is missing.
+    """
+    leaves = {}
+    for key in keys:
+        leaf = key.split("/")[-1].split("[")[0]
+        leaves.setdefault(leaf, key)
+    ret = {}
+    for name in names:
+        for leaf in [name, "events." + name]:
+            if leaf in leaves:
+                ret[name] = leaves[leaf]
+                break
+        else:
+            raise KeyError("No branch " + name + " in ROOT file")
+    return ret
+
+
+def flatten(jagged):
+    """
+    Turns a per-entry array of arrays into (flat array, counts)
+    """
+    counts = np.fromiter((len(x) for x in jagged), dtype=np.int64,
+                         count=len(jagged))
+    if counts.sum() == 0:
+        # Keeping the shape of fixed size arrays, e.g. (0, 11)
+        shape = np.shape(jagged[0])[1:] if len(jagged) > 0 else ()
+        return np.zeros((0,) + shape), counts
+    return np.concatenate([np.asarray(x) for x in jagged]), counts
+
+
+def largest_peak(event_ids, area):
+    """
+    For peaks given by event_ids (sorted) and area, returns for every
+    event that has one the position of its largest peak with positive
+    area, as (events, positions). Ties go to the first peak, like the
+    per-event loop.
+    """
+    if len(event_ids) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    order = np.lexsort((-area, event_ids))
+    firsts = np.flatnonzero(np.diff(event_ids[order], prepend=-1) != 0)
+    positions = order[firsts]
+    positions = positions[area[positions] > 0]
+    return event_ids[positions], positions
+
+
+def reduce_columns(arrays, table=FIELD_TABLE):
+    """
+    Builds the reduced doc fields for a block of entries. arrays maps
+    the names in table_branches(table) to per-entry values: numbers for
+    event level branches, arrays for the peak, interaction and s1s/s2s
+    ones. Returns {field: (values, valid)}, where valid marks the
+    entries that have the field (the rest are None in the docs).
+    """
+    n = len(arrays["start_time"])
+    everywhere = np.ones(n, dtype=bool)
+    columns = {}
+
+    start_time = np.asarray(arrays["start_time"]).astype(np.int64)
+    columns["event_length"] = (np.asarray(arrays["stop_time"]).astype(
+        np.int64) - start_time, everywhere)
+
+    # Peaks of all entries back to back. Peak i of entry e sits at
+    # peak_offsets[e] + i.
+    peaks = {}
+    interactions = {}
+    for name, values in arrays.items():
+        if name.startswith("peaks."):
+            peaks[name[len("peaks."):]], n_peaks = flatten(values)
+        elif name.startswith("interactions."):
+            interactions[name[len("interactions."):]], n_interactions = \
+                flatten(values)
+    peak_offsets = np.concatenate(([0], np.cumsum(n_peaks)[:-1]))
+
+    s1s, ns1 = flatten(arrays["s1s"])
+    s2s, ns2 = flatten(arrays["s2s"])
+    columns["ns1"] = (ns1, everywhere)
+    columns["ns2"] = (ns2, everywhere)
+
+    # Main S1 and S2 come from the first interaction
+    columns["interactions"] = (n_interactions, everywhere)
+    has_interaction = n_interactions > 0
+    first = np.concatenate(([0], np.cumsum(n_interactions)[:-1]))
+    first = first[has_interaction]
+
+    # For every peak source, its position in the flat peak arrays for
+    # the entries that have one, and which entries those are
+    selections = {}
+    for peak in ["s1", "s2"]:
+        selections[peak] = ( peak_offsets[has_interaction] +
+                             interactions[peak][first].astype(np.int64),
+                             has_interaction )
+    for peak, indices, counts in [("s1", s1s, ns1), ("s2", s2s, ns2)]:
+        event_ids = np.repeat(np.arange(n), counts)
+        index = peak_offsets[event_ids] + indices.astype(np.int64)
+        events, positions = largest_peak(event_ids, peaks["area"][index])
+        has_peak = np.zeros(n, dtype=bool)
+        has_peak[events] = True
+        selections["largest_" + peak] = (index[positions], has_peak)
+
+    def per_entry(values, where):
+        ret = np.zeros((n,) + values.shape[1:], dtype=values.dtype)
+        ret[where] = values
+        return ret
+
+    for field, source, attribute, index in table:
+        if source == "event":
+            values, valid = np.asarray(arrays[attribute]), everywhere
+        elif source == "interaction":
+            values = interactions[attribute][first]
+            valid = has_interaction
+        else:
+            rows, valid = selections[source]
+            values = peaks[attribute][rows]
+        if index is not None:
+            values = values[:, index]
+        if valid is not everywhere:
+            values = per_entry(values, valid)
+        columns[field] = (values, valid)
+
+    for peak in ["s1", "s2"]:
+        rows, valid = selections[peak]
+        # Both are Float_t, the event loop multiplies them as doubles
+        columns["c" + peak] = (per_entry(
+            peaks["area"][rows].astype(np.float64) *
+            interactions[peak + "_area_correction"][first].astype(
+                np.float64), valid), valid)
+    return columns
+
+
+def columns_to_docs(columns, table=FIELD_TABLE):
+    """
+    Turns reduce_columns output into reduced docs, with the same keys
+    as the ones jax.reducer.Reducer makes
+    """
+    fields = []
+    for field, (values, valid) in columns.items():
+        values = values.tolist()
+        if not valid.all():
+            values = [v if ok else None for v, ok in zip(values,
+                                                         valid.tolist())]
+        fields.append((field, values))
+    n = len(fields[0][1])
+    template = {"type": "data"}
+    template.update(dict.fromkeys(table_fields(table)))
+    docs = [dict(template) for i in range(n)]
+    for field, values in fields:
+        for doc, value in zip(docs, values):
+            doc[field] = value
+    return docs
+
+
+def count_entries(filename):
+    """
+    Number of entries in the file's tree. Needs uproot.
+    """
+    import uproot
+    return uproot.open(filename)["tree"].num_entries
+
+
+def iterate_reduced(filename, entry_start=0, step_size=10000,
+                    entry_stop=None, table=FIELD_TABLE):
+    """
+    Reads the ROOT file in blocks of step_size entries, from entry_start
+    up to entry_stop (the end by default). Yields (entry after the
+    block, reduced docs with the fields in table). Needs uproot.
+    """
+    import uproot
+    tree = uproot.open(filename)["tree"]
+    branches = resolve_branches(tree.keys(), table_branches(table))
+    names = dict((v, k) for k, v in branches.items())
+    for arrays, report in tree.iterate(list(branches.values()),
+                                       step_size=step_size,
+                                       entry_start=entry_start,
+                                       entry_stop=entry_stop,
+                                       library="np", report=True):
+        block = dict((names[key], value) for key, value in arrays.items())
+        yield report.tree_entry_stop, columns_to_docs(
+            reduce_columns(block, table), table)
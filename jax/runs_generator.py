@@ -4,17 +4,71 @@ Allows list input as well if wanted.
 """
 
 
-from configparser import ConfigParser
 import logging
 _logger = logging.getLogger(__name__)
-import pymongo
 import os
 import json
+import time
+import collections
+
+from jax.mongo import get_database
+
+# All scheduling and processing need from a run doc. 'end' is only
+# there once the run has ended.
+RUN_PROJECTION = {"name": 1, "number": 1, "detector": 1, "start": 1,
+                  "end": 1}
+
+
+class RunDocCache(object):
+    """
+    The last max_size run docs looked up, least recently used out
+    first. Docs of finished runs (with an 'end') don't change anymore
+    and are kept. Docs of live runs are looked up again after ttl
+    seconds, which is how the end of a run is noticed.
+    """
+
+    def __init__(self, ttl=60., max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # name: (doc, time.time() it was read)
+        self.docs = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, now=None):
+        entry = self.docs.get(name)
+        if entry is not None:
+            doc, read = entry
+            if now is None:
+                now = time.time()
+            if doc.get('end') is not None or now - read < self.ttl:
+                self.docs.move_to_end(name)
+                self.hits += 1
+                return doc
+            del self.docs[name]
+        self.misses += 1
+        return None
+
+    def put(self, doc, now=None):
+        if now is None:
+            now = time.time()
+        self.docs[doc['name']] = (doc, now)
+        self.docs.move_to_end(doc['name'])
+        while len(self.docs) > self.max_size:
+            self.docs.popitem(last=False)
+
 
 class RunsGenerator(object):
     """
     The whole point of this thing is to tell the processing nodes which
     run to look at next.
+
+    Runs from the DB are kept as candidates, newest last. After the
+    first query only runs with a newer _id than the last one we saw are
+    fetched. A run that isn't available yet, or that the output took or
+    may still take (see defer), isn't offered again for a while. One the
+    output is done with is dropped. So a pass costs O(new runs) rather
+    than O(all runs).
     """
 
     def __init__(self, config):
@@ -24,22 +78,12 @@ class RunsGenerator(object):
         if ( config.has_option("runs_input", "runs_uri") and
              config.has_option("runs_input", "runs_db") and
              config.has_option("runs_input", "runs_collection") ):
-            try:
-                # Get environment variables for mongo
-                user = os.getenv("MONGO_USER")
-                password = os.getenv("MONGO_PASSWORD")
-                upstr = ""
-                if user is not None and password is not None:
-                    upstr = user + ":" + password + "@"
-                client = pymongo.MongoClient("mongodb://" + upstr + config.get(
-                    "runs_input", "runs_uri"))        
-                database = config.get("runs_input", "runs_db")
-                collection = config.get("runs_input", "runs_collection")
-                self.db = client[database][collection]
-
-            except pymongo.errors.ConnectionFailure as e:
-                print("Error! Didn't connect to runs DB! " + e)
-                _logger.debug("Failed to connect to runs DB. Standalone mode?")
+            # Get environment variables for mongo
+            database = config.get("runs_input", "runs_db")
+            collection = config.get("runs_input", "runs_collection")
+            self.db = get_database(config.get("runs_input", "runs_uri"),
+                                   database, os.getenv("MONGO_USER"),
+                                   os.getenv("MONGO_PASSWORD"))[collection]
 
         # In case we get a list of runs
         self.runs_to_process = []
@@ -58,18 +102,38 @@ class RunsGenerator(object):
         if config.has_option("runs_input", "last_run"):
             self.last_run = config.get("runs_input", "last_run")
 
-    def get(self, processor):
+        # name: projected run doc, in _id order
+        self.candidates = collections.OrderedDict()
+        self.last_id = None
+        # name: time.time() from which the run is offered again
+        self.deferred = {}
+        # Runs never offered again
+        self.dropped = set()
 
-        # If user defined runs_to_process this is easy
-        if len(self.runs_to_process) > 0:            
-            for item in self.runs_to_process:
-                if processor.check_available({"name": item}):
-                    yield item
-        
-        if self.db == None:
-            return None
+        # Runs whose data isn't there are looked at again after
+        # recheck_unavailable seconds. Runs the output took, or turned
+        # down for now (one another worker is on), after retry_rejected.
+        self.recheck_unavailable = 60.
+        if config.has_option("runs_input", "recheck_unavailable"):
+            self.recheck_unavailable = config.getfloat(
+                "runs_input", "recheck_unavailable")
+        self.retry_rejected = 3600.
+        if config.has_option("runs_input", "retry_rejected"):
+            self.retry_rejected = config.getfloat("runs_input",
+                                                  "retry_rejected")
+        self.n_queries = 0
+        self.n_checked = 0
+
+        # Run docs get_run_doc serves without asking the DB
+        run_cache_ttl = 60.
+        if config.has_option("runs_input", "run_cache_ttl"):
+            run_cache_ttl = config.getfloat("runs_input", "run_cache_ttl")
+        run_cache_size = 1000
+        if config.has_option("runs_input", "run_cache_size"):
+            run_cache_size = config.getint("runs_input", "run_cache_size")
+        self.cache = RunDocCache(run_cache_ttl, run_cache_size)
 
-        # Make the query
+    def make_query(self):
         query = {}
         if self.detector is not None:
             query["detector"] = self.detector
@@ -79,38 +143,137 @@ class RunsGenerator(object):
                 query["number"]["$lte"] = self.last_run
         elif self.last_run is not None:
             query["number"] = {"$lte": self.last_run}
+        return query
 
-
+    def update(self):
+        """
+        Adds the runs that are new since the last call to the
+        candidates, all matching runs on the first call. Returns how
+        many there were.
+        """
+        query = self.make_query()
+        if self.last_id is not None:
+            query["_id"] = {"$gt": self.last_id}
         try:
-            cursor = self.db.find(query).sort("_id", -1)
-        except:
-            _logger.error("Tried but failed to query runs DB")
+            docs = list(self.db.find(query, RUN_PROJECTION).sort("_id", 1))
+        except Exception as e:
+            _logger.error("Tried but failed to query runs DB: " + str(e))
+            return 0
+        self.n_queries += 1
+        for doc in docs:
+            self.remember(doc)
+            if doc['name'] not in self.dropped:
+                self.candidates[doc['name']] = doc
+            self.last_id = doc['_id']
+        return len(docs)
+
+    def remember(self, doc):
+        """
+        Caches a freshly read run doc. A candidate is replaced too, so
+        get hands out the newest doc we've seen.
+        """
+        self.cache.put(doc)
+        if doc['name'] in self.candidates:
+            self.candidates[doc['name']] = doc
+
+    def defer(self, name, delay=None):
+        """
+        Don't offer this run for delay seconds (retry_rejected by
+        default). For runs the output just took or turned down.
+        """
+        if delay is None:
+            delay = self.retry_rejected
+        self.deferred[name] = time.time() + delay
+
+    def drop(self, name):
+        """
+        Never offer this run again. For runs the output turned down for
+        good, e.g. finished ones.
+        """
+        self.candidates.pop(name, None)
+        self.deferred.pop(name, None)
+        self.dropped.add(name)
+
+    def is_deferred(self, name, now):
+        until = self.deferred.get(name)
+        if until is None:
+            return False
+        if until > now:
+            return True
+        del self.deferred[name]
+        return False
+
+    def get(self, processor):
+
+        """
+        Yields the run docs (see RUN_PROJECTION) of the runs to try,
+        newest first
+        """
+        now = time.time()
+
+        # If user defined runs_to_process this is easy. Without a runs
+        # DB the name has to do.
+        if len(self.runs_to_process) > 0:            
+            for doc in processor.filter_available(
+                    [{"name": item} for item in self.runs_to_process
+                     if item not in self.dropped and
+                     not self.is_deferred(item, now)]):
+                if self.db is not None:
+                    doc = self.get_run_doc(doc['name'])
+                    if doc is None:
+                        continue
+                yield doc
+        
+        if self.db == None:
             return None
 
-        for doc in cursor:
-            if processor.check_available(doc):
-                yield doc['name']
+        self.update()
+        docs = [self.candidates[name] for name in reversed(list(
+            self.candidates)) if not self.is_deferred(name, now)]
+        self.n_checked += len(docs)
+        available = processor.filter_available(docs)
+        names = set(doc['name'] for doc in available)
+        for doc in docs:
+            if doc['name'] not in names:
+                self.defer(doc['name'], self.recheck_unavailable)
+        _logger.debug(processor.availability.summary())
+        for doc in available:
+            # Live runs are looked up again every run_cache_ttl, so the
+            # scheduler sees when they end
+            if doc.get('end') is None:
+                doc = self.get_run_doc(doc['name']) or doc
+            yield doc
             
     def get_run_doc(self, name):
+        """
+        The run doc (see RUN_PROJECTION) of run name, from the cache if
+        we have it, else from the DB in one round trip
+        """
         
         if self.db == None:
             return
 
+        doc = self.cache.get(name)
+        if doc is not None:
+            return doc
+
         # Make the query. Support for muon veto "just in case"
         query = {"detector": "tpc", "name": name}
         if self.detector is not None:
             query["detector"] = self.detector
 
+        # Two are enough to tell there's more than one, in one batch
         try:
-            cursor = self.db.find(query)
-        except:
-            _logger.error("Tried but failed to get run doc for run " + name)
+            docs = list(self.db.find(query, RUN_PROJECTION).limit(2))
+        except Exception as e:
+            _logger.error("Tried but failed to get run doc for run " + name +
+                          ": " + str(e))
             return None
         
-        if cursor.count() != 1:
+        if len(docs) != 1:
             _logger.error("Tried to get doc for run " + name +
-                          "but cursor returned a count of " + 
-                          str(cursor.count()))
+                          " but found " + str(len(docs)))
             return None
 
-        return cursor[0]
+        self.remember(docs[0])
+        return docs[0]
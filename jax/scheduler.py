@@ -0,0 +1,176 @@
+"""
+Decides which of the available runs the run workers take next. Runs
+fall into priority classes: live (no end yet, the run the shifters are
+watching), recent (ended less than recent_hours ago) and backlog. Each
+class has a quota of workers, and a backlog run is paused (checkpointed
+and given back, see Output.release) when a live run finds no free
+worker. The queue state is written to state_file for `jax --queue`.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import json
+import time
+import datetime
+
+# In priority order
+CLASSES = ["live", "recent", "backlog"]
+
+
+def to_timestamp(value):
+    """
+    Seconds since the epoch of a run DB time. pymongo returns naive
+    datetimes in UTC.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+
+class Scheduler(object):
+    """
+    Orders the run docs of a RunsGenerator pass by class and keeps
+    track of which class every run a worker is on belongs to.
+    """
+
+    def __init__(self, config, n_workers):
+        self.n_workers = n_workers
+        self.recent_hours = 24.
+        self.preempt = True
+        self.state_file = None
+        # Up to n_workers per class, but backlog leaves one free for
+        # live and recent runs if there's more than one
+        self.quotas = {"live": n_workers, "recent": n_workers,
+                       "backlog": max(1, n_workers - 1)}
+        if config.has_section("scheduler"):
+            if config.has_option("scheduler", "recent_hours"):
+                self.recent_hours = config.getfloat("scheduler",
+                                                    "recent_hours")
+            if config.has_option("scheduler", "preempt"):
+                self.preempt = config.getboolean("scheduler", "preempt")
+            if config.has_option("scheduler", "state_file"):
+                self.state_file = config.get("scheduler", "state_file")
+            for run_class in CLASSES:
+                if config.has_option("scheduler", run_class + "_quota"):
+                    self.quotas[run_class] = config.getint(
+                        "scheduler", run_class + "_quota")
+
+        # name: class of the runs the workers are on
+        self.running = {}
+        # Runs asked to pause, not given back yet
+        self.pausing = set()
+        # class: names of the runs waiting, as of the last pass
+        self.waiting = dict((run_class, []) for run_class in CLASSES)
+        self.n_preempted = 0
+
+    def classify(self, rundoc, now=None):
+        if rundoc.get('end') is None:
+            return "live"
+        if now is None:
+            now = time.time()
+        if now - to_timestamp(rundoc['end']) < self.recent_hours * 3600:
+            return "recent"
+        return "backlog"
+
+    def order(self, rundocs, now=None):
+        """
+        [(class, run doc)] of the runs that aren't running, by class
+        priority and otherwise in the order given
+        """
+        ordered = []
+        self.waiting = dict((run_class, []) for run_class in CLASSES)
+        for rundoc in rundocs:
+            if rundoc['name'] in self.running:
+                continue
+            run_class = self.classify(rundoc, now)
+            ordered.append((CLASSES.index(run_class), len(ordered),
+                            run_class, rundoc))
+            self.waiting[run_class].append(rundoc['name'])
+        ordered.sort(key=lambda entry: entry[:2])
+        return [(run_class, rundoc) for i, n, run_class, rundoc in ordered]
+
+    def has_quota(self, run_class):
+        return ( sum(1 for c in self.running.values() if c == run_class) <
+                 self.quotas[run_class] )
+
+    def started(self, name, run_class):
+        self.running[name] = run_class
+        self.waiting[run_class].remove(name)
+
+    def finished(self, name):
+        self.running.pop(name, None)
+        self.pausing.discard(name)
+
+    def victims(self):
+        """
+        The backlog runs that could be paused for a live run. Empty while
+        a pause is pending.
+        """
+        if not self.preempt or len(self.pausing) > 0:
+            return []
+        return [name for name, run_class in self.running.items()
+                if run_class == "backlog"]
+
+    def paused(self, name):
+        """
+        A worker was asked to pause run name
+        """
+        self.pausing.add(name)
+        self.n_preempted += 1
+
+    def state(self, pool=None):
+        state = {
+            "time": time.time(),
+            "workers": self.n_workers,
+            "quotas": self.quotas,
+            "running": self.running,
+            "pausing": sorted(self.pausing),
+            "waiting": self.waiting,
+            "preempted": self.n_preempted,
+        }
+        if pool is not None:
+            state["queued"] = pool.n_queued
+            state["started"] = pool.n_started
+            state["recycled"] = pool.n_recycled
+        return state
+
+    def write_state(self, pool=None):
+        """
+        Replaces state_file with the current state, if there is one
+        """
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file + ".tmp", "w") as f:
+                json.dump(self.state(pool), f)
+            os.replace(self.state_file + ".tmp", self.state_file)
+        except OSError as e:
+            _logger.warning("Can't write scheduler state to " +
+                            self.state_file + ": " + str(e))
+
+
+def format_state(state):
+    """
+    The state written by Scheduler.write_state, for people
+    """
+    lines = ["Queue as of " + time.strftime(
+        "%Y-%m-%d %H:%M:%S", time.localtime(state["time"])) +
+        " (" + str(state["workers"]) + " workers, " +
+        str(state["preempted"]) + " runs paused so far)"]
+    for run_class in CLASSES:
+        running = sorted(name for name, c in state["running"].items()
+                         if c == run_class)
+        waiting = state["waiting"].get(run_class, [])
+        lines.append("  %-8s %d/%d running: %s" % (
+            run_class, len(running), state["quotas"][run_class],
+            " ".join(running)))
+        lines.append("  %-8s %d waiting: %s" % (
+            "", len(waiting), " ".join(waiting[:10]) +
+            (" ..." if len(waiting) > 10 else "")))
+    if state["pausing"]:
+        lines.append("  pausing: " + " ".join(state["pausing"]))
+    return "\n".join(lines)
@@ -0,0 +1,131 @@
+"""
+Decides which events get their waveform saved, from the reduced doc we
+have anyway. Besides every waveform_prescale-th event, classes of
+interesting events (big S2s, several interactions, saturation...) are
+picked up, each at most at its own rate so a noisy run can't flood the
+waveform DB. See the [waveform_selection] config section.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import re
+import operator
+
+OPERATORS = {
+    "<": operator.lt, "<=": operator.le, ">": operator.gt,
+    ">=": operator.ge, "==": operator.eq, "!=": operator.ne,
+}
+CONDITION = re.compile(r"^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*$")
+
+
+def parse_conditions(spec):
+    """
+    Turns "s2 > 1e5 and interactions >= 2" into a list of
+    (field, comparison, value), all of which have to hold
+    """
+    conditions = []
+    for part in re.split(r"\s+and\s+", spec.strip()):
+        match = CONDITION.match(part)
+        if match is None:
+            raise ValueError("Can't read waveform selection condition '" +
+                             part + "', expected field op number")
+        conditions.append((match.group(1), OPERATORS[match.group(2)],
+                           float(match.group(3))))
+    return conditions
+
+
+class WaveformClass(object):
+    """
+    Events whose reduced doc passes all conditions. At most
+    max_per_minute of them per minute of event time are selected, with
+    bursts of up to max_per_minute, like a token bucket. None means no
+    limit.
+    """
+
+    def __init__(self, name, conditions, max_per_minute=None):
+        self.name = name
+        self.conditions = conditions
+        self.max_per_minute = max_per_minute
+        self.tokens = max_per_minute
+        self.last_time = None
+        self.n_matched = 0
+        self.n_selected = 0
+
+    def matches(self, doc):
+        for field, compare, value in self.conditions:
+            have = doc.get(field)
+            if have is None or not compare(have, value):
+                return False
+        return True
+
+    def take(self, time):
+        """
+        Takes a token for an event at time (ns). Returns False if the
+        class is over its rate.
+        """
+        if self.max_per_minute is None:
+            return True
+        if time is not None:
+            if self.last_time is not None and time > self.last_time:
+                self.tokens = min(
+                    self.max_per_minute,
+                    self.tokens + (time - self.last_time) *
+                    self.max_per_minute / 60e9)
+            self.last_time = time
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def parse_class(name, spec):
+    """
+    Turns a [waveform_selection] entry like
+        large_s2 = s2 > 100000 ; 10
+    (conditions, then optionally the most waveforms per minute) into
+    a WaveformClass
+    """
+    parts = spec.split(";")
+    if len(parts) > 2:
+        raise ValueError("Can't read waveform class " + name + " = " + spec)
+    max_per_minute = None
+    if len(parts) == 2:
+        max_per_minute = float(parts[1])
+    return WaveformClass(name, parse_conditions(parts[0]), max_per_minute)
+
+
+class WaveformSelector(object):
+    """
+    select(doc, n) returns the name of the class the event with reduced
+    doc doc, the n-th of its run, is saved for, or None. Classes are
+    tried in config order, then the prescale.
+    """
+
+    def __init__(self, config=None, prescale=1000):
+        self.prescale = prescale
+        self.classes = []
+        if config is not None and config.has_section("waveform_selection"):
+            for name, spec in config.items("waveform_selection"):
+                self.classes.append(parse_class(name, spec))
+        self.n_prescaled = 0
+
+    def select(self, doc, n):
+        for waveform_class in self.classes:
+            if waveform_class.matches(doc):
+                waveform_class.n_matched += 1
+                if waveform_class.take(doc.get('time')):
+                    waveform_class.n_selected += 1
+                    return waveform_class.name
+        if self.prescale > 0 and n % self.prescale == 0:
+            self.n_prescaled += 1
+            return "prescale"
+        return None
+
+    def summary(self):
+        ret = "waveforms: " + str(self.n_prescaled) + " prescaled"
+        for waveform_class in self.classes:
+            ret += (", " + waveform_class.name + " " +
+                    str(waveform_class.n_selected) + " of " +
+                    str(waveform_class.n_matched))
+        return ret
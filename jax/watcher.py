@@ -0,0 +1,141 @@
+"""
+Watches a raw data run directory for new files. Uses inotify where the
+kernel (and filesystem) supports it and falls back to rescanning the
+directory with a short poll interval.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import ctypes
+import ctypes.util
+import select
+import time
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+
+def inotify_watch(directory):
+    """
+    Returns an inotify file descriptor watching directory for new and
+    finished files, or None if inotify isn't available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None
+    if fd < 0:
+        return None
+    wd = libc.inotify_add_watch(fd, os.fsencode(directory),
+                                IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE)
+    if wd < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class RunWatcher(object):
+    """
+    Keeps an index from first event number to file name for the raw
+    files of one run, e.g. XENON1T-6386-000001000-000001999-000001000.zip
+    is indexed under 1000. Temp files are left out until they're renamed.
+    finished is set once eventbuilder.log shows up.
+    """
+
+    def __init__(self, directory, prefix, poll_interval=1.,
+                 rescan_interval=30., use_inotify=True):
+        self.directory = directory
+        self.prefix = prefix
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+        self.files = {}
+        self.any_files = False
+        self.finished = False
+
+        self.fd = None
+        if use_inotify and os.path.isdir(directory):
+            self.fd = inotify_watch(directory)
+        if self.fd is None:
+            _logger.debug("No inotify for " + directory + ", polling")
+        self.scan()
+
+    def scan(self):
+        """
+        One listing of the directory, updating the index
+        """
+        try:
+            entries = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in entries:
+            if name == "eventbuilder.log":
+                self.finished = True
+                continue
+            if not name.startswith(self.prefix):
+                continue
+            self.any_files = True
+            if 'temp' in name:
+                continue
+            parts = name.split("-")
+            try:
+                self.files[int(parts[2])] = name
+            except (IndexError, ValueError):
+                continue
+
+    def wait(self, timeout):
+        """
+        Blocks until the directory changes or timeout seconds pass, then
+        rescans. Without inotify this is a sleep.
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+        else:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if ready:
+                # Drain the events, we rescan anyway
+                try:
+                    while os.read(self.fd, 65536):
+                        pass
+                except BlockingIOError:
+                    pass
+        self.scan()
+
+    def wait_for(self, start_event, timeout):
+        """
+        Returns the name of the file starting at start_event as soon as
+        it's there. Returns None after timeout seconds, or right away if
+        the run is finished and the file doesn't exist.
+        Without inotify the directory is rescanned every poll_interval
+        seconds. With inotify it's rescanned on every event and, since
+        network filesystems don't always send events, at least every
+        rescan_interval seconds.
+        """
+        interval = self.poll_interval
+        if self.fd is not None:
+            interval = self.rescan_interval
+        end = time.time() + timeout
+        if start_event not in self.files:
+            self.scan()
+        while True:
+            if start_event in self.files:
+                return self.files[start_event]
+            if self.finished:
+                # The log can show up just before the last file
+                self.scan()
+                return self.files.get(start_event)
+            remaining = end - time.time()
+            if remaining <= 0:
+                return None
+            self.wait(min(remaining, interval))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,249 @@
+"""
+Long-lived run workers. Each worker builds its output and Processor (and
+so its pax, DB clients and compiled event classes) once and then takes
+run docs from its task queue. It reports every run it starts and
+finishes on a result queue, which is what the main loop waits on, so a
+freed slot is refilled as soon as the run is done.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import os
+import queue
+import resource
+import multiprocessing
+
+from jax.output import get_output
+from jax.mongo import close_clients
+from jax.processor import Processor, Paused, PAUSED
+
+
+def rss_mb():
+    """
+    Resident memory of this process in MB. Falls back to the peak if
+    /proc isn't there.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in kB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def worker_main(config, worker_id, tasks, results, pause, max_runs=0,
+                max_rss=0):
+    """
+    Processes run docs from tasks until it gets None, or until it has
+    done max_runs runs or uses more than max_rss MB (0 for no limit).
+    Puts ("started", worker_id, name) and
+    ("finished", worker_id, name, result, retire) on results. Setting
+    the pause event pauses the current run at its next checkpoint, its
+    result is then PAUSED.
+    """
+    output = get_output(config)
+    processor = Processor(config)
+    processor.pause = pause
+    n_runs = 0
+    try:
+        while True:
+            rundoc = tasks.get()
+            if rundoc is None:
+                break
+            pause.clear()
+            results.put(("started", worker_id, rundoc['name']))
+            try:
+                result = processor.process_run(output, rundoc)
+            except Paused:
+                _logger.info("Paused run " + rundoc['name'])
+                result = PAUSED
+            except Exception:
+                _logger.exception("Worker " + str(worker_id) +
+                                  " failed on run " + rundoc['name'])
+                result = -1
+            n_runs += 1
+            retire = ( (max_runs > 0 and n_runs >= max_runs) or
+                       (max_rss > 0 and rss_mb() > max_rss) )
+            results.put(("finished", worker_id, rundoc['name'], result,
+                         retire))
+            if retire:
+                break
+    finally:
+        processor.shutdown()
+        if hasattr(output, 'stop'):
+            output.stop()
+        # Child processes skip atexit
+        close_clients()
+
+
+class WorkerPool(object):
+    """
+    n_workers worker processes, each with its own task queue so we
+    know which run every worker has, started or not. The workers aren't
+    daemonic, so they can have pools of their own (file_workers,
+    entry_workers). A worker that retires (max_runs, max_rss) or dies is
+    replaced.
+
+    submit() a run doc only while free_slots() > 0, then wait() for
+    runs to finish.
+    """
+
+    def __init__(self, config, n_workers, max_runs=0, max_rss=0):
+        self.config = config
+        self.n_workers = n_workers
+        self.max_runs = max_runs
+        self.max_rss = max_rss
+        self.results = multiprocessing.Queue()
+        self.next_id = 0
+        # worker id: Process
+        self.workers = {}
+        # worker id: its task queue
+        self.tasks = {}
+        # worker id: multiprocessing.Event that pauses its run
+        self.pause_events = {}
+        # worker id: name of the run it's on
+        self.running = {}
+        # worker id: name of the run submitted to it, not started yet
+        self.assigned = {}
+        self.n_started = 0
+        self.n_recycled = 0
+
+    def start(self):
+        while len(self.workers) < self.n_workers:
+            self.spawn()
+
+    def spawn(self):
+        worker_id = self.next_id
+        self.next_id += 1
+        pause = multiprocessing.Event()
+        tasks = multiprocessing.Queue()
+        worker = multiprocessing.Process(
+            target=worker_main, name="jax-worker-" + str(worker_id),
+            args=(self.config, worker_id, tasks, self.results, pause,
+                  self.max_runs, self.max_rss))
+        worker.start()
+        self.workers[worker_id] = worker
+        self.tasks[worker_id] = tasks
+        self.pause_events[worker_id] = pause
+        _logger.debug("Started worker " + str(worker_id) + " (pid " +
+                      str(worker.pid) + ")")
+
+    @property
+    def n_queued(self):
+        return len(self.assigned)
+
+    def idle(self):
+        return [worker_id for worker_id in self.workers
+                if worker_id not in self.running and
+                worker_id not in self.assigned]
+
+    def free_slots(self):
+        return len(self.idle())
+
+    def busy(self):
+        return len(self.running) + len(self.assigned)
+
+    def submit(self, rundoc):
+        worker_id = self.idle()[0]
+        self.tasks[worker_id].put(rundoc)
+        self.assigned[worker_id] = rundoc['name']
+
+    def forget(self, worker_id):
+        del self.workers[worker_id]
+        del self.tasks[worker_id]
+        del self.pause_events[worker_id]
+
+    def pause(self, name):
+        """
+        Asks the worker on run name to pause it. Returns False if no
+        worker is on it.
+        """
+        for worker_id, running in self.running.items():
+            if running == name:
+                self.pause_events[worker_id].set()
+                return True
+        return False
+
+    def handle(self, message):
+        """
+        Books a result message. Returns (name, result) for a finished
+        run, else None.
+        """
+        if message[0] == "started":
+            worker_id, name = message[1:]
+            self.assigned.pop(worker_id, None)
+            self.n_started += 1
+            self.running[worker_id] = name
+            return None
+        worker_id, name, result, retire = message[1:]
+        self.running.pop(worker_id, None)
+        if retire:
+            self.n_recycled += 1
+            # Unless reap() found it gone already
+            worker = self.workers.get(worker_id)
+            if worker is not None:
+                worker.join()
+                self.forget(worker_id)
+                self.spawn()
+        return name, result
+
+    def reap(self):
+        """
+        Replaces workers that died without saying so. Their run, started
+        or just submitted, counts as failed. Returns [(name, -1)].
+        """
+        finished = []
+        for worker_id, worker in list(self.workers.items()):
+            if worker.is_alive():
+                continue
+            worker.join()
+            self.forget(worker_id)
+            name = self.running.pop(worker_id, None)
+            if name is None:
+                name = self.assigned.pop(worker_id, None)
+            if name is None and worker.exitcode == 0:
+                # Retired, the message is on its way
+                self.spawn()
+                continue
+            _logger.error("Worker " + str(worker_id) + " died with exit code " +
+                          str(worker.exitcode) + " on run " + str(name))
+            if name is not None:
+                finished.append((name, -1))
+            self.spawn()
+        return finished
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for a run to finish, returning as
+        soon as one does. Returns [(name, result)] of the finished runs.
+        """
+        finished = []
+        try:
+            message = self.results.get(timeout=timeout)
+            while True:
+                ret = self.handle(message)
+                if ret is not None:
+                    finished.append(ret)
+                message = self.results.get_nowait()
+        except queue.Empty:
+            pass
+        return finished + self.reap()
+
+    def stop(self):
+        """
+        Lets the workers finish what they're on and exit
+        """
+        for tasks in self.tasks.values():
+            tasks.put(None)
+        for worker in self.workers.values():
+            worker.join()
+        self.workers = {}
+        self.tasks = {}
+        self.pause_events = {}
+
+    def summary(self):
+        return ("workers: " + str(len(self.running)) + " running, " +
+                str(self.n_queued) + " queued, " + str(self.n_started) +
+                " runs started, " + str(self.n_recycled) + " recycled")
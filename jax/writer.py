@@ -0,0 +1,161 @@
+"""
+Runs an output backend behind a bounded queue in a background thread,
+so pax keeps the core busy while inserts are in flight.
+"""
+
+
+import logging
+_logger = logging.getLogger(__name__)
+import threading
+import queue
+
+
+class WriterError(Exception):
+    """
+    Raised in the processing loop when the writer thread failed
+    """
+    pass
+
+
+class AsyncOutput(object):
+    """
+    Wraps an output backend (see jax.output.Output). Events are reduced
+    in the calling thread, since ROOT reuses the event object for the
+    next entry, and the resulting docs are written by the writer thread.
+    When the queue is full the caller blocks until the writer catches up.
+    An exception in the writer thread is raised as WriterError from the
+    next call in the processing loop.
+    """
+
+    def __init__(self, output, queue_size=1000):
+        self.output = output
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        # Started on first use rather than in __init__ so a forked
+        # worker gets its own thread
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.write_loop,
+                                       name="jax-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Drain the queue and stop the writer thread
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.check_error()
+
+    def write_loop(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                function, args = task
+                function(*args)
+            except Exception as e:
+                _logger.error("Output writer failed: " + str(e))
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def put(self, function, *args):
+        self.check_error()
+        self.start()
+        self.queue.put((function, args))
+
+    def check_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise WriterError("Output writer failed: " + str(error))
+
+    def register_processor(self, collection, mode, prescale):
+        return self.output.register_processor(collection, mode, prescale)
+
+    def may_take_later(self, collection, mode):
+        return self.output.may_take_later(collection, mode)
+
+    def MakeReducedDoc(self, event):
+        return self.output.MakeReducedDoc(event)
+
+    def save_doc(self, event, collection):
+        insert_doc = self.output.MakeReducedDoc(event)
+        if insert_doc is None:
+            return
+        self.put(self.output.save_reduced_doc, insert_doc, collection)
+
+    def save_reduced_doc(self, insert_doc, collection):
+        self.put(self.output.save_reduced_doc, insert_doc, collection)
+
+    def save_waveform(self, event, collection, selection=None):
+        """
+        Written right away in the calling thread, not queued: the
+        processor needs to know whether this waveform was stored to save
+        the next one instead. Waveforms are rare, so it hardly waits.
+        """
+        return self.output.save_waveform(event, collection, selection)
+
+    @property
+    def concurrent_writers(self):
+        return self.output.concurrent_writers
+
+    @property
+    def can_release(self):
+        return self.output.can_release
+
+    def flush(self, collection):
+        """
+        Waits until everything queued so far is written and flushed
+        """
+        self.put(self.output.flush, collection)
+        self.queue.join()
+        self.check_error()
+
+    def checkpoint(self, collection, checkpoint):
+        # Queued behind the docs it covers
+        self.put(self.output.checkpoint, collection, checkpoint)
+
+    def write_aggregates(self, collection):
+        """
+        Waits until everything queued so far and the aggregates are
+        written
+        """
+        self.put(self.output.write_aggregates, collection)
+        self.queue.join()
+        self.check_error()
+
+    def get_checkpoint(self, collection):
+        return self.output.get_checkpoint(collection)
+
+    def forget(self, collection):
+        # Queued behind the writes that still need it
+        self.put(self.output.forget, collection)
+
+    def release(self, collection, checkpoint):
+        """
+        Waits until everything queued so far is written, then gives
+        the run back
+        """
+        self.put(self.output.release, collection, checkpoint)
+        self.queue.join()
+        self.check_error()
+
+    def close(self, collection, nevents):
+        """
+        Waits until everything queued so far is written, then closes
+        the run in the backend
+        """
+        self.put(self.output.close, collection, nevents)
+        self.queue.join()
+        self.check_error()
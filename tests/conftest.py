@@ -1,12 +1,278 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """
-    Dummy conftest.py for jax.
+    conftest.py for jax: fakes and event factories the test modules
+    share, handed out as fixtures.
 
-    If you don't know what this is for, just leave it empty.
     Read more about conftest.py under:
     https://pytest.org/latest/plugins.html
 """
 from __future__ import print_function, absolute_import, division
 
+from configparser import ConfigParser
+from types import SimpleNamespace
+
+import numpy as np
+import pymongo
 import pytest
+from jax.output import MonitorOutput
+from jax.root_reader import PEAK_BRANCHES, INTERACTION_BRANCHES
+
+
+def matches(doc, query):
+    return all(doc.get(key) == value for key, value in query.items())
+
+
+class FakeCollection(object):
+    """
+    Keeps inserted docs in docs and docs created by bulk_write upserts
+    in upserted, and enforces unique indexes on both
+    """
+
+    def __init__(self):
+        self.docs = []
+        self.upserted = []
+        self.updates = []
+        self.requests = []
+        self.indexes = []
+        self.found = None
+        self.matched_count = 1
+        self.n_calls = 0
+
+    def duplicate(self, doc):
+        for key, options in self.indexes:
+            if not options.get('unique'):
+                continue
+            partial = options.get('partialFilterExpression', {})
+            if not matches(doc, partial):
+                continue
+            for other in self.docs + self.upserted:
+                if matches(other, partial) and \
+                   other.get(key) == doc.get(key):
+                    return {'code': 11000, 'errmsg': "E11000 duplicate key "
+                            + key + ": " + str(doc.get(key))}
+        return None
+
+    def insert_many(self, docs, ordered=True):
+        self.n_calls += 1
+        errors = []
+        for doc in docs:
+            error = self.duplicate(doc)
+            if error is None:
+                self.docs.append(doc)
+            else:
+                errors.append(error)
+        if len(errors) > 0:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors})
+        return SimpleNamespace(inserted_ids=list(range(len(docs))))
+
+    def insert_one(self, doc):
+        self.n_calls += 1
+        self.docs.append(doc)
+
+    def bulk_write(self, requests, ordered=True):
+        errors = []
+        for request in requests:
+            self.requests.append(request)
+            query, update = request._filter, request._doc
+            if any(matches(doc, query) for doc in self.docs + self.upserted):
+                continue
+            if not request._upsert:
+                continue
+            if isinstance(request, pymongo.ReplaceOne):
+                doc = dict(update)
+            else:
+                doc = dict(update.get('$setOnInsert', {}))
+            doc.update(query)
+            error = self.duplicate(doc)
+            if error is None:
+                self.upserted.append(doc)
+                continue
+            errors.append(error)
+            if ordered:
+                break
+        if len(errors) > 0:
+            raise pymongo.errors.BulkWriteError({'writeErrors': errors})
+
+    def find_one(self, *args, **kwargs):
+        return self.found
+
+    def create_index(self, key, **kwargs):
+        self.indexes.append((key, kwargs))
+
+    def update_one(self, query, update):
+        self.n_calls += 1
+        self.updates.append(update)
+        return SimpleNamespace(matched_count=self.matched_count)
+
+
+class FakeDB(dict):
+    def __missing__(self, key):
+        self[key] = FakeCollection()
+        return self[key]
+
+    def collection_names(self):
+        return list(self.keys())
+
+
+def _make_output(**options):
+    config = ConfigParser()
+    config.add_section("mongo_output")
+    for key, value in options.items():
+        config.set("mongo_output", key, str(value))
+    output = MonitorOutput(config)
+    output.mdb = FakeDB()
+    return output
+
+
+def _make_event(event_number):
+    return SimpleNamespace(s1s=[], s2s=[], peaks=[], interactions=[],
+                           start_time=event_number*1000,
+                           stop_time=event_number*1000+100,
+                           event_number=event_number)
+
+
+# Float_t in pax's ROOT event class
+FLOAT_BRANCHES = ["area", "range_area_decile", "hit_time_mean",
+                  "area_fraction_top", "s1_area_correction",
+                  "s2_area_correction", "x", "y", "z", "drift_time"]
+
+
+def _make_root_events(n, seed=0):
+    """
+    Events shaped like the ROOT flavour of the pax event class: s1s and
+    s2s are peak indices, interactions point at peaks by index. Floats
+    hold float32 values, as PyROOT hands out Float_t members.
+    """
+    rng = np.random.RandomState(seed)
+
+    def f32(value):
+        return float(np.float32(value))
+    events = []
+    for i in range(n):
+        peaks = []
+        for j in range(rng.randint(0, 6)):
+            peaks.append(SimpleNamespace(
+                area=f32(rng.choice([0., rng.exponential(100)])),
+                range_area_decile=rng.uniform(0, 1000, 11).astype(
+                    np.float32),
+                hit_time_mean=f32(rng.uniform(0, 1e5)),
+                area_fraction_top=f32(rng.uniform()),
+                n_hits=int(rng.randint(0, 100)),
+                n_contributing_channels=int(rng.randint(0, 100)),
+                n_saturated_channels=int(rng.randint(0, 3))))
+        kinds = rng.randint(0, 3, len(peaks))
+        s1s = [j for j in range(len(peaks)) if kinds[j] == 1]
+        s2s = [j for j in range(len(peaks)) if kinds[j] == 2]
+        interactions = []
+        if len(s1s) > 0 and len(s2s) > 0:
+            for j in range(rng.randint(0, 3)):
+                interactions.append(SimpleNamespace(
+                    s1=int(rng.choice(s1s)), s2=int(rng.choice(s2s)),
+                    s1_area_correction=f32(rng.uniform(1, 2)),
+                    s2_area_correction=f32(rng.uniform(1, 2)),
+                    x=f32(rng.normal()), y=f32(rng.normal()),
+                    z=f32(rng.normal()), drift_time=f32(rng.normal())))
+        start = int(1e18) + i * 1000
+        events.append(SimpleNamespace(
+            event_number=i, start_time=start,
+            stop_time=start + int(rng.randint(100, 1000)),
+            s1s=s1s, s2s=s2s, peaks=peaks, interactions=interactions))
+    return events
+
+
+def _to_arrays(events):
+    # What uproot hands us with library="np"
+    def jagged(values, dtype=None):
+        ret = np.empty(len(values), dtype=object)
+        ret[:] = [np.array(v, dtype=dtype) for v in values]
+        return ret
+    arrays = {
+        "event_number": np.array([e.event_number for e in events]),
+        "start_time": np.array([e.start_time for e in events]),
+        "stop_time": np.array([e.stop_time for e in events]),
+        "s1s": jagged([e.s1s for e in events], np.int32),
+        "s2s": jagged([e.s2s for e in events], np.int32),
+    }
+    for b in PEAK_BRANCHES:
+        arrays["peaks." + b] = jagged(
+            [[getattr(p, b) for p in e.peaks] for e in events],
+            np.float32 if b in FLOAT_BRANCHES else None)
+        if b == "range_area_decile":
+            for i, e in enumerate(events):
+                arrays["peaks." + b][i] = arrays["peaks." + b][i].reshape(
+                    len(e.peaks), 11)
+    for b in INTERACTION_BRANCHES:
+        arrays["interactions." + b] = jagged(
+            [[getattr(i, b) for i in e.interactions] for e in events],
+            np.float32 if b in FLOAT_BRANCHES else None)
+    return arrays
+
+
+
+
+def _write_root_file(filename, events):
+    uproot = pytest.importorskip("uproot")
+    ak = pytest.importorskip("awkward")
+    branches = {}
+    for name, values in _to_arrays(events).items():
+        if name == "peaks.range_area_decile":
+            # A (n_peaks, 11) array per entry, like pax's Float_t[11].
+            # uproot works out the basket offsets of such a branch from
+            # the flattened values, 8 instead of 88 bytes a peak, so we
+            # hand it offsets in values, not peaks.
+            counts = [len(v) for v in values]
+            offsets = np.concatenate(([0], np.cumsum(counts))) * 11
+            values = ak.Array(ak.contents.ListOffsetArray(
+                ak.index.Index64(offsets),
+                ak.contents.RegularArray(ak.contents.NumpyArray(
+                    np.concatenate(list(values)).ravel()), 11)))
+        elif name not in ["event_number", "start_time", "stop_time"]:
+            values = ak.Array([list(v) for v in values])
+        branches[name] = values
+    with uproot.recreate(filename) as f:
+        # A TTree like pax writes, not uproot's default RNTuple
+        f.mktree("tree", dict((k, v.type) if hasattr(v, "layout") else
+                              (k, v.dtype) for k, v in branches.items()))
+        f["tree"].extend(branches)
+
+
+@pytest.fixture
+def make_output():
+    """
+    make_output(**options): a MonitorOutput with those mongo_output
+    options, writing to a FakeDB
+    """
+    return _make_output
+
+
+@pytest.fixture
+def make_event():
+    """
+    make_event(event_number): an event without peaks
+    """
+    return _make_event
+
+
+@pytest.fixture
+def make_root_events():
+    """
+    make_root_events(n, seed=0): random events like the ROOT event class
+    """
+    return _make_root_events
+
+
+@pytest.fixture
+def to_arrays():
+    """
+    to_arrays(events): the branches of events as uproot reads them
+    """
+    return _to_arrays
+
+
+@pytest.fixture
+def write_root_file():
+    """
+    write_root_file(filename, events): writes events to a pax-like TTree
+    """
+    return _write_root_file
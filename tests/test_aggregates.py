@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from configparser import ConfigParser
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from jax import processor
+from jax.writer import AsyncOutput
+from jax.aggregates import (Histogram, QuantileSketch, RunAggregates,
+                            sketch_quantile, get_histograms)
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def apply_inc(doc, increments):
+    # What mongo does with $inc on dotted paths, array indices included
+    for path, value in increments.items():
+        keys = path.split(".")
+        target = doc
+        for key in keys[:-1]:
+            target = target[int(key)] if isinstance(target, list) else \
+                target.setdefault(key, {})
+        if isinstance(target, list):
+            target[int(keys[-1])] += value
+        else:
+            target[keys[-1]] = target.get(keys[-1], 0) + value
+
+
+def test_histogram_matches_numpy():
+    rng = np.random.RandomState(0)
+    x = rng.normal(0, 30, 1000)
+    y = rng.normal(0, 30, 1000)
+    x[::10] = np.nan
+    histogram = Histogram(["x", "y"], [10, 20], [(-50, 50), (-40, 40)])
+    histogram.add({"x": x[:500], "y": y[:500]})
+    histogram.add({"x": x[500:], "y": y[500:]})
+    ok = np.isfinite(x)
+    expected, _, _ = np.histogram2d(x[ok], y[ok], [10, 20],
+                                    [(-50, 50), (-40, 40)])
+    np.testing.assert_array_equal(histogram.counts.reshape(10, 20),
+                                  expected)
+    assert histogram.overflow == ok.sum() - expected.sum()
+
+
+def test_sketch_accuracy():
+    rng = np.random.RandomState(1)
+    values = np.concatenate([rng.exponential(1000, 10000),
+                             -rng.exponential(10, 100), np.zeros(50)])
+    sketch = QuantileSketch(0.01)
+    for part in np.array_split(values, 7):
+        sketch.add(part)
+    doc = sketch.empty_doc()
+    apply_inc(doc, dict((k[len("q."):], v) for k, v in
+                        sketch.pop_increments("q").items()))
+    for q in [0.001, 0.05, 0.5, 0.9, 0.99]:
+        exact = np.sort(values)[int(q * (len(values) - 1))]
+        assert sketch_quantile(doc, q) == pytest.approx(exact, rel=0.011,
+                                                        abs=1e-12)
+
+
+def test_increments_add_up():
+    docs = [{"cs1": float(i), "cs2": 100. * i, "s1": 1., "s2": None,
+             "event_length": 100, "dt": 1000., "x": 0., "y": 0.,
+             "ns1": 1, "ns2": i % 2, "interactions": 0} for i in range(100)]
+    # Two processes writing the same run
+    first, second = RunAggregates(), RunAggregates()
+    status = first.empty_doc()
+    first.add(docs[:60])
+    second.add(docs[60:])
+    apply_inc(status, dict((k[len("aggregates."):], v) for k, v in
+                           first.pop_increments().items()))
+    apply_inc(status, dict((k[len("aggregates."):], v) for k, v in
+                           second.pop_increments().items()))
+    assert first.pop_increments() == {}
+
+    whole = RunAggregates()
+    whole.add(docs)
+    assert status["counters"] == {"events": 100, "with_s1": 100,
+                                  "with_s2": 50, "with_interaction": 0}
+    assert status["histograms"]["cs1"]["counts"] == \
+        whole.histograms["cs1"].counts.tolist()
+    assert sum(status["histograms"]["cs1_cs2"]["counts"]) == 100
+    assert status["quantiles"]["s2"]["zero"] == 0
+    assert sketch_quantile(status["quantiles"]["cs1"], 0.5) == \
+        pytest.approx(49.5, rel=0.02)
+
+
+def test_checkpoint_carries_increments(make_output):
+    output = make_output(insert_flush_interval=1000)
+    output.save_reduced_doc({"cs1": 10., "ns1": 1}, "run")
+    output.checkpoint("run", {'event': 1, 'saved': 1})
+    update = output.mdb["run_status"].updates[-1]
+    assert update['$inc']['aggregates.counters.events'] == 1
+    assert update['$inc']['aggregates.histograms.cs1.counts.0'] == 1
+    assert 'checkpoint' in update['$set']
+    # Nothing new, nothing to add
+    output.checkpoint("run", {'event': 1, 'saved': 1})
+    assert '$inc' not in output.mdb["run_status"].updates[-1]
+
+
+def test_close_keeps_unwritten_increments(make_output):
+    output = make_output(insert_flush_interval=1000)
+    output.save_reduced_doc({"cs1": 10., "ns1": 1}, "run")
+    output.mdb["run_status"].matched_count = 0
+    output.close("run", 1)
+    update = output.mdb["run_status"].updates[-1]
+    assert update['$inc']['aggregates.counters.events'] == 1
+    # Not confirmed, so they go with the next update
+    output.mdb["run_status"].matched_count = 1
+    output.close("run", 1)
+    update = output.mdb["run_status"].updates[-1]
+    assert update['$inc']['aggregates.counters.events'] == 1
+    assert "run" not in output.aggregates
+
+
+def test_file_task_writes_aggregates(monkeypatch, make_output):
+    backend = make_output(insert_flush_interval=1000)
+    write_aggregates = backend.write_aggregates
+
+    def slow_write_aggregates(collection):
+        time.sleep(0.2)
+        write_aggregates(collection)
+    backend.write_aggregates = slow_write_aggregates
+
+    def process_file(output, run_name, to_process, saved_offset):
+        for i in to_process:
+            output.save_reduced_doc({"cs1": 10., "ns1": 1}, run_name)
+        return len(to_process)
+
+    output = AsyncOutput(backend)
+    monkeypatch.setattr(processor, "_file_worker", (
+        SimpleNamespace(process_file=process_file), output))
+    try:
+        assert processor.process_file_task("run", range(3), 0) == 3
+        # Written by the time the task returns
+        update = backend.mdb["run_status"].updates[-1]
+        assert update['$inc']['aggregates.counters.events'] == 3
+    finally:
+        output.stop()
+
+
+def test_histogram_config():
+    config = ConfigParser()
+    config.add_section("histograms")
+    config.set("histograms", "s2_dt", "s2 10 0 1e5 dt 20 0 8e5")
+    assert get_histograms(config) == {
+        "s2_dt": (["s2", "dt"], [10, 20], [(0., 1e5), (0., 8e5)])}
+    config.set("histograms", "bad", "s2 10 0")
+    with pytest.raises(ValueError):
+        get_histograms(config)
+
+
+def test_rate_docs_next_to_unique_index(make_output):
+    output = make_output(insert_flush_interval=1000, insert_batch_size=10,
+                         rate_bin_seconds=1, rate_block_bins=10)
+    output.index_events("run")
+    # 30 s of events, three rate blocks
+    for i in range(30):
+        output.save_reduced_doc({"type": "data", "event_number": i,
+                                 "time": int(i * 1e9), "s2": 10.}, "run")
+    output.close("run", 30)
+    assert sorted(doc['_id'] for doc in output.mdb["run"].upserted) == \
+        ["rate.0", "rate.1", "rate.2"]
+    assert len(output.mdb["run"].docs) == 30
+
+
+def test_rate_docs(make_output):
+    output = make_output(insert_flush_interval=1000, insert_batch_size=50,
+                         rate_bin_seconds=2, rate_block_bins=10)
+    # 100 events, one every 0.5 s, S2 on every other one
+    for i in range(100):
+        output.save_reduced_doc({"time": int(i * 5e8),
+                                 "s2": 10. if i % 2 else None}, "run")
+    output.close("run", 100)
+
+    # Replay the upserts and increments
+    rate_docs = {}
+    for request in output.mdb["run"].requests:
+        key = request._filter['_id']
+        update = request._doc
+        if '$setOnInsert' in update:
+            rate_docs.setdefault(key, update['$setOnInsert'])
+        else:
+            apply_inc(rate_docs[key], update['$inc'])
+    assert sorted(rate_docs) == ["rate.0", "rate.1", "rate.2"]
+    doc = rate_docs["rate.1"]
+    assert doc["start"] == int(20e9) and doc["bin_seconds"] == 2.
+    assert doc["counts"] == [4] * 10
+    assert doc["s2_n"] == [2] * 10
+    assert doc["s2_sum"] == [20.] * 10
+    assert rate_docs["rate.2"]["counts"] == [4] * 5 + [0] * 5
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+from jax.availability import AvailabilityIndex
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def test_available(tmpdir):
+    tmpdir.mkdir("170101_0000")
+    tmpdir.join("170101_0001.root").write("")
+    index = AvailabilityIndex(str(tmpdir))
+    assert index.available("170101_0000")
+    assert index.available("170101_0001")
+    assert not index.available("170101_0002")
+    # Not a prefix match
+    assert not index.available("170101_000")
+    assert index.hits == 2
+    assert index.misses == 2
+    assert index.n_refreshes == 1
+
+
+def test_filter_lists_once(tmpdir):
+    tmpdir.mkdir("run1")
+    tmpdir.mkdir("run10")
+    index = AvailabilityIndex(str(tmpdir))
+    assert index.filter(["run1", "run2", "run10", "run100"]) == \
+        ["run1", "run10"]
+    assert index.n_refreshes == 1
+
+
+def test_refresh_on_change(tmpdir):
+    index = AvailabilityIndex(str(tmpdir), ttl=3600)
+    assert not index.available("run1")
+    tmpdir.mkdir("run1")
+    # Make sure the mtime changes on coarse filesystems
+    os.utime(str(tmpdir), ns=(0, 1))
+    assert index.available("run1")
+    assert index.n_refreshes == 2
+    assert not index.refresh()
+
+
+def test_refresh_on_ttl(tmpdir):
+    index = AvailabilityIndex(str(tmpdir), ttl=0)
+    index.refresh()
+    assert index.refresh()
+
+
+def test_missing_directory(tmpdir):
+    index = AvailabilityIndex(str(tmpdir.join("nothing")))
+    assert not index.available("run1")
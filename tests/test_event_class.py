@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import fcntl
+import multiprocessing
+
+from jax.event_class import populate, class_key, READY, SOURCE
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def slow_build(directory):
+    # Stands in for the compile, leaves one file per build
+    time.sleep(0.2)
+    with open(os.path.join(directory, "build-" + str(os.getpid())), "w"):
+        pass
+
+
+def populate_task(directory):
+    return populate(directory, slow_build)
+
+
+def test_populate_builds_once(tmpdir):
+    directory = str(tmpdir.join("key"))
+    pool = multiprocessing.Pool(4)
+    try:
+        built = pool.map(populate_task, [directory] * 4)
+    finally:
+        pool.close()
+        pool.join()
+    assert sorted(built) == [False, False, False, True]
+    assert len([f for f in os.listdir(directory)
+                if f.startswith("build-")]) == 1
+    assert not populate(directory, slow_build)
+
+
+def test_populate_redoes_unfinished(tmpdir):
+    directory = str(tmpdir.join("key"))
+    os.makedirs(directory)
+    # What a build leaves before READY: the source and half a library
+    for name in [SOURCE, "pax_event_class_cpp.so"]:
+        with open(os.path.join(directory, name), "w") as f:
+            f.write("partial")
+    # Its process still holds the lock
+    lock = open(directory + ".lock", "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    pool = multiprocessing.Pool(1)
+    try:
+        waiting = pool.apply_async(populate_task, (directory,))
+        time.sleep(0.5)
+        assert not waiting.ready()
+        assert not os.path.exists(os.path.join(directory, READY))
+        # and dies
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        assert waiting.get(timeout=10)
+    finally:
+        lock.close()
+        pool.close()
+        pool.join()
+    assert len([f for f in os.listdir(directory)
+                if f.startswith("build-")]) == 1
+    assert os.path.exists(os.path.join(directory, READY))
+    assert not populate(directory, slow_build)
+
+
+def test_class_key():
+    assert class_key("class Event {};", "6.10/04") == \
+        class_key("class Event {};", "6.10/04")
+    assert class_key("class Event {};", "6.10/04") != \
+        class_key("class Event {};", "6.12/06")
+    assert class_key("class Event {};", "6.10/04") != \
+        class_key("class Event { int n; };", "6.10/04")
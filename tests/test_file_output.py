@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from configparser import ConfigParser
+from types import SimpleNamespace
+
+import bson
+import numpy as np
+import pytest
+from jax.output import get_output
+from jax.file_output import FileOutput, load_run
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def make_config(tmpdir, file_format):
+    config = ConfigParser()
+    config.add_section("jax")
+    config.set("jax", "output_mode", "file")
+    config.add_section("file_output")
+    config.set("file_output", "output_path", str(tmpdir))
+    config.set("file_output", "file_format", file_format)
+    config.set("file_output", "chunk_size", "4")
+    return config
+
+
+@pytest.mark.parametrize("file_format", ["npz", "hdf5", "parquet"])
+def test_file_output_roundtrip(tmpdir, file_format, make_event):
+    if file_format == "hdf5":
+        pytest.importorskip("h5py")
+    if file_format == "parquet":
+        pytest.importorskip("pyarrow")
+    output = get_output(make_config(tmpdir, file_format))
+    assert isinstance(output, FileOutput)
+
+    assert output.register_processor("run", "processed", 1)
+    for i in range(10):
+        output.save_doc(make_event(i), "run")
+    output.close("run", 10)
+
+    columns = load_run(output.get_filename("run"))
+    np.testing.assert_array_equal(columns['event_number'], np.arange(10))
+    np.testing.assert_array_equal(columns['event_length'], 100)
+    assert np.all(np.isnan(columns['cs1']))
+
+    status = output.read_status("run")
+    assert status['finished'] and status['events'] == 10
+    # Same instance, finished: leave it alone
+    assert not output.register_processor("run", "processed", 1)
+
+
+def test_file_output_waveforms(tmpdir):
+    output = get_output(make_config(tmpdir, "npz"))
+    event = SimpleNamespace(
+        sum_waveforms=[SimpleNamespace(name='tpc', detector='tpc',
+                                       samples=np.array([0, 1.], np.float32))],
+        peaks=[], all_hits=np.zeros(0), dataset_name='run', event_number=3,
+        start_time=0, stop_time=1)
+    output.save_waveform(event, "run")
+    output.save_waveform(event, "run")
+    with open(output.get_waveform_filename("run"), "rb") as f:
+        docs = list(bson.decode_file_iter(f))
+    assert len(docs) == 2
+    assert docs[0]['sum_waveforms'][0]['samples'] == ['z', '1', '1.0']
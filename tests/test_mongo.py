@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+from jax import mongo
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def test_clients_are_shared():
+    a = mongo.get_client("localhost:27017/admin", "user", "pw")
+    b = mongo.get_client("localhost:27017/admin", "user", "pw")
+    c = mongo.get_client("localhost:27017/admin")
+    assert a is b
+    assert a is not c
+    assert mongo.get_database("localhost:27017/admin", "monitor").client is c
+    mongo.close_clients()
+    assert mongo.get_client("localhost:27017/admin") is not c
+    mongo.close_clients()
+
+
+def test_clients_not_shared_across_fork():
+    parent = mongo.get_client("localhost:27017/admin")
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        child = mongo.get_client("localhost:27017/admin")
+        os.write(write, b"1" if child is not parent else b"0")
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b"1"
+    mongo.close_clients()
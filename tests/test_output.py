@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+from types import SimpleNamespace
+
+import bson
+import pymongo
+import numpy as np
+import pytest
+from jax.output import compress_waveform, encode_waveform, decode_waveform
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def test_save_doc_batches(make_output, make_event):
+    output = make_output(insert_batch_size=10, insert_flush_interval=1000)
+    for i in range(25):
+        output.save_doc(make_event(i), "run")
+    assert len(output.mdb["run"].docs) == 20
+    output.close("run", 25)
+    assert [d['event_number'] for d in output.mdb["run"].docs] == \
+        list(range(25))
+    # Two full batches and the forced flush
+    assert output.mdb["run"].n_calls == 3
+    updates = output.mdb["run_status"].updates
+    assert len(updates) == 1
+    assert updates[0]['$set'] == {'finished': True, 'events': 25}
+    # The run's aggregates go with it
+    assert updates[0]['$inc']['aggregates.counters.events'] == 25
+
+
+def test_resume_upserts_replayed_events(make_output, make_event):
+    output = make_output(resume=True, insert_batch_size=4,
+                         insert_flush_interval=1000)
+    output.index_events("run")
+    output.status().found = {'checkpoint': {'event': 2, 'saved': 2}}
+    output.mdb["run"].found = {'event_number': 4}
+    assert output.get_checkpoint("run")['event'] == 2
+    for i in range(2, 10):
+        output.save_doc(make_event(i), "run")
+    # 2 to 4 may be there already, the rest is new
+    assert [r._doc['event_number'] for r in output.mdb["run"].requests
+            if isinstance(r, pymongo.ReplaceOne)] == [2, 3, 4]
+    assert [d['event_number'] for d in output.mdb["run"].docs] == \
+        [5, 6, 7, 8, 9]
+    assert "run" not in output.replay_until
+
+
+@pytest.mark.parametrize("stat,resume,finish,later", [
+    ({'finished': True, 'instance_id': 16}, True, True, False),
+    ({'finished': False, 'instance_id': 16}, True, False, True),
+    ({'finished': False, 'instance_id': 16}, False, True, False),
+    ({'finished': False, 'instance_id': 3}, True, False, False),
+    ({'finished': False, 'instance_id': 3}, False, True, True),
+    ({'finished': False, 'instance_id': 3, 'mode': "processed"}, True,
+     True, False),
+])
+def test_may_take_later(stat, resume, finish, later, make_output):
+    output = make_output(resume=resume, finish=finish, instance_id=16)
+    output.status().found = stat
+    assert output.may_take_later("run", "raw") == later
+
+
+def test_save_doc_chunks(make_output, make_event):
+    output = make_output(doc_layout="chunks", chunk_size=10,
+                         insert_flush_interval=1000)
+    for i in range(25):
+        output.save_doc(make_event(i), "run")
+    output.close("run", 25)
+    chunks = output.mdb["run"].docs
+    assert [c['n_events'] for c in chunks] == [10, 10, 5]
+    assert chunks[2]['chunk'] == 2
+    assert chunks[1]['fields']['event_number'] == list(range(10, 20))
+    assert chunks[0]['fields']['cs1'] == [None] * 10
+    pushed = [u['$push']['chunks'] for u in output.mdb["run_status"].updates
+              if '$push' in u]
+    assert pushed[2] == {'chunk': 2, 'n_events': 5, 'first_event': 20,
+                         'last_event': 24}
+
+
+def matches(query, doc):
+    # Just enough of mongo's query language for claim_query
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(q, doc) for q in condition):
+                return False
+            continue
+        if not isinstance(condition, dict):
+            condition = {'$eq': condition}
+        for op, value in condition.items():
+            if op == '$eq' and doc.get(key) != value:
+                return False
+            if op == '$ne' and doc.get(key) == value:
+                return False
+            if op == '$in' and doc.get(key) not in value:
+                return False
+            if op == '$exists' and (key in doc) != value:
+                return False
+            if op == '$lt' and not (key in doc and doc[key] < value):
+                return False
+    return True
+
+
+STATUS_DOCS = [
+    {},
+    {'mode': 'raw', 'instance_id': 16, 'finished': True},
+    {'mode': 'raw', 'instance_id': 3, 'finished': False},
+    {'mode': 'processed', 'instance_id': 3, 'finished': True},
+    {'mode': 'processed', 'instance_id': 3},
+    {'mode': 'processed', 'instance_id': 16, 'finished': False},
+    {'instance_id': 3, 'finished': True},
+    {'mode': 'raw', 'instance_id': 16, 'finished': False,
+     'heartbeat': datetime.datetime(2000, 1, 1)},
+    {'mode': 'processed', 'instance_id': 16, 'finished': False,
+     'heartbeat': datetime.datetime(2000, 1, 1)},
+    {'mode': 'raw', 'instance_id': 16, 'finished': False,
+     'heartbeat': datetime.datetime.utcnow()},
+    {'mode': 'raw', 'instance_id': 16, 'finished': True,
+     'heartbeat': datetime.datetime(2000, 1, 1)},
+]
+
+
+@pytest.mark.parametrize("reprocess", [False, True])
+@pytest.mark.parametrize("finish", [False, True])
+@pytest.mark.parametrize("resume", [False, True])
+@pytest.mark.parametrize("mode", ["raw", "processed"])
+def test_claim_query_matches_rules(reprocess, finish, resume, mode,
+                                   make_output):
+    output = make_output(reprocess=reprocess, finish=finish, resume=resume,
+                         instance_id=16)
+    query = output.claim_query("run", mode)
+    for stat in STATUS_DOCS:
+        doc = dict(stat, _id="run")
+        assert matches(query, doc) == output.should_process(stat, mode)
+        assert not matches(query, dict(stat, _id="other"))
+
+
+def reference_compress(waveform):
+    # The original per-sample loop from CompressEvent
+    zeros = 0
+    ret = []
+    for i in range(0, len(waveform)):
+        if waveform[i] == 0:
+            zeros += 1
+            continue
+        else:
+            if zeros != 0:
+                ret.append('z')
+                ret.append(str(zeros))
+                zeros = 0
+            ret.append(str(waveform[i]))
+    if zeros != 0:
+        ret.append('z')
+        ret.append(str(zeros))
+    return ret
+
+
+@pytest.mark.parametrize("sparsity", [0., 0.5, 0.9, 0.99, 1.])
+def test_compress_waveform_matches_reference(sparsity):
+    rng = np.random.RandomState(1)
+    samples = rng.normal(size=5000).astype(np.float32)
+    samples[rng.uniform(size=5000) < sparsity] = 0
+    samples = samples.astype(np.float64).tolist()
+    assert compress_waveform(samples) == reference_compress(samples)
+
+
+@pytest.mark.parametrize("samples", [[], [0], [3], [0, 0, 1, 0], [1, 0, 0],
+                                     [0, 1.5, 2, 0, 0, 0, -1]])
+def test_compress_waveform_edges(samples):
+    assert compress_waveform(samples) == reference_compress(samples)
+    assert compress_waveform(np.array(samples)) == \
+        reference_compress(np.array(samples).tolist())
+
+
+def test_extract_waveform_doc(make_output):
+    output = make_output()
+    hits = np.zeros(2, dtype=[('channel', np.int16), ('area', np.float32)])
+    peak = SimpleNamespace(area=np.float32(10.), area_fraction_top=np.nan,
+                           area_per_channel=np.ones(3), center_time=5,
+                           index_of_maximum=2, left=1, right=4, type='s1',
+                           n_contributing_channels=np.int16(3))
+    event = SimpleNamespace(
+        sum_waveforms=[
+            SimpleNamespace(name='tpc', detector='tpc', channel_list=[0, 1],
+                            samples=np.array([0, 0, 1.5, 0], np.float32)),
+            SimpleNamespace(name='tpc_top', detector='tpc', channel_list=[0],
+                            samples=np.zeros(4, np.float32))],
+        peaks=[peak], all_hits=hits, dataset_name='run', event_number=7,
+        start_time=100, stop_time=200)
+    doc = output.ExtractWaveformDoc(event)
+    assert doc['sum_waveforms'] == [{'name': 'tpc', 'detector': 'tpc',
+                                     'channel_list': [0, 1],
+                                     'samples': ['z', '2', '1.5', 'z', '1']}]
+    assert doc['peaks'][0]['area_fraction_top'] is None
+    assert doc['peaks'][0]['area_per_channel'] == [1., 1., 1.]
+    assert doc['all_hits'] == [(0, 0.), (0, 0.)]
+    assert doc['event_number'] == 7
+    bson.BSON.encode(doc)
+
+
+@pytest.mark.parametrize("samples", [np.zeros(0), np.array([0, 3, -2, 0]),
+                                     np.array([0, 1.25, 0, 0, -7.5]),
+                                     np.array([40000, 0, 1])])
+def test_waveform_encodings_roundtrip(samples):
+    samples = samples.astype(np.float32)
+    encoded = encode_waveform(samples)
+    assert encoded['format_version'] == 1
+    bson.BSON.encode({'samples': encoded})
+    np.testing.assert_array_equal(decode_waveform(encoded), samples)
+    np.testing.assert_array_equal(
+        decode_waveform(compress_waveform(samples)), samples)
+
+
+def test_encode_waveform_dtype():
+    assert encode_waveform(np.array([0., 2., -5.]))['dtype'] == '<i2'
+    assert encode_waveform(np.array([0., 2.5]))['dtype'] == '<f4'
+    assert encode_waveform(np.array([1e5]))['dtype'] == '<f4'
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+from types import ModuleType
+
+import pytest
+from jax.pax_context import PaxContext
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+class FakeInput(object):
+    def __init__(self, config):
+        self.config = config
+        self.n_startups = 0
+        self.fail = False
+
+    def startup(self):
+        if self.fail:
+            raise RuntimeError("can't rescan")
+        self.n_startups += 1
+
+    def get_single_event(self, event_number):
+        return (self.config['input_name'], event_number)
+
+
+class FakeProcessor(object):
+    # Every processor built, in order
+    built = []
+
+    def __init__(self, config_names, config_dict):
+        self.config = config_dict
+        self.input_plugin = FakeInput(dict(config_dict['pax']))
+        self.input_plugin.startup()
+        self.shut_down = False
+        FakeProcessor.built.append(self)
+
+    def process_event(self, event):
+        return event
+
+    def shutdown(self):
+        self.shut_down = True
+
+
+@pytest.fixture
+def built(monkeypatch):
+    """
+    Stands in for pax.core, returns the processors it builds
+    """
+    core = ModuleType("pax.core")
+    core.Processor = FakeProcessor
+    pax = ModuleType("pax")
+    pax.core = core
+    monkeypatch.setitem(sys.modules, "pax", pax)
+    monkeypatch.setitem(sys.modules, "pax.core", core)
+    FakeProcessor.built = []
+    return FakeProcessor.built
+
+
+def test_reuse_within_run(built):
+    context = PaxContext()
+    assert list(context.get_events("run_a", [0, 1])) == \
+        [("run_a", 0), ("run_a", 1)]
+    assert list(context.get_events("run_a", [2])) == [("run_a", 2)]
+    assert len(built) == 1
+    # Re-pointed and rescanned, not built again
+    assert built[0].input_plugin.n_startups == 2
+    assert built[0].config['pax']['events_to_process'] == [2]
+    assert context.n_setups == 2 and context.n_builds == 1
+
+
+def test_new_run_rebuilds(built):
+    context = PaxContext()
+    list(context.get_events("run_a", [0]))
+    assert list(context.get_events("run_b", [0])) == [("run_b", 0)]
+    assert len(built) == 2
+    assert built[0].shut_down
+    assert built[1].config['pax']['input_name'] == "run_b"
+    assert context.input_name == "run_b"
+
+
+def test_rebuild_when_point_at_fails(built):
+    context = PaxContext()
+    list(context.get_events("run_a", [0]))
+    built[0].input_plugin.fail = True
+    assert list(context.get_events("run_a", [1])) == [("run_a", 1)]
+    assert len(built) == 2
+    assert context.pax is built[1]
+
+
+def test_no_reuse(built):
+    context = PaxContext(reuse=False)
+    for event_number in range(3):
+        list(context.get_events("run_a", [event_number]))
+    assert len(built) == 3
+
+
+def test_timing_summary(built):
+    context = PaxContext()
+    assert context.timing_summary() == "pax: no files processed"
+    list(context.get_events("run_a", [0]))
+    list(context.get_events("run_a", [1]))
+    list(context.get_events("run_b", [0]))
+    assert context.n_setups == 3 and context.n_builds == 2
+    assert context.setup_time >= context.build_time >= 0
+    summary = context.timing_summary()
+    assert summary.startswith("pax setup: 3 files, ")
+    assert "(2 builds, " in summary
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+from configparser import ConfigParser
+
+import pytest
+from jax.processor import Processor, process_file_task
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+class FakeResult(object):
+    """
+    Stands in for multiprocessing's AsyncResult. get() waits for the
+    file, so it's done afterwards.
+    """
+
+    def __init__(self, saved, done=False, error=None):
+        self.saved = saved
+        self.done = done
+        self.error = error
+        self.collected = False
+
+    def ready(self):
+        return self.done
+
+    def get(self):
+        self.done = True
+        self.collected = True
+        if self.error is not None:
+            raise self.error
+        return self.saved
+
+
+class FakePool(object):
+    """
+    Takes file tasks without running them. Every other file is done
+    right away, so they finish out of order.
+    """
+
+    def __init__(self, fail_at=None):
+        self.results = []
+        self.fail_at = fail_at
+        self.max_queued = 0
+        self.terminated = False
+
+    def apply_async(self, function, args):
+        assert function is process_file_task
+        run_name, to_process, saved_offset = args
+        error = None
+        if len(self.results) == self.fail_at:
+            error = ValueError("worker failed")
+        result = FakeResult(len(to_process), len(self.results) % 2 == 1,
+                            error)
+        self.results.append(result)
+        self.max_queued = max(self.max_queued, self.queued())
+        return result
+
+    def queued(self):
+        # Submitted and not collected yet
+        return sum(1 for result in self.results if not result.collected)
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self):
+        pass
+
+
+class RecordingOutput(object):
+    concurrent_writers = True
+
+    def __init__(self):
+        self.checkpoints = []
+        self.closed = None
+
+    def get_checkpoint(self, collection):
+        return None
+
+    def checkpoint(self, collection, checkpoint):
+        self.checkpoints.append(checkpoint)
+
+    def close(self, collection, nevents):
+        self.closed = nevents
+
+
+def make_processor(tmpdir, n_files, file_workers=2):
+    directory = tmpdir.mkdir("run")
+    for i in range(n_files):
+        directory.join("XENON1T-1-%09d-%09d-000001000.zip" % (
+            i * 1000, i * 1000 + 999)).write("x")
+    directory.join("eventbuilder.log").write("x")
+    config = ConfigParser()
+    config.add_section("jax")
+    config.set("jax", "input_type", "raw")
+    config.set("jax", "data_path", str(tmpdir))
+    config.set("jax", "raw_prescale", "10")
+    config.set("jax", "file_workers", str(file_workers))
+    return Processor(config)
+
+
+def test_collect_files_in_order():
+    processor = Processor(ConfigParser())
+    output = RecordingOutput()
+    first = FakeResult(10)
+    pending = collections.deque([("f0", 1, first), ("f1", 2, FakeResult(20,
+                                 True)), ("f2", 3, FakeResult(30, True))])
+    checkpoint = {'file': None, 'event': 0, 'saved': 5}
+    # f1 and f2 are done, but f0 isn't
+    checkpoint = processor.collect_files(output, "run", pending, checkpoint)
+    assert output.checkpoints == [] and len(pending) == 3
+    first.done = True
+    checkpoint = processor.collect_files(output, "run", pending, checkpoint)
+    assert [c['file'] for c in output.checkpoints] == ["f0", "f1", "f2"]
+    assert [c['saved'] for c in output.checkpoints] == [15, 35, 65]
+    assert checkpoint == {'file': "f2", 'event': 3, 'saved': 65}
+
+
+def test_collect_files_waits_down_to_max_pending():
+    processor = Processor(ConfigParser())
+    output = RecordingOutput()
+    pending = collections.deque(("f" + str(i), i, FakeResult(1))
+                                for i in range(4))
+    processor.collect_files(output, "run", pending,
+                            {'file': None, 'event': 0, 'saved': 0},
+                            max_pending=2)
+    assert [c['file'] for c in output.checkpoints] == ["f0", "f1"]
+    assert len(pending) == 2
+
+
+def test_file_pool_run(tmpdir):
+    processor = make_processor(tmpdir, 6)
+    pool = processor.file_pool = FakePool()
+    output = RecordingOutput()
+    assert processor.process_run(output, {'name': "run", 'number': 1}) == 600
+    assert output.closed == 600
+    assert [c['file'][:19] for c in output.checkpoints] == \
+        ["XENON1T-1-%09d" % (i * 1000) for i in range(6)]
+    assert [c['saved'] for c in output.checkpoints] == \
+        [100 * (i + 1) for i in range(6)]
+    # At most 2*file_workers-1 files ahead of the checkpoint, plus the
+    # one just submitted
+    assert pool.max_queued == 4
+    # Kept for the next run
+    assert processor.file_pool is pool and not pool.terminated
+
+
+def test_file_pool_error(tmpdir):
+    processor = make_processor(tmpdir, 6)
+    pool = processor.file_pool = FakePool(fail_at=2)
+    output = RecordingOutput()
+    with pytest.raises(ValueError):
+        processor.process_run(output, {'name': "run", 'number': 1})
+    assert [c['saved'] for c in output.checkpoints] == [100, 200]
+    assert output.closed is None
+    # The files still in it belong to the failed run
+    assert pool.terminated and processor.file_pool is None
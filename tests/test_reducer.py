@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from configparser import ConfigParser
+from types import SimpleNamespace
+
+import pytest
+from jax.reducer import Reducer, get_field_table, parse_field
+from jax.root_reader import (reduce_columns, columns_to_docs,
+                             table_branches)
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def make_config(**fields):
+    config = ConfigParser()
+    config.add_section("reduced_fields")
+    for field, spec in fields.items():
+        config.set("reduced_fields", field, spec)
+    return config
+
+
+def to_native(event):
+    # The python native pax event: s1s() and s2s() return the peaks
+    s1s = [event.peaks[i] for i in event.s1s]
+    s2s = [event.peaks[i] for i in event.s2s]
+    return SimpleNamespace(event_number=event.event_number,
+                           start_time=event.start_time,
+                           stop_time=event.stop_time,
+                           peaks=event.peaks, interactions=event.interactions,
+                           s1s=lambda: s1s, s2s=lambda: s2s)
+
+
+def test_flavours_agree(make_root_events):
+    events = make_root_events(200)
+    root = [Reducer().reduce(e) for e in events]
+    native = [Reducer().reduce(to_native(e)) for e in events]
+    assert root == native
+    # Main S1 channels go to the S1 key
+    for doc, event in zip(root, events):
+        if event.interactions:
+            s1 = event.peaks[event.interactions[0].s1]
+            assert doc['s1_n_contributing_channels'] == \
+                s1.n_contributing_channels
+
+
+def test_extra_fields(make_root_events, to_arrays):
+    table = get_field_table(make_config(
+        s2_width="s2.range_area_decile[9]",
+        largest_s1_saturated="largest_s1.n_saturated_channels",
+        s2_correction="interaction.s2_area_correction"))
+    reducer = Reducer(table)
+    events = make_root_events(300)
+    docs = [reducer.reduce(e) for e in events]
+    for doc, event in zip(docs, events):
+        if event.interactions:
+            interaction = event.interactions[0]
+            assert doc['s2_width'] == \
+                event.peaks[interaction.s2].range_area_decile[9]
+            assert doc['s2_correction'] == interaction.s2_area_correction
+        else:
+            assert doc['s2_width'] is None
+
+    # The bulk path makes the same docs
+    arrays = to_arrays(events)
+    assert set(table_branches(table)) <= set(arrays)
+    assert columns_to_docs(reduce_columns(arrays, table), table) == docs
+
+
+def test_bad_fields():
+    with pytest.raises(ValueError):
+        parse_field("a", "peak.area")
+    with pytest.raises(ValueError):
+        parse_field("a", "s1.area[")
+    assert parse_field("a", " s1.area[2] ") == ("a", "s1", "area", 2)
+    with pytest.raises(ValueError):
+        get_field_table(make_config(cs1="s1.area"))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from configparser import ConfigParser
+
+import numpy as np
+import pytest
+from jax.output import MonitorOutput, get_output
+from jax.root_reader import (reduce_columns, columns_to_docs,
+                             resolve_branches, PEAK_BRANCHES,
+                             INTERACTION_BRANCHES)
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def test_reduce_columns_matches_event_loop(make_root_events, to_arrays):
+    output = MonitorOutput(ConfigParser())
+    events = make_root_events(500)
+    expected = [output.MakeReducedDoc(e) for e in events]
+    docs = columns_to_docs(reduce_columns(to_arrays(events)))
+    assert len(docs) == len(expected)
+    for doc, exp in zip(docs, expected):
+        assert doc == exp
+
+
+def test_reduce_columns_no_peaks(make_root_events, to_arrays):
+    output = MonitorOutput(ConfigParser())
+    events = make_root_events(20)
+    for e in events:
+        e.peaks, e.s1s, e.s2s, e.interactions = [], [], [], []
+    docs = columns_to_docs(reduce_columns(to_arrays(events)))
+    assert docs == [output.MakeReducedDoc(e) for e in events]
+
+
+def test_resolve_branches():
+    names = (["events/" + n for n in ["event_number", "start_time",
+                                      "stop_time", "s1s", "s2s"]] +
+             ["events/peaks/peaks." + b for b in PEAK_BRANCHES] +
+             ["events/interactions/interactions." + b
+              for b in INTERACTION_BRANCHES])
+    names[5 + PEAK_BRANCHES.index("range_area_decile")] += "[11]"
+    branches = resolve_branches(names)
+    assert branches["peaks.range_area_decile"] == \
+        "events/peaks/peaks.range_area_decile[11]"
+    assert branches["s1s"] == "events/s1s"
+    with pytest.raises(KeyError):
+        resolve_branches(names[1:])
+
+
+def test_parallel_entry_ranges(tmpdir, make_root_events,
+                               write_root_file):
+    from jax.processor import Processor
+    from jax.file_output import load_run
+    from jax.root_reader import iterate_reduced
+    output = MonitorOutput(ConfigParser())
+    events = make_root_events(100)
+    filename = str(tmpdir.join("run.root"))
+    write_root_file(filename, events)
+
+    blocks = list(iterate_reduced(filename, 10, 7, entry_stop=30))
+    assert [stop for stop, docs in blocks] == [17, 24, 30]
+    docs = sum([docs for stop, docs in blocks], [])
+    assert docs == [output.MakeReducedDoc(e) for e in events[10:30]]
+    # Picked from the whole decile array, not a 50% decile we stored
+    n_checked = 0
+    for doc, event in zip(docs, events[10:30]):
+        if len(event.interactions) > 0:
+            s2 = event.peaks[event.interactions[0].s2]
+            assert doc['s2_range_50p_area'] == s2.range_area_decile[5]
+            n_checked += 1
+    assert n_checked > 0
+
+    config = ConfigParser()
+    config.add_section("jax")
+    config.set("jax", "input_type", "processed")
+    config.set("jax", "data_path", str(tmpdir))
+    config.set("jax", "entry_workers", "3")
+    config.set("jax", "checkpoint_interval", "9")
+    config.set("jax", "output_mode", "file")
+    config.add_section("file_output")
+    config.set("file_output", "output_path", str(tmpdir.join("out")))
+    file_output = get_output(config)
+    assert file_output.register_processor("run", "processed", 1)
+    assert Processor(config).process_run(file_output, {'name': "run"}) == 100
+
+    columns = load_run(file_output.get_filename("run"))
+    np.testing.assert_array_equal(columns['event_number'], np.arange(100))
+    assert file_output.read_status("run")['events'] == 100
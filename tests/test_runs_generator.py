@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from configparser import ConfigParser
+from types import SimpleNamespace
+
+from jax.runs_generator import RunsGenerator, RunDocCache
+from jax.scheduler import Scheduler
+from jax.jax import fill_slots
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+class FakeCursor(list):
+    def sort(self, key, direction):
+        return FakeCursor(sorted(self, key=lambda d: d[key],
+                                 reverse=direction < 0))
+
+    def limit(self, n):
+        return FakeCursor(self[:n])
+
+
+class FakeRuns(object):
+    def __init__(self):
+        self.docs = []
+        self.queries = []
+
+    def add(self, number, detector="tpc"):
+        self.docs.append({"_id": len(self.docs), "name": "run" + str(number),
+                          "number": number, "detector": detector,
+                          "source": {"type": "none"}})
+
+    def find(self, query, projection=None):
+        self.queries.append(query)
+        ret = FakeCursor()
+        for doc in self.docs:
+            if doc["detector"] != query.get("detector", doc["detector"]):
+                continue
+            if "_id" in query and not doc["_id"] > query["_id"]["$gt"]:
+                continue
+            if doc["name"] != query.get("name", doc["name"]):
+                continue
+            if projection is not None:
+                doc = dict((k, v) for k, v in doc.items()
+                           if k == "_id" or k in projection)
+            ret.append(doc)
+        return ret
+
+
+class Available(object):
+    def __init__(self, names):
+        self.names = set(names)
+        self.checked = []
+        self.availability = SimpleNamespace(summary=lambda: "")
+
+    def filter_available(self, docs):
+        self.checked.extend(doc['name'] for doc in docs)
+        return [doc for doc in docs if doc['name'] in self.names]
+
+
+def names(docs):
+    return [doc['name'] for doc in docs]
+
+
+def make_generator(**options):
+    config = ConfigParser()
+    config.add_section("runs_input")
+    config.set("runs_input", "detector", "tpc")
+    for key, value in options.items():
+        config.set("runs_input", key, str(value))
+    runs = RunsGenerator(config)
+    runs.db = FakeRuns()
+    return runs
+
+
+def test_incremental_discovery():
+    runs = make_generator()
+    for i in range(5):
+        runs.db.add(i)
+    runs.db.add(5, detector="muon_veto")
+    processor = Available(["run1", "run3", "run4"])
+
+    assert names(runs.get(processor)) == ["run4", "run3", "run1"]
+    assert runs.db.queries[0] == {"detector": "tpc"}
+    assert sorted(runs.candidates["run4"]) == ["_id", "detector", "name",
+                                               "number"]
+    # What get read is served from the cache
+    assert runs.get_run_doc("run4") is runs.candidates["run4"]
+    assert len(runs.db.queries) == 1
+
+    # The output took run4 and turned down run3
+    runs.defer("run4")
+    runs.defer("run3")
+    runs.db.add(6)
+    processor.names.add("run6")
+    processor.checked = []
+    assert names(runs.get(processor)) == ["run6", "run1"]
+    assert runs.db.queries[1] == {"detector": "tpc", "_id": {"$gt": 4}}
+    # Unavailable runs wait for recheck_unavailable
+    assert processor.checked == ["run6", "run1"]
+
+
+def test_recheck_after_delay():
+    runs = make_generator(recheck_unavailable=0, retry_rejected=0)
+    runs.db.add(1)
+    processor = Available([])
+    assert names(runs.get(processor)) == []
+    processor.names.add("run1")
+    assert names(runs.get(processor)) == ["run1"]
+    runs.defer("run1")
+    assert names(runs.get(processor)) == ["run1"]
+
+
+def test_dropped_run_never_offered():
+    runs = make_generator(recheck_unavailable=0, retry_rejected=0,
+                          process_runs='["run1"]')
+    runs.db.add(1)
+    runs.db.add(2)
+    processor = Available(["run1", "run2"])
+    assert names(runs.get(processor)) == ["run1", "run2", "run1"]
+    # Finished, the output turned it down for good
+    runs.drop("run1")
+    for i in range(3):
+        processor.checked = []
+        assert names(runs.get(processor)) == ["run2"]
+        assert processor.checked == ["run2"]
+
+
+def test_finished_run_claimed_once(make_output):
+    runs = make_generator(retry_rejected=0)
+    runs.db.add(1)
+    processor = Available(["run1"])
+    processor.get_mode = lambda: "processed"
+    processor.get_prescale = lambda: 1
+    output = make_output(resume=True, instance_id=16)
+    output.status().found = {'_id': "run1", 'finished': True,
+                             'instance_id': 16}
+    claims = []
+
+    def register_processor(collection, mode, prescale):
+        claims.append(collection)
+        return False
+    output.register_processor = register_processor
+    pool = SimpleNamespace(free_slots=lambda: 1)
+    for i in range(3):
+        fill_slots(pool, Scheduler(ConfigParser(), 1), runs, output,
+                   processor)
+    assert claims == ["run1"]
+    assert processor.checked == ["run1"]
+
+
+def test_run_doc_cache():
+    cache = RunDocCache(ttl=10, max_size=2)
+    cache.put({"name": "live"}, now=0)
+    cache.put({"name": "done", "end": 1}, now=0)
+    assert cache.get("live", now=5) == {"name": "live"}
+    # Live runs are read again after ttl, finished ones never
+    assert cache.get("live", now=11) is None
+    assert cache.get("done", now=1e9) == {"name": "done", "end": 1}
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # Least recently used out first
+    cache.put({"name": "a", "end": 1}, now=0)
+    cache.put({"name": "b", "end": 1}, now=0)
+    assert list(cache.docs) == ["a", "b"]
+
+
+def test_get_run_doc_refreshes_live_runs():
+    runs = make_generator(run_cache_ttl=0)
+    runs.db.add(1)
+    runs.db.add(2)
+    assert runs.get_run_doc("run1")["number"] == 1
+    assert runs.db.queries[-1] == {"detector": "tpc", "name": "run1"}
+    assert "source" not in runs.get_run_doc("run1")
+    assert len(runs.db.queries) == 2
+
+    # Once the run has ended it comes from the cache
+    runs.db.docs[0]["end"] = 100
+    assert runs.get_run_doc("run1")["end"] == 100
+    assert runs.get_run_doc("run1")["end"] == 100
+    assert len(runs.db.queries) == 3
+
+    assert runs.get_run_doc("run3") is None
+    runs.db.add(2)
+    assert runs.get_run_doc("run2") is None
+
+
+def test_runs_to_process():
+    runs = make_generator(process_runs='["run1", "run2"]')
+    runs.db = None
+    assert list(runs.get(Available(["run2"]))) == [{"name": "run2"}]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+from configparser import ConfigParser
+from types import SimpleNamespace
+
+import pytest
+from jax.scheduler import Scheduler, format_state
+from jax.processor import Processor, Paused
+from jax.jax import fill_slots
+
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+NOW = datetime.datetime(2018, 1, 2, 12)
+
+
+def make_scheduler(n_workers, **options):
+    config = ConfigParser()
+    config.add_section("scheduler")
+    for key, value in options.items():
+        config.set("scheduler", key, str(value))
+    return Scheduler(config, n_workers)
+
+
+def run_doc(name, hours_ago=None):
+    doc = {"name": name}
+    if hours_ago is not None:
+        doc["end"] = NOW - datetime.timedelta(hours=hours_ago)
+    return doc
+
+
+def now():
+    return NOW.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def test_order_by_class():
+    scheduler = make_scheduler(4)
+    docs = [run_doc("old1", 100), run_doc("recent", 2), run_doc("live"),
+            run_doc("old2", 30)]
+    ordered = scheduler.order(docs, now())
+    assert [(c, d["name"]) for c, d in ordered] == [
+        ("live", "live"), ("recent", "recent"), ("backlog", "old1"),
+        ("backlog", "old2")]
+    assert scheduler.waiting == {"live": ["live"], "recent": ["recent"],
+                                 "backlog": ["old1", "old2"]}
+
+    scheduler.started("old1", "backlog")
+    assert [d["name"] for c, d in scheduler.order(docs, now())] == [
+        "live", "recent", "old2"]
+
+
+def test_quotas():
+    scheduler = make_scheduler(3)
+    assert scheduler.quotas == {"live": 3, "recent": 3, "backlog": 2}
+    scheduler.order([run_doc("a", 100), run_doc("b", 100)], now())
+    scheduler.started("a", "backlog")
+    assert scheduler.has_quota("backlog")
+    scheduler.started("b", "backlog")
+    assert not scheduler.has_quota("backlog")
+    assert scheduler.has_quota("live")
+    scheduler.finished("a")
+    assert scheduler.has_quota("backlog")
+
+    scheduler = make_scheduler(1, live_quota=0)
+    assert not scheduler.has_quota("live")
+
+
+def test_victims():
+    scheduler = make_scheduler(2)
+    scheduler.order([run_doc("old", 100), run_doc("recent", 1)], now())
+    scheduler.started("recent", "recent")
+    assert scheduler.victims() == []
+    scheduler.started("old", "backlog")
+    assert scheduler.victims() == ["old"]
+    scheduler.paused("old")
+    # One at a time
+    assert scheduler.victims() == []
+    scheduler.finished("old")
+    assert scheduler.pausing == set()
+    assert "1 runs paused so far" in format_state(scheduler.state())
+
+    scheduler = make_scheduler(1, preempt=False)
+    scheduler.order([run_doc("old", 100)], now())
+    scheduler.started("old", "backlog")
+    assert scheduler.victims() == []
+
+
+def test_state_file(tmpdir):
+    state_file = str(tmpdir.join("queue.json"))
+    scheduler = make_scheduler(2, state_file=state_file)
+    scheduler.order([run_doc("live")], now())
+    scheduler.write_state()
+    with open(state_file) as f:
+        assert '"live": ["live"]' in f.read()
+
+
+def test_pause_processed_run(tmpdir, make_output, make_root_events,
+                             write_root_file):
+    write_root_file(str(tmpdir.join("run.root")), make_root_events(20))
+    config = ConfigParser()
+    config.add_section("jax")
+    config.set("jax", "input_type", "processed")
+    config.set("jax", "data_path", str(tmpdir))
+    config.set("jax", "checkpoint_interval", "5")
+    output = make_output(resume=True)
+    processor = Processor(config)
+    processor.pause = threading.Event()
+    processor.pause.set()
+
+    with pytest.raises(Paused):
+        processor.process_run(output, {"name": "run"})
+    checkpoint, release = output.status().updates[-2:]
+    assert checkpoint['$set']['checkpoint']['event'] == 5
+    assert release == {'$set': {'heartbeat': datetime.datetime(1970, 1, 1)}}
+    assert len(output.mdb["run"].docs) == 5
+    assert "run" not in output.aggregates
+
+
+class FakePool(object):
+    def __init__(self, slots):
+        self.slots = slots
+        self.submitted = []
+        self.started = []
+        self.paused = []
+
+    def free_slots(self):
+        return self.slots - len(self.submitted)
+
+    def submit(self, rundoc):
+        self.submitted.append(rundoc['name'])
+
+    def pause(self, name):
+        # Only runs a worker has started can be paused
+        if name not in self.started:
+            return False
+        self.paused.append(name)
+        return True
+
+
+class FakeRuns(object):
+    def __init__(self, docs):
+        self.docs = docs
+        self.deferred = []
+        self.dropped = []
+
+    def get(self, processor):
+        return iter(self.docs)
+
+    def defer(self, name, delay=None):
+        self.deferred.append(name)
+
+    def drop(self, name):
+        self.dropped.append(name)
+
+
+class FakeClaims(object):
+    """
+    Takes the runs in take, turns down the others, for good unless
+    they're in later, can't reach the DB for those in broken
+    """
+    def __init__(self, take, broken=(), later=()):
+        self.take = take
+        self.broken = broken
+        self.later = later
+
+    def register_processor(self, collection, mode, prescale):
+        if collection in self.broken:
+            raise RuntimeError("no DB")
+        return collection in self.take
+
+    def may_take_later(self, collection, mode):
+        return collection in self.later
+
+
+def test_fill_slots_defers_after_claim():
+    scheduler = make_scheduler(3)
+    runs = FakeRuns([run_doc("live"), run_doc("rejected", 100),
+                     run_doc("finished", 100), run_doc("old", 100)])
+    pool = FakePool(3)
+    processor = SimpleNamespace(get_mode=lambda: "processed",
+                                get_prescale=lambda: 1)
+    claims = FakeClaims(["old"], broken=["live"], later=["rejected"])
+    assert fill_slots(pool, scheduler, runs, claims, processor) == 1
+    assert pool.submitted == ["old"]
+    # The live run is tried again next pass
+    assert runs.deferred == ["rejected", "old"]
+    assert runs.dropped == ["finished"]
+    assert scheduler.running == {"old": "backlog"}
+
+
+def test_fill_slots_pauses_started_backlog_run():
+    scheduler = make_scheduler(2, backlog_quota=2)
+    processor = SimpleNamespace(get_mode=lambda: "processed",
+                                get_prescale=lambda: 1)
+    pool = FakePool(2)
+    claims = FakeClaims(["old1", "old2", "live"])
+    fill_slots(pool, scheduler, FakeRuns([run_doc("old1", 100),
+                                          run_doc("old2", 100)]),
+               claims, processor)
+    assert pool.submitted == ["old1", "old2"]
+    pool.started = ["old2"]
+
+    runs = FakeRuns([run_doc("live")])
+    fill_slots(pool, scheduler, runs, claims, processor)
+    # old1 hasn't started, so old2 it is
+    assert pool.paused == ["old2"]
+    assert scheduler.pausing == {"old2"}
+    fill_slots(pool, scheduler, runs, claims, processor)
+    assert pool.paused == ["old2"]
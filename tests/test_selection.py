@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from configparser import ConfigParser
+
+import pytest
+from jax.selection import WaveformSelector, parse_conditions, parse_class
+from jax.processor import Processor
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def make_config(**classes):
+    config = ConfigParser()
+    config.add_section("jax")
+    config.add_section("waveform_selection")
+    for name, spec in classes.items():
+        config.set("waveform_selection", name, spec)
+    return config
+
+
+def test_conditions():
+    waveform_class = parse_class("big", "s2 > 1e5 and interactions >= 2")
+    assert waveform_class.matches({"s2": 2e5, "interactions": 2})
+    assert not waveform_class.matches({"s2": 2e5, "interactions": 1})
+    assert not waveform_class.matches({"s2": None, "interactions": 3})
+    with pytest.raises(ValueError):
+        parse_conditions("s2 >> 1")
+    with pytest.raises(ValueError):
+        parse_conditions("s2 > 1 or s1 > 1")
+
+
+def test_rate_limit_in_event_time():
+    selector = WaveformSelector(make_config(big="s2 > 100 ; 2"), prescale=0)
+    minute = int(60e9)
+    # 10 big ones in the first second, then one every 10 s
+    times = [i * int(1e8) for i in range(10)]
+    times += [minute + i * int(10e9) for i in range(12)]
+    selected = [selector.select({"s2": 1000., "time": t}, i)
+                for i, t in enumerate(times)]
+    assert selected[:10].count("big") == 2
+    # Refills at 2 per minute: every third one after the first minute
+    assert selected[10:].count("big") == 5
+    assert selector.select({"s2": 1., "time": 10 * minute}, 0) is None
+    assert "big 7 of 22" in selector.summary()
+
+
+def test_classes_then_prescale():
+    selector = WaveformSelector(make_config(multi="interactions >= 2"),
+                                prescale=10)
+    assert selector.select({"interactions": 3}, 3) == "multi"
+    assert selector.select({"interactions": 1}, 20) == "prescale"
+    assert selector.select({"interactions": 1}, 21) is None
+
+
+class FakePax(object):
+    # Stands in for jax.pax_context.PaxContext
+    def get_events(self, input_name, to_process):
+        return iter(to_process)
+
+    def process_event(self, event):
+        return event
+
+
+class FakeOutput(object):
+    def __init__(self):
+        self.docs = []
+        self.waveforms = []
+
+    def MakeReducedDoc(self, event):
+        return {"event_number": event, "time": event * int(1e9),
+                "s2": 1e6 if event % 7 == 0 else 10.}
+
+    def save_reduced_doc(self, doc, collection):
+        self.docs.append(doc)
+
+    def save_waveform(self, event, collection, selection=None):
+        self.waveforms.append((event, selection))
+        # The second one doesn't fit
+        return len(self.waveforms) != 2
+
+
+def test_process_file_selects_waveforms():
+    config = make_config(large_s2="s2 > 1e5 ; 60")
+    config.set("jax", "waveform_prescale", "25")
+    processor = Processor(config)
+    processor.pax_context = FakePax()
+    output = FakeOutput()
+    assert processor.process_file(output, "run", range(50), 0) == 50
+    assert len(output.docs) == 50
+    # Every 7th for S2, 25 for the prescale and 8 again for 7 not fitting
+    assert output.waveforms == [
+        (0, "large_s2"), (7, "large_s2"), (8, "large_s2"), (14, "large_s2"),
+        (21, "large_s2"), (25, "prescale"), (28, "large_s2"),
+        (35, "large_s2"), (42, "large_s2"), (49, "large_s2")]
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import pytest
+from jax.watcher import RunWatcher
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def touch(directory, name):
+    with open(os.path.join(directory, name), "w") as f:
+        f.write("x")
+
+
+def later(delay, function, *args):
+    timer = threading.Timer(delay, function, args)
+    timer.start()
+    return timer
+
+
+@pytest.fixture(params=[True, False], ids=["inotify", "polling"])
+def use_inotify(request):
+    return request.param
+
+
+def test_watcher_index(tmpdir, use_inotify):
+    directory = str(tmpdir)
+    touch(directory, "XENON1T-6386-000000000-000000999-000001000.zip")
+    touch(directory, "XENON1T-6386-000001000-000001999-000001000.zip")
+    touch(directory, "XENON1T-6386-000002000-000002999-000001000.zip_temp")
+    touch(directory, "XENON1T-6385-000003000-000003999-000001000.zip")
+    watcher = RunWatcher(directory, "XENON1T-6386-", use_inotify=use_inotify)
+    assert watcher.any_files
+    assert sorted(watcher.files) == [0, 1000]
+    assert not watcher.finished
+    assert watcher.wait_for(2000, 0) is None
+    watcher.close()
+
+
+def test_watcher_notices_new_files(tmpdir, use_inotify):
+    directory = str(tmpdir)
+    watcher = RunWatcher(directory, "XENON1T-1-", poll_interval=0.05,
+                         use_inotify=use_inotify)
+    name = "XENON1T-1-000000000-000000999-000001000.zip"
+    later(0.1, touch, directory, name + "_temp")
+    later(0.2, os.rename, os.path.join(directory, name + "_temp"),
+          os.path.join(directory, name))
+    start = time.time()
+    assert watcher.wait_for(0, 5) == name
+    assert time.time() - start < 1
+
+    later(0.1, touch, directory, "eventbuilder.log")
+    assert watcher.wait_for(1000, 5) is None
+    assert watcher.finished
+    watcher.close()
+
+
+def test_watcher_inotify_without_rescans(tmpdir):
+    directory = str(tmpdir)
+    watcher = RunWatcher(directory, "XENON1T-1-", rescan_interval=60)
+    if watcher.fd is None:
+        pytest.skip("no inotify here")
+    name = "XENON1T-1-000000000-000000999-000001000.zip"
+    later(0.1, touch, directory, name)
+    start = time.time()
+    assert watcher.wait_for(0, 5) == name
+    assert time.time() - start < 1
+    watcher.close()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from configparser import ConfigParser
+
+from jax.output import get_output
+from jax.workers import WorkerPool
+
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+def make_config(tmpdir):
+    config = ConfigParser()
+    config.add_section("jax")
+    config.set("jax", "input_type", "processed")
+    config.set("jax", "data_path", str(tmpdir))
+    config.set("jax", "output_mode", "file")
+    config.add_section("file_output")
+    config.set("file_output", "output_path", str(tmpdir.join("out")))
+    return config
+
+
+def test_pool_runs_and_recycles(tmpdir, make_root_events, write_root_file):
+    names = ["run" + str(i) for i in range(3)]
+    for i, name in enumerate(names):
+        write_root_file(str(tmpdir.join(name + ".root")),
+                        make_root_events(10 + i, seed=i))
+    config = make_config(tmpdir)
+    output = get_output(config)
+
+    pool = WorkerPool(config, 2, max_runs=1)
+    pool.start()
+    try:
+        todo = list(names)
+        finished = {}
+        deadline = time.time() + 60
+        while len(finished) < len(names) and time.time() < deadline:
+            while todo and pool.free_slots() > 0:
+                name = todo.pop(0)
+                assert output.register_processor(name, "processed", 1)
+                pool.submit({"name": name})
+            finished.update(pool.wait(1))
+        assert finished == {"run0": 10, "run1": 11, "run2": 12}
+        assert pool.busy() == 0
+        # Every worker retired after its run and was replaced
+        assert pool.n_recycled == 3
+        assert len(pool.workers) == 2
+    finally:
+        pool.stop()
+    assert output.read_status("run2")['events'] == 12
+
+
+def test_dead_worker_is_replaced(tmpdir):
+    pool = WorkerPool(make_config(tmpdir), 1)
+    pool.start()
+    try:
+        worker = pool.workers[0]
+        worker.terminate()
+        worker.join()
+        assert pool.wait(0.1) == []
+        assert list(pool.workers) == [1]
+        assert pool.workers[1].is_alive()
+    finally:
+        pool.stop()
+
+
+def test_dead_worker_reports_submitted_run(tmpdir):
+    pool = WorkerPool(make_config(tmpdir), 1)
+    pool.start()
+    try:
+        worker = pool.workers[0]
+        # Dies before it gets to say it started
+        worker.terminate()
+        worker.join()
+        pool.submit({"name": "run"})
+        assert pool.free_slots() == 0
+        assert pool.wait(0.1) == [("run", -1)]
+        assert pool.free_slots() == 1
+        assert pool.busy() == 0
+    finally:
+        pool.stop()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+from jax.writer import AsyncOutput, WriterError
+
+__author__ = "Daniel Coderre"
+__copyright__ = "Daniel Coderre"
+__license__ = "gpl3"
+
+
+class RecordingOutput(object):
+    """
+    Stands in for a backend. Reduces an event to its own number.
+    """
+    debug_waveform_size = False
+
+    def __init__(self, fail_on=None, block=None):
+        self.docs = []
+        self.closed = None
+        self.fail_on = fail_on
+        self.block = block
+        self.threads = set()
+
+    def MakeReducedDoc(self, event):
+        return {"event_number": event}
+
+    def ExtractWaveformDoc(self, event):
+        return {"event_number": event}
+
+    def save_reduced_doc(self, insert_doc, collection):
+        self.threads.add(threading.current_thread().name)
+        if self.block is not None:
+            self.block.wait()
+        if insert_doc["event_number"] == self.fail_on:
+            raise RuntimeError("insert failed")
+        self.docs.append(insert_doc["event_number"])
+
+    def save_waveform(self, event, collection, selection=None):
+        return self.save_waveform_doc(self.ExtractWaveformDoc(event),
+                                      collection)
+
+    def save_waveform_doc(self, waveform_doc, collection):
+        return waveform_doc["event_number"] != self.fail_on
+
+    def close(self, collection, nevents):
+        self.closed = (collection, nevents, list(self.docs))
+
+
+def test_async_output_drains_on_close():
+    backend = RecordingOutput()
+    output = AsyncOutput(backend, queue_size=5)
+    for i in range(100):
+        output.save_doc(i, "run")
+    output.close("run", 100)
+    assert backend.closed == ("run", 100, list(range(100)))
+    assert backend.threads == {"jax-writer"}
+    output.stop()
+
+
+def test_async_output_backpressure():
+    block = threading.Event()
+    output = AsyncOutput(RecordingOutput(block=block), queue_size=2)
+    # One doc in the writer, two in the queue. The next one has to wait.
+    for i in range(3):
+        output.save_doc(i, "run")
+    producer = threading.Thread(target=output.save_doc, args=(3, "run"))
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+    block.set()
+    producer.join(1)
+    assert not producer.is_alive()
+    output.stop()
+
+
+def test_async_output_reports_errors():
+    output = AsyncOutput(RecordingOutput(fail_on=3))
+    for i in range(5):
+        output.save_doc(i, "run")
+    with pytest.raises(WriterError):
+        output.close("run", 5)
+
+
+def test_async_output_waveform_retry():
+    output = AsyncOutput(RecordingOutput(fail_on=1))
+    # Each call tells about its own waveform
+    assert not output.save_waveform(1, "run")
+    assert output.save_waveform(2, "run")
+    output.stop()